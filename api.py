@@ -0,0 +1,494 @@
+"""Headless HTTP API for the scribe pipeline, for mobile and other clients.
+
+    python api.py --port 8000 --workers 4
+    uvicorn api:app --workers 4
+
+Every request carries a bearer token from `POST /auth/token`, and all state
+lives in MongoDB, so any number of API processes can run behind a load
+balancer. Recordings posted to `/recordings` are queued for worker.py, like
+the Streamlit app does; `/recordings?stream=1` instead transcribes in this
+process and streams the transcript and summary back as NDJSON events.
+"""
+import argparse
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import openai
+import uvicorn
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.responses import (JSONResponse, PlainTextResponse,
+                                 StreamingResponse)
+from starlette.routing import Route
+
+import jobs
+import metrics
+from data import DEFAULT_PROMPT_NAME, DatabaseManager
+from jobs import JobQueue
+from resilience import CircuitOpenError, DeadlineExceeded
+from stt import prepare_upload, transcribe_upload
+from stt_backends import create_router
+from summary_cache import SummaryCache
+from utils import (get_summary, hash_audio, stream_summary,
+                   stream_summary_to_db, verify_user)
+
+API_TOKEN_TTL_SECONDS = int(os.getenv('API_TOKEN_TTL_SECONDS', 12 * 3600))
+API_MAX_UPLOAD_BYTES = int(os.getenv('API_MAX_UPLOAD_BYTES', 200 * 1024 * 1024))
+API_PAGE_SIZE = 20
+
+logger = logging.getLogger("scriber.api")
+
+
+class ApiResponse(JSONResponse):
+    """JSON response that also encodes ObjectIds and datetimes"""
+
+    def render(self, content):
+        return json.dumps(content, default=encode).encode("utf-8")
+
+
+def encode(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def ndjson(event, **fields):
+    return json.dumps({"event": event, **fields}, default=encode) + "\n"
+
+
+def api_secret():
+    secret = os.getenv('API_SECRET')
+    if not secret:
+        raise RuntimeError("API_SECRET must be set to issue API tokens")
+    return secret.encode()
+
+
+def issue_token(provider_id, ttl=API_TOKEN_TTL_SECONDS):
+    """Signed `provider_id.expiry.signature` token; nothing is stored"""
+    expires_at = int(time.time() + ttl)
+    payload = f"{provider_id}.{expires_at}"
+    signature = hmac.new(api_secret(), payload.encode(),
+                         hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}", expires_at
+
+
+def verify_token(token):
+    """Provider id of a valid, unexpired token, else None"""
+    try:
+        provider_id, expires_at, signature = token.split(".")
+        expired = int(expires_at) < time.time()
+    except ValueError:
+        return None
+    expected = hmac.new(api_secret(), f"{provider_id}.{expires_at}".encode(),
+                        hashlib.sha256).hexdigest()
+    if expired or not hmac.compare_digest(signature, expected):
+        return None
+    return provider_id
+
+
+def authenticated(endpoint):
+    """Resolve the bearer token and pass its provider id to `endpoint`"""
+    @functools.wraps(endpoint)
+    async def wrapper(request):
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        provider_id = verify_token(token) if scheme.lower() == "bearer" else None
+        if provider_id is None:
+            raise HTTPException(401, "Missing or invalid token")
+        return await endpoint(request, provider_id)
+    return wrapper
+
+
+async def read_json(request, *required):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(400, "Body must be JSON")
+    if not isinstance(body, dict):
+        raise HTTPException(400, "Body must be a JSON object")
+    missing = [field for field in required if not body.get(field)]
+    if missing:
+        raise HTTPException(400, f"Missing fields: {', '.join(missing)}")
+    return body
+
+
+def object_id(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise HTTPException(404, "Not found")
+
+
+def int_param(request, name, default):
+    try:
+        return max(0, int(request.query_params.get(name, default)))
+    except ValueError:
+        raise HTTPException(400, f"{name} must be an integer")
+
+
+async def own_patient(request, provider_id, patient_id):
+    """404 unless the patient exists and belongs to this provider"""
+    patient = await run_in_threadpool(
+        request.app.state.db.patients.find_one,
+        {"_id": object_id(patient_id), "provider_id": provider_id},
+        {"_id": 1})
+    if patient is None:
+        raise HTTPException(404, "Patient not found")
+    return patient_id
+
+
+async def own_recording(request, provider_id, recording_id):
+    object_id(recording_id)
+    recording = await run_in_threadpool(
+        request.app.state.db_manager.load_recording_data, recording_id)
+    if recording is None or recording["provider_id"] != provider_id:
+        raise HTTPException(404, "Recording not found")
+    return recording
+
+
+async def resolve_prompt(request, provider_id, body):
+    """An explicit `system_prompt`, or the provider's `prompt_name` template"""
+    if body.get("system_prompt"):
+        return body["system_prompt"]
+    prompt_name = body.get("prompt_name") or DEFAULT_PROMPT_NAME
+    prompts = await run_in_threadpool(
+        request.app.state.db_manager.load_system_prompts, provider_id)
+    if prompt_name not in prompts:
+        raise HTTPException(400, f"Unknown prompt: {prompt_name}")
+    return prompts[prompt_name]
+
+
+async def create_token(request):
+    body = await read_json(request, "email", "password")
+    provider_id = await run_in_threadpool(
+        verify_user, body["email"], body["password"], request.app.state.db)
+    if not provider_id:
+        raise HTTPException(401, "Invalid email or password")
+    token, expires_at = issue_token(provider_id)
+    return ApiResponse({"token": token, "provider_id": provider_id,
+                        "expires_at": expires_at})
+
+
+@authenticated
+async def list_patients(request, provider_id):
+    patients = await run_in_threadpool(
+        request.app.state.db_manager.get_all_patients, provider_id)
+    return ApiResponse([
+        {"id": patient_id, "first_name": first, "last_name": last}
+        for first, last, patient_id in patients
+    ])
+
+
+@authenticated
+async def create_patient(request, provider_id):
+    body = await read_json(request, "first_name", "last_name")
+    patient_id = await run_in_threadpool(
+        request.app.state.db_manager.save_patient_data, body["first_name"],
+        body["last_name"], provider_id, body.get("notes", ""))
+    return ApiResponse({"id": patient_id}, status_code=201)
+
+
+@authenticated
+async def patient_notes(request, provider_id):
+    db_manager = request.app.state.db_manager
+    patient_id = await own_patient(
+        request, provider_id, request.path_params["patient_id"])
+    if request.method == "PUT":
+        body = await read_json(request)
+        saved = await run_in_threadpool(
+            db_manager.update_patient_notes, patient_id,
+            body.get("notes", ""), body.get("version"))
+        if saved is None:
+            raise HTTPException(409, "Notes were changed since that version")
+    notes, version = await run_in_threadpool(
+        db_manager.get_patient_notes, patient_id)
+    return ApiResponse({"id": patient_id, "notes": notes, "version": version})
+
+
+@authenticated
+async def patient_recordings(request, provider_id):
+    """Newest-first page; pass `next` back as `before` for older ones"""
+    patient_id = await own_patient(
+        request, provider_id, request.path_params["patient_id"])
+    before = request.query_params.get("before")
+    if before:
+        timestamp, _, last_id = before.partition("_")
+        try:
+            before = (datetime.fromisoformat(timestamp), str(ObjectId(last_id)))
+        except (ValueError, InvalidId):
+            raise HTTPException(400, "Invalid cursor")
+    recordings, cursor = await run_in_threadpool(
+        request.app.state.db_manager.list_recordings, patient_id, provider_id,
+        limit=min(int_param(request, "limit", API_PAGE_SIZE), 100) or 1,
+        before=before)
+    return ApiResponse({
+        "recordings": [{"id": r["_id"], "timestamp": r["timestamp"]}
+                       for r in recordings],
+        "next": f"{cursor[0].isoformat()}_{cursor[1]}" if cursor else None
+    })
+
+
+@authenticated
+async def search_recordings(request, provider_id):
+    query = request.query_params.get("q", "")
+    results = await run_in_threadpool(
+        request.app.state.db_manager.search_recordings, provider_id, query,
+        page=int_param(request, "page", 0),
+        page_size=min(int_param(request, "page_size", 10), 100) or 1)
+    return ApiResponse(results)
+
+
+@authenticated
+async def recording(request, provider_id):
+    """
+    PATCH writes only the fields given. Send the `version` the edit is
+    based on to get a 409 instead of overwriting someone else's change.
+    """
+    recording_id = request.path_params["recording_id"]
+    current = await own_recording(request, provider_id, recording_id)
+    if request.method == "PATCH":
+        body = await read_json(request)
+        fields = {field: body[field] for field in ("transcript", "summary")
+                  if isinstance(body.get(field), str)}
+        if not fields:
+            raise HTTPException(400, "Nothing to update")
+        saved = await run_in_threadpool(
+            request.app.state.db_manager.patch_recording, recording_id,
+            fields, body.get("version"))
+        if saved is None:
+            raise HTTPException(409, "Recording was changed since that version")
+        current = await own_recording(request, provider_id, recording_id)
+    return ApiResponse({
+        "id": current["_id"],
+        "patient_id": current["patient_id"],
+        "timestamp": current["timestamp"],
+        "last_modified": current.get("last_modified"),
+        "transcript": current["transcript"],
+        "summary": current["summary"],
+        "summary_complete": current.get("summary_complete", True),
+        "version": current.get("version", 0)
+    })
+
+
+@authenticated
+async def create_recording(request, provider_id):
+    """
+    Upload a recording as the raw request body. By default it is queued
+    for worker.py and a job id is returned (202); with `stream=1` it is
+    processed here and the response streams NDJSON events: `transcript`,
+    then `summary` deltas, then `done` with the recording id.
+    """
+    state = request.app.state
+    if not request.query_params.get("patient_id"):
+        raise HTTPException(400, "patient_id is required")
+    patient_id = await own_patient(
+        request, provider_id, request.query_params.get("patient_id"))
+    if int(request.headers.get("content-length") or 0) > API_MAX_UPLOAD_BYTES:
+        raise HTTPException(413, "Recording is too large")
+    audio = await request.body()
+    if not audio:
+        raise HTTPException(400, "Empty recording")
+    system_prompt = await resolve_prompt(
+        request, provider_id, dict(request.query_params))
+
+    audio_hash = hash_audio(audio)
+    recording_id = await run_in_threadpool(
+        state.db_manager.find_recording_by_hash, provider_id, audio_hash)
+    if recording_id:
+        return ApiResponse({"recording_id": recording_id, "duplicate": True})
+
+    if request.query_params.get("stream") != "1":
+        job_id, created = await run_in_threadpool(
+            state.job_queue.enqueue, audio, provider_id, patient_id,
+            system_prompt, audio_hash)
+        return ApiResponse({"job_id": job_id, "duplicate": not created},
+                           status_code=202)
+
+    async def events():
+        try:
+            upload = await run_in_threadpool(prepare_upload, audio)
+            result = await transcribe_upload(upload, state.stt_router)
+            if not result["transcript"]:
+                yield ndjson("error", detail="Transcription returned no text")
+                return
+            yield ndjson("transcript", transcript=result["transcript"],
+                         words=result["words"])
+
+            audio_file_id = await run_in_threadpool(
+                state.job_queue.audio.save, audio,
+                metadata={"provider_id": provider_id,
+                          "patient_id": patient_id})
+            recording_id = await run_in_threadpool(
+                state.db_manager.save_recording_data, result["transcript"],
+                "", provider_id, patient_id, summary_complete=False,
+                audio_hash=audio_hash, audio_file_id=audio_file_id)
+            tokens = stream_summary_to_db(
+                result["transcript"], system_prompt, state.db_manager,
+                recording_id, state.summary_cache)
+            async for token in iterate_in_threadpool(tokens):
+                yield ndjson("summary", delta=token)
+            yield ndjson("done", recording_id=recording_id)
+        except Exception as e:
+            # Headers are already sent; report the failure in-band.
+            logger.warning("Streamed recording failed: %s", e)
+            yield ndjson("error", detail=str(e))
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+@authenticated
+async def job_status(request, provider_id):
+    job = await run_in_threadpool(
+        request.app.state.db.jobs.find_one,
+        {"_id": object_id(request.path_params["job_id"]),
+         "provider_id": provider_id},
+        {"state": 1, "recording_id": 1, "error": 1, "created_at": 1,
+         "updated_at": 1})
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    job["id"] = job.pop("_id")
+    job["finished"] = job["state"] not in jobs.ACTIVE_STATES
+    return ApiResponse(job)
+
+
+@authenticated
+async def summarize(request, provider_id):
+    """
+    Summarize a transcript with a saved template or an explicit prompt.
+    Streams plain-text tokens unless `stream` is false in the body.
+    """
+    state = request.app.state
+    body = await read_json(request, "transcript")
+    system_prompt = await resolve_prompt(request, provider_id, body)
+    if body.get("stream", True) is False:
+        summary = await run_in_threadpool(
+            get_summary, body["transcript"], system_prompt,
+            state.summary_cache)
+        return ApiResponse({"summary": summary})
+    tokens = stream_summary(body["transcript"], system_prompt,
+                            state.summary_cache)
+    # Wait for the first token before sending the status, so an OpenAI
+    # outage is still a 503/504 rather than an empty 200.
+    first = await run_in_threadpool(next, tokens, None)
+
+    async def text():
+        if first is not None:
+            yield first
+        async for token in iterate_in_threadpool(tokens):
+            yield token
+
+    return StreamingResponse(text(), media_type="text/plain; charset=utf-8")
+
+
+@authenticated
+async def prompts(request, provider_id):
+    db_manager = request.app.state.db_manager
+    if request.method == "PUT":
+        body = await read_json(request)
+        if not body or not all(isinstance(name, str) and isinstance(text, str)
+                               for name, text in body.items()):
+            raise HTTPException(400, "Body must map prompt names to text")
+        await run_in_threadpool(
+            db_manager.save_system_prompts, body, provider_id)
+    return ApiResponse(await run_in_threadpool(
+        db_manager.load_system_prompts, provider_id))
+
+
+async def health(request):
+    await run_in_threadpool(request.app.state.db.command, "ping")
+    return ApiResponse({"status": "ok",
+                        "stt": request.app.state.stt_router.status()})
+
+
+async def metrics_endpoint(request):
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(404, "Metrics are disabled")
+    return PlainTextResponse(metrics.registry.render_prometheus(),
+                             media_type="text/plain; version=0.0.4")
+
+
+async def http_error(request, exc):
+    return ApiResponse({"detail": exc.detail}, status_code=exc.status_code)
+
+
+async def upstream_unavailable(request, exc):
+    return ApiResponse({"detail": str(exc)}, status_code=503,
+                       headers={"Retry-After": "30"})
+
+
+async def upstream_timeout(request, exc):
+    return ApiResponse({"detail": str(exc)}, status_code=504)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    load_dotenv()
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    api_secret()
+    client = MongoClient(os.getenv('MONGO_URI'))
+    db_manager = DatabaseManager(client)
+    app.state.db_manager = db_manager
+    app.state.db = db_manager.db
+    app.state.job_queue = JobQueue(db_manager.db)
+    app.state.summary_cache = SummaryCache(db_manager.db)
+    app.state.stt_router = await create_router()
+    try:
+        yield
+    finally:
+        await app.state.stt_router.aclose()
+        client.close()
+
+
+routes = [
+    Route("/health", health),
+    Route("/metrics", metrics_endpoint),
+    Route("/auth/token", create_token, methods=["POST"]),
+    Route("/patients", list_patients, methods=["GET"]),
+    Route("/patients", create_patient, methods=["POST"]),
+    Route("/patients/{patient_id}/notes", patient_notes,
+          methods=["GET", "PUT"]),
+    Route("/patients/{patient_id}/recordings", patient_recordings),
+    Route("/recordings", search_recordings, methods=["GET"]),
+    Route("/recordings", create_recording, methods=["POST"]),
+    Route("/recordings/{recording_id}", recording, methods=["GET", "PATCH"]),
+    Route("/jobs/{job_id}", job_status),
+    Route("/summaries", summarize, methods=["POST"]),
+    Route("/prompts", prompts, methods=["GET", "PUT"]),
+]
+
+app = Starlette(
+    routes=routes,
+    lifespan=lifespan,
+    exception_handlers={
+        HTTPException: http_error,
+        CircuitOpenError: upstream_unavailable,
+        DeadlineExceeded: upstream_timeout,
+    }
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+    uvicorn.run("api:app", host=args.host, port=args.port,
+                workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
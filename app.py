@@ -1,25 +1,42 @@
 import streamlit as st
-from stt import deepgram_stt
+from stt import record_audio
 from dotenv import load_dotenv
 import os
 import openai
+import metrics
 from data import DatabaseManager
+from jobs import JobQueue
+from utils import hash_audio
 from auth import render_auth_ui
 from ui_components import (
     render_sidebar,
     render_visit_records,
-    render_patient_notes
+    render_patient_notes,
+    render_job_status,
+    render_batch_status,
+    render_search,
+    render_autosave
 )
-from utils import get_summary
 
 load_dotenv()
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
+
+@st.cache_resource
+def start_metrics_server():
+    # One /metrics endpoint per Streamlit process; no-op unless enabled.
+    return metrics.start_http_server()
+
+
+start_metrics_server()
+
 # Initialize session state
 if 'authenticated' not in st.session_state:
     st.session_state['authenticated'] = False
     st.session_state['provider_id'] = None
     st.session_state['current_file'] = None
+    st.session_state['pending_jobs'] = []
+    st.session_state['processed_hashes'] = {}
 
 # Initialize database connection
 db_manager = DatabaseManager()
@@ -29,20 +46,40 @@ else:
     st.error("Failed to initialize MongoDB connection")
     st.stop()
 
+job_queue = JobQueue(db)
 
-def process_new_recording(transcript):
+
+def process_new_recording(audio):
+    # audio_recorder hands back the last recording on every rerun, so skip
+    # audio we've already seen in this session before touching the database.
+    audio_hash = hash_audio(audio)
+    if audio_hash in st.session_state.processed_hashes:
+        return
+
+    # Transcription and summarization run in worker.py; we only enqueue here
+    # so the provider can start the next visit straight away.
     try:
-        with st.spinner('Generating summary...'):
-            system_prompt = st.session_state.current_prompt
-            summary = get_summary(transcript, system_prompt)
-            doc_id = db_manager.save_recording_data(
-                transcript,
-                summary,
-                st.session_state.provider_id,
-                st.session_state.selected_patient_id
-            )
-            st.session_state.current_file = doc_id
-            st.success("Recording saved successfully!")
+        recording_id = db_manager.find_recording_by_hash(
+            st.session_state.provider_id, audio_hash)
+        if recording_id:
+            st.session_state.processed_hashes[audio_hash] = recording_id
+            st.session_state.current_file = recording_id
+            st.info("This recording has already been processed")
+            return
+
+        job_id, created = job_queue.enqueue(
+            audio,
+            st.session_state.provider_id,
+            st.session_state.selected_patient_id,
+            st.session_state.current_prompt,
+            audio_hash
+        )
+        st.session_state.processed_hashes[audio_hash] = job_id
+        if created:
+            st.session_state.pending_jobs.append(job_id)
+            st.success("Recording queued for processing")
+        else:
+            st.info("This recording is already being processed")
 
     except Exception as e:
         st.error(f"Error processing recording: {str(e)}")
@@ -59,6 +96,10 @@ st.title("Scribe")
 
 # Render sidebar
 render_sidebar(db_manager)
+render_autosave(db_manager)
+
+with st.expander("Search visits", expanded=False):
+    render_search(db_manager)
 
 # Main content area
 if st.session_state.selected_patient:
@@ -71,12 +112,14 @@ if st.session_state.selected_patient:
     # Recording session
     st.header("Recording Session")
 
-    transcript = deepgram_stt(deepgram_api_key=os.getenv(
-        'DEEPGRAM_API_KEY'))
+    audio = record_audio()
+
+    if audio:
+        process_new_recording(audio)
+        audio = None
 
-    if transcript:
-        process_new_recording(transcript)
-        transcript = None
+    render_job_status(job_queue, db_manager)
+    render_batch_status(db_manager)
 
     # Render visit records
     render_visit_records(db_manager)
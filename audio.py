@@ -0,0 +1,371 @@
+import io
+import struct
+import wave
+from dataclasses import dataclass
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+FRAME_MS = 30
+# RMS (int16 scale) below which a frame counts as silence, roughly -40 dBFS.
+SILENCE_RMS = 330
+
+# Voice activity detection: frames this many times above the noise floor
+# count as speech, and internal silences longer than VAD_MAX_GAP_SECONDS
+# are shortened to VAD_KEEP_GAP_SECONDS.
+VAD_NOISE_RATIO = 3.0
+VAD_PAD_SECONDS = 0.3
+VAD_MAX_GAP_SECONDS = 1.5
+VAD_KEEP_GAP_SECONDS = 0.5
+
+# Speech models are trained on 16 kHz mono; anything above is wasted upload.
+TARGET_SAMPLE_RATE = 16000
+RESAMPLE_TAPS = 101
+RESAMPLE_BLOCK = 1 << 16
+
+
+@dataclass
+class AudioChunk:
+    data: bytes
+    offset: float      # where the chunk audio starts in the recording
+    own_start: float   # words whose midpoint falls in [own_start, own_end)
+    own_end: float     # belong to this chunk; the rest is overlap
+
+
+@dataclass
+class WavLayout:
+    channels: int
+    sample_rate: int
+    sample_width: int  # bytes per sample
+    data_offset: int   # byte offset of the PCM data in the file
+    data_size: int
+
+    @property
+    def block_align(self):
+        return self.channels * self.sample_width
+
+    @property
+    def duration(self):
+        return self.data_size / (self.block_align * self.sample_rate)
+
+
+@dataclass
+class PreparedAudio:
+    samples: np.ndarray  # mono int16 at sample_rate
+    sample_rate: int
+    original_bytes: int
+
+    @property
+    def duration(self):
+        return len(self.samples) / self.sample_rate
+
+
+def read_wav(wav_bytes):
+    """Return (int16 samples shaped (frames, channels), sample_rate)"""
+    with wave.open(io.BytesIO(wav_bytes), 'rb') as wf:
+        width = wf.getsampwidth()
+        channels = wf.getnchannels()
+        sample_rate = wf.getframerate()
+        frames = wf.readframes(wf.getnframes())
+
+    if width == 1:
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.int16)
+                   - 128) << 8
+    elif width == 2:
+        samples = np.frombuffer(frames, dtype=np.int16)
+    elif width == 4:
+        samples = (np.frombuffer(frames, dtype=np.int32) >> 16).astype(np.int16)
+    else:
+        raise ValueError(f"Unsupported WAV sample width: {width} bytes")
+    return samples.reshape(-1, channels), sample_rate
+
+
+def wav_layout(header, file_size):
+    """
+    Locate the PCM data in a WAV file from its first few KB, so a byte or
+    time range can be read without fetching the whole file.
+    """
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        raise ValueError("Not a WAV file")
+
+    fmt = None
+    position = 12
+    while position + 8 <= len(header):
+        chunk_id = header[position:position + 4]
+        size = int.from_bytes(header[position + 4:position + 8], "little")
+        if chunk_id == b"fmt ":
+            _, channels, sample_rate, _, _, bits = struct.unpack(
+                "<HHIIHH", header[position + 8:position + 24])
+            fmt = (channels, sample_rate, bits // 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                break
+            data_offset = position + 8
+            # Streaming encoders often leave the size as 0 or 0xFFFFFFFF.
+            available = file_size - data_offset
+            data_size = size if 0 < size <= available else available
+            return WavLayout(*fmt, data_offset=data_offset,
+                             data_size=data_size)
+        position += 8 + size + (size & 1)
+    raise ValueError("WAV header has no fmt/data chunk in the first bytes")
+
+
+def pcm_to_wav(pcm, layout):
+    """Wrap raw PCM frames in a WAV header matching `layout`"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(layout.channels)
+        wf.setsampwidth(layout.sample_width)
+        wf.setframerate(layout.sample_rate)
+        wf.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def write_wav(samples, sample_rate):
+    samples = np.asarray(samples, dtype=np.int16)
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+def encode(samples, sample_rate):
+    """
+    Losslessly compress mono int16 samples for upload. Returns
+    (bytes, content_type); FLAC when soundfile is installed, WAV otherwise.
+    """
+    if soundfile is None:
+        return write_wav(samples, sample_rate), "audio/wav"
+    buffer = io.BytesIO()
+    soundfile.write(buffer, samples, sample_rate, format="FLAC",
+                    subtype="PCM_16")
+    return buffer.getvalue(), "audio/flac"
+
+
+def lowpass_kernel(cutoff, taps=RESAMPLE_TAPS):
+    """Blackman-windowed sinc; `cutoff` is a fraction of the sample rate"""
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.blackman(taps)
+    return kernel / kernel.sum()
+
+
+def fft_filter(signal, kernel, block=RESAMPLE_BLOCK):
+    """
+    Linear convolution via block overlap-add. All blocks of a batch are
+    transformed in one 2-D rfft, so memory stays bounded on long audio.
+    Output is aligned with the input (group delay removed).
+    """
+    taps = len(kernel)
+    n_fft = 1 << int(np.ceil(np.log2(block + taps - 1)))
+    kernel_fft = np.fft.rfft(kernel, n_fft)
+
+    n_blocks = -(-len(signal) // block)
+    padded = np.zeros(n_blocks * block, dtype=np.float32)
+    padded[:len(signal)] = signal
+    blocks = padded.reshape(n_blocks, block)
+
+    out = np.zeros(n_blocks * block + n_fft, dtype=np.float32)
+    batch = 64
+    for first in range(0, n_blocks, batch):
+        spectra = np.fft.rfft(blocks[first:first + batch], n_fft, axis=1)
+        filtered = np.fft.irfft(spectra * kernel_fft, n_fft, axis=1)
+        for i, row in enumerate(filtered, first):
+            out[i * block:i * block + n_fft] += row
+
+    delay = (taps - 1) // 2
+    return out[delay:delay + len(signal)]
+
+
+def resample(mono, source_rate, target_rate=TARGET_SAMPLE_RATE):
+    if source_rate == target_rate:
+        return mono.astype(np.float32)
+    signal = mono.astype(np.float32)
+    if target_rate < source_rate:
+        # Anti-alias just below the new Nyquist frequency.
+        signal = fft_filter(signal, lowpass_kernel(0.45 * target_rate / source_rate))
+    n_out = int(len(signal) * target_rate / source_rate)
+    positions = np.arange(n_out) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(len(signal)), signal)
+
+
+def prepare_audio(wav_bytes, target_rate=TARGET_SAMPLE_RATE):
+    """Decode a WAV recording, downmix it to mono and resample to 16 kHz"""
+    samples, sample_rate = read_wav(wav_bytes)
+    mono = samples.mean(axis=1, dtype=np.float32)
+    resampled = resample(mono, sample_rate, target_rate)
+    return PreparedAudio(
+        samples=np.clip(np.rint(resampled), -32768, 32767).astype(np.int16),
+        sample_rate=target_rate,
+        original_bytes=len(wav_bytes)
+    )
+
+
+def frame_rms(mono, frame_len):
+    n_frames = len(mono) // frame_len
+    frames = mono[:n_frames * frame_len].reshape(n_frames, frame_len)
+    frames = frames.astype(np.float32)
+    return np.sqrt(np.einsum("ij,ij->i", frames, frames) / frame_len)
+
+
+@dataclass
+class TimeMap:
+    """
+    Maps times in trimmed audio back to the original recording. Segment i
+    starts at trimmed_starts[i] in the trimmed audio and original_starts[i]
+    in the original; time within a segment is unchanged.
+    """
+    trimmed_starts: np.ndarray
+    original_starts: np.ndarray
+
+    def to_original(self, times):
+        times = np.asarray(times, dtype=np.float64)
+        segment = np.searchsorted(self.trimmed_starts, times, side="right") - 1
+        segment = np.clip(segment, 0, len(self.trimmed_starts) - 1)
+        return self.original_starts[segment] + (times - self.trimmed_starts[segment])
+
+
+def speech_frames(mono, sample_rate, pad_seconds=VAD_PAD_SECONDS):
+    """
+    Frame-energy voice activity detection. A frame is speech when its RMS
+    clears an adaptive threshold above the recording's noise floor; speech
+    regions are then padded so word onsets and tails aren't clipped.
+    """
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    rms = frame_rms(mono, frame_len)
+    if len(rms) == 0:
+        return rms.astype(bool), frame_len
+
+    noise_floor = np.percentile(rms, 10)
+    if np.median(rms) < noise_floor * VAD_NOISE_RATIO:
+        # No quieter floor to measure against, e.g. a dictation without
+        # pauses; fall back to the absolute silence level.
+        noise_floor = SILENCE_RMS / VAD_NOISE_RATIO
+    speech = rms > max(SILENCE_RMS, noise_floor * VAD_NOISE_RATIO)
+
+    pad = int(pad_seconds * 1000 / FRAME_MS)
+    if pad:
+        # Dilate: a frame is kept if any frame within `pad` is speech.
+        counts = np.convolve(speech, np.ones(2 * pad + 1, dtype=np.int32),
+                             mode="same")
+        speech = counts > 0
+    return speech, frame_len
+
+
+def trim_silence(mono, sample_rate, max_gap=VAD_MAX_GAP_SECONDS,
+                 keep_gap=VAD_KEEP_GAP_SECONDS):
+    """
+    Drop leading and trailing silence and shorten internal silences longer
+    than `max_gap` to `keep_gap`. Returns (trimmed samples, TimeMap).
+    """
+    speech, frame_len = speech_frames(mono, sample_rate)
+    if not speech.any():
+        return mono[:0], TimeMap(np.zeros(1), np.zeros(1))
+
+    # Boundaries of runs of equal frames: run i covers [starts[i], ends[i]).
+    changes = np.flatnonzero(np.diff(speech.astype(np.int8))) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [len(speech)]))
+    is_speech = speech[starts]
+
+    keep_ends = ends.copy()
+    silent = ~is_speech
+    max_gap_frames = int(max_gap * 1000 / FRAME_MS)
+    keep_gap_frames = int(keep_gap * 1000 / FRAME_MS)
+    long_gaps = silent & (ends - starts > max_gap_frames)
+    keep_ends[long_gaps] = starts[long_gaps] + keep_gap_frames
+    # Leading and trailing silence goes entirely.
+    if silent[0]:
+        keep_ends[0] = starts[0]
+    if silent[-1]:
+        keep_ends[-1] = starts[-1]
+
+    lengths = keep_ends - starts
+    kept = lengths > 0
+    seg_starts, seg_lengths = starts[kept] * frame_len, lengths[kept] * frame_len
+    # The final frame may extend past the last whole frame; keep the tail.
+    if ends[-1] == keep_ends[-1] and is_speech[-1]:
+        seg_lengths[-1] = len(mono) - seg_starts[-1]
+
+    trimmed = np.concatenate([
+        mono[start:start + length]
+        for start, length in zip(seg_starts, seg_lengths)
+    ])
+    trimmed_starts = np.concatenate(([0], np.cumsum(seg_lengths)[:-1]))
+    return trimmed, TimeMap(
+        trimmed_starts=trimmed_starts / sample_rate,
+        original_starts=seg_starts / sample_rate
+    )
+
+
+def find_split_points(mono, sample_rate, chunk_seconds, search_seconds):
+    """
+    Pick a cut near every `chunk_seconds`, preferring the quietest frame
+    within `search_seconds` of the target. Returns (sample_index, is_silent)
+    pairs; cuts that didn't land in silence need overlap on both sides.
+    """
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    rms = frame_rms(mono, frame_len)
+    chunk_frames = int(chunk_seconds * 1000 / FRAME_MS)
+    search_frames = int(search_seconds * 1000 / FRAME_MS)
+
+    splits = []
+    target = chunk_frames
+    while target < len(rms) - search_frames:
+        lo, hi = target - search_frames, target + search_frames
+        quietest = lo + int(np.argmin(rms[lo:hi]))
+        if rms[quietest] <= SILENCE_RMS:
+            splits.append((quietest * frame_len + frame_len // 2, True))
+            target = quietest + chunk_frames
+        else:
+            splits.append((target * frame_len, False))
+            target += chunk_frames
+    return splits
+
+
+def split_samples(mono, sample_rate, chunk_seconds=60, search_seconds=5,
+                  overlap_seconds=1.0):
+    """
+    Split mono int16 audio into encoded AudioChunks, cut at silence where
+    possible. Returns (chunks, content_type).
+    """
+    splits = find_split_points(mono, sample_rate, chunk_seconds, search_seconds)
+
+    overlap = int(overlap_seconds * sample_rate)
+    cuts = [(0, True)] + splits + [(len(mono), True)]
+    chunks = []
+    content_type = None
+    for (start, start_silent), (end, end_silent) in zip(cuts, cuts[1:]):
+        lo = start if start_silent else max(0, start - overlap)
+        hi = end if end_silent else min(len(mono), end + overlap)
+        data, content_type = encode(mono[lo:hi], sample_rate)
+        chunks.append(AudioChunk(
+            data=data,
+            offset=lo / sample_rate,
+            own_start=start / sample_rate,
+            own_end=end / sample_rate
+        ))
+    return chunks, content_type
+
+
+def stitch_words(chunk_words):
+    """
+    Merge per-chunk word lists, given as (AudioChunk, words) pairs in order.
+    Word times are shifted onto the recording timeline and words from the
+    overlap are dropped, so each spoken word appears exactly once.
+    """
+    merged = []
+    for chunk, words in chunk_words:
+        for word in words:
+            start = word["start"] + chunk.offset
+            end = word["end"] + chunk.offset
+            if chunk.own_start <= (start + end) / 2 < chunk.own_end:
+                merged.append({**word, "start": start, "end": end})
+    return merged
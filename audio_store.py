@@ -0,0 +1,62 @@
+from bson.objectid import ObjectId
+from gridfs import GridFSBucket
+
+from audio import pcm_to_wav, wav_layout
+
+CHUNK_SIZE_BYTES = 255 * 1024
+HEADER_BYTES = 4096
+
+
+class AudioStore:
+    """
+    Archive of raw visit audio in the `recording_audio` GridFS bucket.
+
+    Uploads are streamed chunk by chunk and reads seek straight to the
+    chunks they need, so neither side holds an hour of audio in memory.
+    """
+
+    def __init__(self, db):
+        self.bucket = GridFSBucket(
+            db, bucket_name="recording_audio",
+            chunk_size_bytes=CHUNK_SIZE_BYTES)
+
+    def save(self, source, filename="recording.wav", metadata=None):
+        """Store `source` (bytes or a readable file object); returns its id"""
+        return self.bucket.upload_from_stream(
+            filename, source, metadata=metadata or {})
+
+    def save_chunks(self, chunks, filename="recording.wav", metadata=None):
+        """Store audio produced incrementally, e.g. by a live recorder"""
+        with self.bucket.open_upload_stream(
+                filename, metadata=metadata or {}) as stream:
+            for chunk in chunks:
+                stream.write(chunk)
+            return stream._id
+
+    def read(self, file_id):
+        return self.bucket.open_download_stream(ObjectId(file_id)).read()
+
+    def read_range(self, file_id, start, end=None):
+        """Bytes [start, end) of the stored file"""
+        with self.bucket.open_download_stream(ObjectId(file_id)) as stream:
+            stream.seek(start)
+            size = -1 if end is None else max(0, end - start)
+            return stream.read(size)
+
+    def layout(self, file_id):
+        with self.bucket.open_download_stream(ObjectId(file_id)) as stream:
+            return wav_layout(stream.read(HEADER_BYTES), stream.length)
+
+    def read_time_range(self, file_id, start_seconds, end_seconds):
+        """A standalone WAV covering [start_seconds, end_seconds)"""
+        layout = self.layout(file_id)
+        start = int(start_seconds * layout.sample_rate) * layout.block_align
+        end = int(end_seconds * layout.sample_rate) * layout.block_align
+        start = min(max(start, 0), layout.data_size)
+        end = min(max(end, start), layout.data_size)
+        pcm = self.read_range(
+            file_id, layout.data_offset + start, layout.data_offset + end)
+        return pcm_to_wav(pcm, layout)
+
+    def delete(self, file_id):
+        self.bucket.delete(ObjectId(file_id))
@@ -0,0 +1,86 @@
+"""Debounced autosave of edited fields with optimistic concurrency.
+
+Edits are collected per document and written once it has been left alone
+for AUTOSAVE_DEBOUNCE_SECONDS, as one field-level patch that carries the
+version the on-screen text was loaded at. If another tab or process wrote
+the document in the meantime the patch is rejected and kept as a conflict
+for the user to resolve, instead of silently overwriting their change.
+"""
+import os
+import time
+
+AUTOSAVE_DEBOUNCE_SECONDS = float(os.getenv('AUTOSAVE_DEBOUNCE_SECONDS', 2.0))
+
+
+class Autosave:
+    """
+    Unsaved edits of one session, keyed by document, e.g.
+    ("recording", id) or ("notes", patient_id).
+    """
+
+    def __init__(self, debounce=AUTOSAVE_DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self.versions = {}    # version the on-screen text was loaded at
+        self.pending = {}     # {field: value} not written yet
+        self.changed_at = {}
+        self.conflicts = {}   # {field: value} rejected as out of date
+
+    def track(self, key, version):
+        """
+        Record the stored version of a document being shown. Returns True
+        if the text on screen is older and should be reloaded, which is
+        never the case while this session has unsaved edits to it.
+        """
+        if key in self.pending or key in self.conflicts:
+            return False
+        stale = self.versions.get(key, version) != version
+        self.versions[key] = version
+        return stale
+
+    def edit(self, key, field, value):
+        self.pending.setdefault(key, {})[field] = value
+        self.changed_at[key] = time.monotonic()
+
+    def flush(self, save, force=False):
+        """
+        Write the edits of every document idle for the debounce period (all
+        of them with `force`) through `save(key, fields, version)`, which
+        returns the new version or None if the document moved on. Returns
+        the keys saved and the keys that conflicted.
+        """
+        now = time.monotonic()
+        saved, conflicted = [], []
+        for key in list(self.pending):
+            if not force and now - self.changed_at[key] < self.debounce:
+                continue
+            fields = self.pending.pop(key)
+            del self.changed_at[key]
+            try:
+                version = save(key, fields, self.versions.get(key))
+            except Exception:
+                # Keep the edits for the next flush.
+                self.edit_all(key, fields)
+                raise
+            if version is None:
+                self.conflicts[key] = fields
+                conflicted.append(key)
+            else:
+                self.versions[key] = version
+                saved.append(key)
+        return saved, conflicted
+
+    def edit_all(self, key, fields):
+        for field, value in fields.items():
+            self.pending.setdefault(key, {}).setdefault(field, value)
+        self.changed_at[key] = time.monotonic()
+
+    def resolve(self, key, save=None):
+        """
+        Settle a conflict: discard this session's edits so the latest text
+        is reloaded, or, given `save`, write them over the other change.
+        """
+        fields = self.conflicts.pop(key)
+        if save is None:
+            self.versions.pop(key, None)
+        else:
+            self.versions[key] = save(key, fields, None)
@@ -0,0 +1,65 @@
+"""Benchmark silence trimming on an hour of synthetic 16 kHz exam-room audio.
+
+    python benchmarks/bench_vad.py [--hours 1] [--budget 1.0]
+
+Exits non-zero if the best run is slower than the budget (seconds).
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audio import trim_silence  # noqa: E402
+
+SAMPLE_RATE = 16000
+
+
+def synthetic_visit(hours, seed=0):
+    """Alternating speech-like bursts and silences over a low noise floor"""
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600 * SAMPLE_RATE)
+    audio = rng.normal(0, 20, n)
+
+    position = 0
+    while position < n:
+        speech = int(rng.uniform(1, 15) * SAMPLE_RATE)
+        silence = int(rng.exponential(4) * SAMPLE_RATE)
+        end = min(n, position + speech)
+        audio[position:end] += rng.normal(0, 2500, end - position)
+        position = end + silence
+    return np.clip(audio, -32768, 32767).astype(np.int16)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--budget", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    audio = synthetic_visit(args.hours)
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        trimmed, time_map = trim_silence(audio, SAMPLE_RATE)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    print(f"audio:    {len(audio) / SAMPLE_RATE / 3600:.2f} h "
+          f"({len(audio):,} samples)")
+    print(f"trimmed:  {len(trimmed) / SAMPLE_RATE / 3600:.2f} h "
+          f"in {len(time_map.original_starts):,} segments")
+    print(f"best:     {best * 1000:.0f} ms, "
+          f"median: {sorted(timings)[len(timings) // 2] * 1000:.0f} ms")
+    print(f"speed:    {len(audio) / SAMPLE_RATE / best:,.0f}x real time")
+
+    if best > args.budget:
+        print(f"FAIL: slower than the {args.budget:.2f}s budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
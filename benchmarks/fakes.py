@@ -0,0 +1,148 @@
+"""Local stand-ins for the Deepgram and OpenAI HTTP APIs with tunable latency."""
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+WORDS_PER_SECOND = 2.5
+VOCABULARY = (
+    "patient reports intermittent chest pain radiating to the left arm "
+    "since last week denies shortness of breath takes metformin daily "
+    "blood pressure is one thirty over eighty plan to order an ECG"
+).split()
+
+
+def fake_text(n_words, offset=0):
+    return " ".join(
+        VOCABULARY[(offset + i) % len(VOCABULARY)] for i in range(n_words))
+
+
+class FakeServer:
+    """Runs a handler on 127.0.0.1 in a background thread"""
+
+    def __init__(self, handler_class):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def audio_seconds(body):
+    if soundfile is not None:
+        try:
+            return soundfile.info(io.BytesIO(body)).duration
+        except RuntimeError:
+            pass
+    return len(body) / 32000  # 16 kHz int16 mono
+
+
+def deepgram_server(latency=0.05, seconds_per_mb=0.02):
+    """POST /v1/listen returning Deepgram's prerecorded response shape"""
+
+    class Handler(_JSONHandler):
+        def do_POST(self):
+            body = self.read_body()
+            time.sleep(latency + seconds_per_mb * len(body) / 1e6)
+
+            duration = audio_seconds(body)
+            n_words = int(duration * WORDS_PER_SECOND)
+            step = duration / max(n_words, 1)
+            words = [
+                {"word": word, "punctuated_word": word,
+                 "start": i * step, "end": i * step + step * 0.8}
+                for i, word in enumerate(fake_text(n_words).split())
+            ]
+            self.send_json({"results": {"channels": [{"alternatives": [{
+                "transcript": " ".join(w["word"] for w in words),
+                "words": words
+            }]}]}})
+
+    return FakeServer(Handler)
+
+
+def openai_server(latency=0.1, seconds_per_1k_tokens=0.01,
+                  tokens_per_second=400, output_words=150):
+    """
+    POST /v1/chat/completions, streaming or not. Time to first token grows
+    with prompt size; streamed tokens arrive at `tokens_per_second`.
+    """
+
+    class Handler(_JSONHandler):
+        def do_POST(self):
+            request = json.loads(self.read_body())
+            prompt_chars = sum(len(m["content"]) for m in request["messages"])
+            time.sleep(latency + seconds_per_1k_tokens * prompt_chars / 4000)
+
+            words = fake_text(output_words).split()
+            common = {"id": "chatcmpl-bench", "created": int(time.time()),
+                      "model": request["model"]}
+            if not request.get("stream"):
+                time.sleep(len(words) / tokens_per_second)
+                self.send_json({**common, "object": "chat.completion",
+                                "choices": [{
+                                    "index": 0,
+                                    "finish_reason": "stop",
+                                    "message": {"role": "assistant",
+                                                "content": " ".join(words)}
+                                }]})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, word in enumerate(words):
+                time.sleep(1 / tokens_per_second)
+                self.send_event({**common, "object": "chat.completion.chunk",
+                                 "choices": [{
+                                     "index": 0,
+                                     "finish_reason": None,
+                                     "delta": {"content": (" " if i else "") + word}
+                                 }]})
+            self.send_event("[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def send_event(self, payload):
+            data = payload if isinstance(payload, str) else json.dumps(payload)
+            event = f"data: {data}\n\n".encode()
+            self.wfile.write(f"{len(event):X}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+
+    return FakeServer(Handler)
@@ -0,0 +1,331 @@
+"""Offline benchmarks for the record -> transcribe -> summarize -> save pipeline.
+
+Runs against fake Deepgram/OpenAI servers and mongomock (or a real MongoDB
+with --mongo-uri), then compares medians with benchmarks/baseline.json:
+
+    python benchmarks/run.py                  # compare with the baseline
+    python benchmarks/run.py --save-baseline  # record a new baseline
+    python benchmarks/run.py --quick          # smaller grid, fewer repeats
+
+The whole suite runs --rounds times, each time on a fresh database, and
+each case's median over the rounds is compared. Spreading a case's rounds
+over the run keeps a slow minute on a shared host from deciding it. Exits
+non-zero when a case is slower than the baseline's slowest round by more
+than --tolerance and by more than --min-delta-ms (--sub-ms-min-delta-ms
+for cases under a millisecond). Compare numbers only between runs on the
+same machine.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import openai  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+import jobs  # noqa: E402
+import stt  # noqa: E402
+import stt_backends  # noqa: E402
+import transcript_store  # noqa: E402
+import utils  # noqa: E402
+import worker  # noqa: E402
+from audio import write_wav  # noqa: E402
+from benchmarks.fakes import deepgram_server, fake_text, openai_server  # noqa: E402
+from data import DatabaseManager  # noqa: E402
+
+BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baseline.json")
+PROVIDER_ID = "bench-provider"
+SYSTEM_PROMPT = "Summarize the visit."
+
+# Set from the command line in main().
+WARMUP = 2
+
+
+def measure(fn, repeat, setup=None):
+    """Wall times of `repeat` runs of fn() in milliseconds, after WARMUP"""
+    timings = []
+    for i in range(WARMUP + repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        if i >= WARMUP:
+            timings.append(elapsed)
+    return timings
+
+
+def summarize(rounds):
+    """
+    Median and p95 of each case over the rounds: `median_ms` is the median
+    of the round medians, so one unusually slow or fast round moves
+    neither the baseline nor the comparison.
+    """
+    results = {}
+    for name in rounds[0]:
+        medians = [statistics.median(r[name]) for r in rounds]
+        timings = sorted(t for r in rounds for t in r[name])
+        results[name] = {
+            "median_ms": statistics.median(medians),
+            "round_medians_ms": medians,
+            "p95_ms": timings[min(len(timings) - 1,
+                                  int(len(timings) * 0.95))],
+            "runs": len(timings)
+        }
+    return results
+
+
+def synthetic_recording(seconds, sample_rate=44100, seed=0):
+    """Speech-like noise bursts separated by pauses, as recorder WAV bytes"""
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    samples = rng.normal(0, 20, n)
+    position = 0
+    while position < n:
+        end = min(n, position + int(rng.uniform(2, 10) * sample_rate))
+        samples[position:end] += rng.normal(0, 2500, end - position)
+        position = end + int(rng.uniform(0.3, 3) * sample_rate)
+    return write_wav(np.clip(samples, -32768, 32767).astype(np.int16),
+                     sample_rate)
+
+
+def mongo_client(uri):
+    if uri:
+        return MongoClient(uri)
+    import mongomock
+    import mongomock.gridfs
+    mongomock.gridfs.enable_gridfs_integration()
+    return mongomock.MongoClient()
+
+
+def seed_patient(db_manager, recordings, transcript_words):
+    patient_id = db_manager.save_patient_data(
+        "Bench", f"Patient{recordings}", PROVIDER_ID)
+    transcript = fake_text(transcript_words)
+    recording_id = None
+    for _ in range(recordings):
+        recording_id = db_manager.save_recording_data(
+            transcript, "summary", PROVIDER_ID, patient_id)
+    return patient_id, recording_id
+
+
+def bench_database(db_manager, grid, repeat):
+    results = {}
+    clear_cache = db_manager.query_cache.entries.clear
+
+    for count in grid["recordings_per_patient"]:
+        patient_id, recording_id = seed_patient(db_manager, count, 500)
+        results[f"db.list_recordings[recordings={count}]"] = measure(
+            lambda: db_manager.list_recordings(patient_id, PROVIDER_ID),
+            repeat, setup=clear_cache)
+        results[f"db.list_recordings_cached[recordings={count}]"] = measure(
+            lambda: db_manager.list_recordings(patient_id, PROVIDER_ID),
+            repeat)
+        # Every seeded visit has the same text, so each term matches all
+        # of the provider's visits seeded so far: the worst case.
+        results[f"db.search_recordings[recordings={count}]"] = measure(
+            lambda: db_manager.search_recordings(
+                PROVIDER_ID, "metformin chest pain"), repeat)
+
+    for words in grid["transcript_words"]:
+        patient_id, recording_id = seed_patient(db_manager, 1, words)
+        results[f"db.load_recording_data[words={words}]"] = measure(
+            lambda: db_manager.load_recording_data(recording_id), repeat)
+        results[f"db.save_recording_data[words={words}]"] = measure(
+            lambda: db_manager.save_recording_data(
+                fake_text(words), "summary", PROVIDER_ID, patient_id),
+            repeat)
+        text = fake_text(words)
+        compressed = transcript_store.compress(text)
+        results[f"transcript.compress[words={words}]"] = measure(
+            lambda: transcript_store.compress(text), repeat)
+        results[f"transcript.decompress[words={words}]"] = measure(
+            lambda: transcript_store.decompress(
+                compressed, transcript_store.TRANSCRIPT_CODEC), repeat)
+
+    results["db.get_all_patients"] = measure(
+        lambda: db_manager.get_all_patients(PROVIDER_ID),
+        repeat, setup=clear_cache)
+    results["db.get_patient_notes"] = measure(
+        lambda: db_manager.get_patient_notes(patient_id),
+        repeat, setup=clear_cache)
+    results["db.update_patient_notes"] = measure(
+        lambda: db_manager.update_patient_notes(patient_id, "notes"), repeat)
+    results["db.load_system_prompts"] = measure(
+        lambda: db_manager.load_system_prompts(PROVIDER_ID),
+        repeat, setup=clear_cache)
+    prompts = {f"Template {i}": f"Prompt {i}" for i in range(10)}
+    results["db.save_system_prompts"] = measure(
+        lambda: db_manager.save_system_prompts(prompts, PROVIDER_ID), repeat)
+    return results
+
+
+def bench_transcription(stt_service, grid, repeat):
+    results = {}
+    for seconds in grid["audio_seconds"]:
+        recording = synthetic_recording(seconds)
+        results[f"stt.transcribe_audio[seconds={seconds}]"] = measure(
+            lambda: stt_service.transcribe(recording), repeat)
+    return results
+
+
+def bench_summary(grid, repeat):
+    results = {}
+    for words in grid["transcript_words"]:
+        transcript = fake_text(words)
+        results[f"utils.get_summary[words={words}]"] = measure(
+            lambda: utils.get_summary(transcript, SYSTEM_PROMPT), repeat)
+    return results
+
+
+def bench_pipeline(db_manager, stt_service, grid, repeat):
+    """Enqueue a recording and run it through worker.process_job"""
+    results = {}
+    job_queue = jobs.JobQueue(db_manager.db)
+    patient_id, _ = seed_patient(db_manager, 0, 0)
+
+    for seconds in grid["audio_seconds"]:
+        recording = synthetic_recording(seconds)
+
+        def run_once():
+            job_id, _ = job_queue.enqueue(
+                recording, PROVIDER_ID, patient_id, SYSTEM_PROMPT,
+                audio_hash=f"{time.perf_counter_ns()}")
+            job = job_queue.claim("bench")
+            recording_id = worker.process_job(
+                db_manager, job_queue, job, stt_service)
+            job_queue.complete(job, recording_id)
+
+        results[f"pipeline.process_recording[seconds={seconds}]"] = measure(
+            run_once, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta_ms,
+            sub_ms_min_delta_ms):
+    """
+    Cases slower than the baseline's slowest round by more than `tolerance`
+    and by more than `min_delta_ms`, or `sub_ms_min_delta_ms` for cases
+    whose baseline is under a millisecond. Measuring from the slowest round
+    widens the gate only for cases whose baseline was itself noisy, and the
+    floors keep timer, GC and scheduler noise, which can be several times a
+    sub-millisecond case, from counting as regressions.
+    """
+    regressions = []
+    print(f"{'case':<55} {'median':>10} {'baseline':>10} {'delta':>8}")
+    for name, result in results.items():
+        median = result["median_ms"]
+        previous = baseline.get(name, {}).get("median_ms")
+        if previous:
+            delta = (median - previous) / previous
+            slowest = max(baseline[name].get("round_medians_ms", [previous]))
+            floor = sub_ms_min_delta_ms if previous < 1 else min_delta_ms
+            regressed = (median > slowest * (1 + tolerance)
+                         and median - slowest > floor)
+            flag = "  REGRESSION" if regressed else ""
+            if regressed:
+                regressions.append(name)
+            print(f"{name:<55} {median:>8.2f}ms {previous:>8.2f}ms "
+                  f"{delta:>+7.0%}{flag}")
+        else:
+            print(f"{name:<55} {median:>8.2f}ms {'-':>10} {'new':>8}")
+    return regressions
+
+
+def main():
+    global WARMUP
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--min-delta-ms", type=float, default=0.5,
+                        help="Ignore slowdowns smaller than this")
+    parser.add_argument("--sub-ms-min-delta-ms", type=float, default=2.0,
+                        help="The same, for cases under a millisecond")
+    parser.add_argument("--warmup", type=int, default=WARMUP)
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="Times to run the whole suite")
+    parser.add_argument("--mongo-uri", default=None,
+                        help="Use a real MongoDB instead of mongomock")
+    parser.add_argument("--deepgram-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    WARMUP = args.warmup
+    if args.quick:
+        grid = {"recordings_per_patient": [10, 100],
+                "transcript_words": [500, 5000],
+                "audio_seconds": [10, 60]}
+        repeat = 3
+    else:
+        grid = {"recordings_per_patient": [10, 100, 1000],
+                "transcript_words": [500, 5000, 20000],
+                "audio_seconds": [10, 60, 300]}
+        repeat = 5
+
+    client = mongo_client(args.mongo_uri)
+    with deepgram_server(latency=args.deepgram_latency) as deepgram, \
+            openai_server(latency=args.openai_latency) as fake_openai:
+        stt_backends.DEEPGRAM_URL = f"{deepgram.url}/v1/listen"
+        stt_backends.STT_BACKENDS = ["deepgram"]
+        openai.base_url = f"{fake_openai.url}/v1/"
+        openai.api_key = "bench"
+        stt_service = stt.STTService("bench")
+
+        rounds = []
+        for _ in range(args.rounds):
+            client.drop_database("scriber")
+            db_manager = DatabaseManager(client=client)
+            if not args.mongo_uri:
+                # mongomock checks unique indexes with a full scan per
+                # insert, which makes seeding search postings quadratic.
+                db_manager.db.search_postings.drop_index("recording_term")
+            timings = {}
+            timings.update(bench_database(db_manager, grid, repeat))
+            timings.update(bench_transcription(stt_service, grid, repeat))
+            timings.update(bench_summary(grid, repeat))
+            timings.update(
+                bench_pipeline(db_manager, stt_service, grid, repeat))
+            rounds.append(timings)
+        stt_service.close()
+    results = summarize(rounds)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            recorded = json.load(f)
+        baseline = recorded["results"]
+        if recorded.get("machine") != platform.platform():
+            print(f"Note: the baseline was recorded on {recorded.get('machine')}"
+                  f"; re-record it on this machine for a trustworthy gate.\n")
+    regressions = compare(results, baseline, args.tolerance,
+                          args.min_delta_ms, args.sub_ms_min_delta_ms)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "recorded_at": datetime.now().isoformat(timespec="seconds"),
+                "machine": platform.platform(),
+                "python": platform.python_version(),
+                "mongo": args.mongo_uri and "mongodb" or "mongomock",
+                "results": results
+            }, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+    elif regressions:
+        print(f"\n{len(regressions)} case(s) regressed by more than "
+              f"{args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
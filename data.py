@@ -1,8 +1,21 @@
 from datetime import datetime
-from pymongo import MongoClient
+from pymongo import DeleteMany, MongoClient, ReturnDocument, UpdateOne
 from bson.objectid import ObjectId
 import os
 import streamlit as st
+from metrics import instrument_methods
+from migrations import run_migrations
+from search import SearchIndex, snippet
+from transcript_store import TranscriptStore
+from db_cache import (
+    ChangeStreamInvalidator,
+    QueryCache,
+    cached,
+    invalidates
+)
+
+DEFAULT_PROMPT_NAME = "Default Summary"
+DEFAULT_PROMPT = "You are a medical scribe assistant. Create a concise, professional summary of the medical conversation, highlighting key symptoms, diagnoses, and treatment plans. Format the summary in a clear, medical-note style."
 
 
 @st.cache_resource
@@ -10,128 +23,355 @@ def init_connection():
     try:
         client = MongoClient(os.getenv('MONGO_URI'))
         client.admin.command('ping')
-        return client
     except Exception as e:
         st.error(f"Could not connect to MongoDB: {str(e)}")
         return None
+    try:
+        # Runs once per process since the connection is cached.
+        run_migrations(client['scriber'])
+    except Exception as e:
+        st.error(f"Database migration failed: {str(e)}")
+        return None
+    return client
+
+
+@st.cache_resource
+def get_query_cache(_client):
+    # Shared by every session in the process.
+    query_cache = QueryCache()
+    if os.getenv('DB_CACHE_CHANGE_STREAMS') == '1':
+        ChangeStreamInvalidator(_client['scriber'], query_cache).start()
+    return query_cache
 
 
+@instrument_methods("db")
 class DatabaseManager:
-    def __init__(self):
-        self.client = init_connection()
+    def __init__(self, client=None):
+        # Scripts and benchmarks may pass their own client; it is migrated
+        # here because it didn't come through init_connection.
+        if client is not None:
+            run_migrations(client['scriber'])
+        self.client = client or init_connection()
         if self.client:
             self.db = self.client['scriber']
+            self.query_cache = get_query_cache(self.client)
+            self.transcripts = TranscriptStore(self.db)
+            self.search_index = SearchIndex(self.db, self.transcripts)
         else:
             st.error("Failed to initialize MongoDB connection")
             st.stop()
 
     def load_system_prompts(self, provider_id):
         try:
-            prompts = {}
-            query = {"provider_id": provider_id}
-            prompts_cursor = self.db.system_messages.find(query)
-
-            if self.db.system_messages.count_documents(query) == 0:
-                default_prompt = {
-                    "name": "Default Summary",
-                    "content": "You are a medical scribe assistant. Create a concise, professional summary of the medical conversation, highlighting key symptoms, diagnoses, and treatment plans. Format the summary in a clear, medical-note style.",
-                    "provider_id": provider_id,
-                    "created_at": datetime.now(),
-                    "last_modified": datetime.now()
-                }
-                self.db.system_messages.insert_one(default_prompt)
-                prompts[default_prompt["name"]] = default_prompt["content"]
-            else:
-                for doc in prompts_cursor:
-                    prompts[doc['name']] = doc['content']
-
-            return prompts
+            return self._load_system_prompts(provider_id)
         except Exception as e:
             st.error(f"Error loading system prompts: {str(e)}")
             return {}
 
-    def save_system_prompts(self, prompts, provider_id):
-        try:
-            self.db.system_messages.delete_many({"provider_id": provider_id})
-            for name, content in prompts.items():
-                self.db.system_messages.insert_one({
-                    "name": name,
-                    "content": content,
-                    "provider_id": provider_id,
+    @cached("prompts", "provider_id")
+    def _load_system_prompts(self, provider_id):
+        prompts = {
+            doc['name']: doc['content']
+            for doc in self.db.system_messages.find(
+                {"provider_id": provider_id}, {"name": 1, "content": 1})
+        }
+
+        if not prompts:
+            self.db.system_messages.update_one(
+                {"provider_id": provider_id, "name": DEFAULT_PROMPT_NAME},
+                {"$setOnInsert": {
+                    "content": DEFAULT_PROMPT,
                     "created_at": datetime.now(),
                     "last_modified": datetime.now()
-                })
+                }},
+                upsert=True
+            )
+            prompts[DEFAULT_PROMPT_NAME] = DEFAULT_PROMPT
+
+        return prompts
+
+    @invalidates("prompts", "provider_id")
+    def save_system_prompts(self, prompts, provider_id):
+        try:
+            existing = {
+                doc['name']: doc['content']
+                for doc in self.db.system_messages.find(
+                    {"provider_id": provider_id}, {"name": 1, "content": 1})
+            }
+
+            operations = [
+                UpdateOne(
+                    {"provider_id": provider_id, "name": name},
+                    {
+                        "$set": {
+                            "content": content,
+                            "last_modified": datetime.now()
+                        },
+                        "$setOnInsert": {"created_at": datetime.now()}
+                    },
+                    upsert=True
+                )
+                for name, content in prompts.items()
+                if existing.get(name) != content
+            ]
+            removed = [name for name in existing if name not in prompts]
+            if removed:
+                operations.append(DeleteMany(
+                    {"provider_id": provider_id, "name": {"$in": removed}}))
+
+            if operations:
+                self.db.system_messages.bulk_write(operations, ordered=False)
         except Exception as e:
             st.error(f"Error saving system prompts: {str(e)}")
 
-    def save_recording_data(self, transcript, summary, provider_id, patient_id):
-        result = self.db.recordings.insert_one({
-            "transcript": transcript,
+    @invalidates("recordings", "patient_id")
+    def save_recording_data(self, transcript, summary, provider_id, patient_id,
+                            summary_complete=True, audio_hash=None,
+                            audio_file_id=None):
+        # The transcript is kept compressed in its own collection so that
+        # the recordings collection stays small enough to remain in memory.
+        recording = {
             "summary": summary,
+            "summary_complete": summary_complete,
             "provider_id": provider_id,
             "patient_id": patient_id,
+            "audio_hash": audio_hash,
+            "audio_file_id": audio_file_id,
             "timestamp": datetime.now(),
-            "last_modified": datetime.now()
-        })
+            "last_modified": datetime.now(),
+            "version": 0
+        }
+        result = self.db.recordings.insert_one(recording)
+        self.transcripts.put(result.inserted_id, transcript, version=0)
+        self.search_index.index_recording(
+            {**recording, "transcript": transcript}, new=True)
         return str(result.inserted_id)
 
-    def update_recording_data(self, document_id, transcript, summary):
+    def patch_recording(self, document_id, fields, version=None):
+        """
+        `$set` only the given fields of a recording and bump its version.
+        With `version`, the write applies only if the recording is still at
+        that version. Returns the new version, or None if another writer got
+        there first.
+        """
+        query = {"_id": ObjectId(document_id)}
+        if version is not None:
+            query["version"] = version
+        fields = dict(fields)
+        transcript = fields.pop("transcript", None)
+        recording = self.db.recordings.find_one_and_update(
+            query,
+            {
+                "$set": {**fields, "last_modified": datetime.now()},
+                "$inc": {"version": 1}
+            },
+            projection={"version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if recording is None:
+            return None
+        if transcript is not None:
+            self.transcripts.put(document_id, transcript,
+                                 version=recording["version"])
+        if transcript is not None or "summary" in fields:
+            self.search_index.reindex(document_id)
+        return recording["version"]
+
+    def bulk_update_recording_data(self, updates):
+        """
+        Apply {document_id: {field: value}} to many recordings with a single
+        bulk write, e.g. summaries rewritten by a batch.
+        """
+        if not updates:
+            return
+        now = datetime.now()
+        updates = {document_id: dict(fields)
+                   for document_id, fields in updates.items()}
+        self.transcripts.put_many({
+            document_id: fields.pop("transcript")
+            for document_id, fields in updates.items()
+            if "transcript" in fields
+        })
+        self.db.recordings.bulk_write([
+            UpdateOne({"_id": ObjectId(document_id)},
+                      {"$set": {**fields, "last_modified": now},
+                       "$inc": {"version": 1}})
+            for document_id, fields in updates.items()
+        ], ordered=False)
+        self.search_index.reindex(list(updates))
+
+    def update_recording_draft(self, document_id, transcript, summary,
+                               summary_complete=False):
+        recording = self.db.recordings.find_one_and_update(
+            {"_id": ObjectId(document_id)},
+            {
+                "$set": {
+                    "summary": summary,
+                    "summary_complete": summary_complete,
+                    "last_modified": datetime.now()
+                },
+                "$inc": {"version": 1}
+            },
+            projection={"version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if recording is not None:
+            self.transcripts.put(document_id, transcript,
+                                 version=recording["version"])
+        # Drafts change every few seconds; index the finished note only.
+        if summary_complete:
+            self.search_index.reindex(document_id)
+
+    def update_recording_summary(self, document_id, summary, summary_complete=True):
         self.db.recordings.update_one(
             {"_id": ObjectId(document_id)},
             {
                 "$set": {
-                    "transcript": transcript,
                     "summary": summary,
+                    "summary_complete": summary_complete,
                     "last_modified": datetime.now()
-                }
+                },
+                "$inc": {"version": 1}
             }
         )
+        if summary_complete:
+            self.search_index.reindex(document_id)
 
-    def get_patient_recordings(self, patient_id, provider_id):
-        return list(self.db.recordings.find({
-            "patient_id": patient_id,
-            "provider_id": provider_id
-        }).sort("timestamp", -1))
+    def find_recording_by_hash(self, provider_id, audio_hash):
+        recording = self.db.recordings.find_one(
+            {"provider_id": provider_id, "audio_hash": audio_hash},
+            {"_id": 1}
+        )
+        return str(recording["_id"]) if recording else None
+
+    @cached("recordings", "patient_id")
+    def list_recordings(self, patient_id, provider_id, limit=20, before=None):
+        """
+        Newest-first page of a patient's recordings with only `_id` and
+        `timestamp`. Pass the returned cursor as `before` for the next page;
+        it is None once there are no older recordings.
+        """
+        query = {"patient_id": patient_id, "provider_id": provider_id}
+        if before:
+            timestamp, last_id = before
+            query["$or"] = [
+                {"timestamp": {"$lt": timestamp}},
+                {"timestamp": timestamp, "_id": {"$lt": ObjectId(last_id)}}
+            ]
+
+        recordings = list(self.db.recordings.find(
+            query, {"timestamp": 1}
+        ).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+
+        if len(recordings) <= limit:
+            return recordings, None
+        recordings = recordings[:limit]
+        last = recordings[-1]
+        return recordings, (last["timestamp"], str(last["_id"]))
+
+    def search_recordings(self, provider_id, query, page=0, page_size=10):
+        """
+        Ranked full-text search over a provider's transcripts and summaries.
+        Returns {"results", "total", "page", "page_size"}; each result has
+        the recording and patient ids, timestamp, score, and a snippet from
+        the summary or, failing that, the transcript.
+        """
+        hits, total, terms = self.search_index.search(
+            provider_id, query, page, page_size)
+
+        summaries = {
+            str(r["_id"]): r.get("summary") for r in self.db.recordings.find(
+                {"_id": {"$in": [ObjectId(h["recording_id"]) for h in hits]}},
+                {"summary": 1})
+        } if hits else {}
+        for hit in hits:
+            hit["snippet"] = snippet(summaries.get(hit["recording_id"]), terms)
+            hit["field"] = "summary" if hit["snippet"] else None
 
-    def load_recording_data(self, document_id):
-        return self.db.recordings.find_one({"_id": ObjectId(document_id)})
+        # Transcripts are only decompressed for hits the summary can't show.
+        missing = [hit for hit in hits if not hit["snippet"]]
+        transcripts = self.transcripts.get_many(
+            [hit["recording_id"] for hit in missing]) if missing else {}
+        for hit in missing:
+            hit["snippet"] = snippet(
+                transcripts.get(ObjectId(hit["recording_id"])), terms)
+            hit["field"] = "transcript" if hit["snippet"] else None
+
+        return {"results": hits, "total": total,
+                "page": page, "page_size": page_size}
+
+    def load_recording_data(self, document_id, transcript=True):
+        """
+        A recording with its transcript decompressed into "transcript";
+        callers that only need the summary or status can skip it.
+        """
+        recording = self.db.recordings.find_one({"_id": ObjectId(document_id)})
+        if recording is not None and transcript:
+            recording["transcript"] = self.load_transcript(document_id)
+        return recording
+
+    def load_transcript(self, document_id):
+        return self.transcripts.get(document_id) or ""
 
     def get_all_patients(self, provider_id):
         try:
-            patients = list(self.db.patients.find(
-                {"provider_id": provider_id},
-                {"first_name": 1, "last_name": 1}
-            ).sort("last_name", 1))
-            return [(p["first_name"], p["last_name"], str(p["_id"])) for p in patients]
+            return self._get_all_patients(provider_id)
         except Exception as e:
             st.error(f"Error fetching patients from database: {str(e)}")
             return []
 
+    @cached("patients", "provider_id")
+    def _get_all_patients(self, provider_id):
+        patients = list(self.db.patients.find(
+            {"provider_id": provider_id},
+            {"first_name": 1, "last_name": 1}
+        ).sort("last_name", 1))
+        return [(p["first_name"], p["last_name"], str(p["_id"])) for p in patients]
+
+    @invalidates("patients", "provider_id")
     def save_patient_data(self, first_name, last_name, provider_id, notes=""):
         result = self.db.patients.insert_one({
             "first_name": first_name,
             "last_name": last_name,
             "notes": notes,
+            "notes_version": 0,
             "provider_id": provider_id,
             "created_at": datetime.now(),
             "last_modified": datetime.now()
         })
         return str(result.inserted_id)
 
-    def update_patient_notes(self, patient_id, notes):
-        self.db.patients.update_one(
-            {"_id": ObjectId(patient_id)},
+    @invalidates("patient_notes", "patient_id")
+    def update_patient_notes(self, patient_id, notes, version=None):
+        """
+        Save a patient's notes. With `version`, only if they are still at
+        that version; returns the new version, or None if they changed.
+        """
+        query = {"_id": ObjectId(patient_id)}
+        if version is not None:
+            query["notes_version"] = version
+        patient = self.db.patients.find_one_and_update(
+            query,
             {
                 "$set": {
                     "notes": notes,
                     "last_modified": datetime.now()
-                }
-            }
+                },
+                "$inc": {"notes_version": 1}
+            },
+            projection={"notes_version": 1},
+            return_document=ReturnDocument.AFTER
         )
+        return patient["notes_version"] if patient else None
 
+    @cached("patient_notes", "patient_id")
     def get_patient_notes(self, patient_id):
-        patient = self.db.patients.find_one({"_id": ObjectId(patient_id)})
-        return patient.get("notes", "") if patient else ""
+        """(notes, version) of a patient"""
+        patient = self.db.patients.find_one(
+            {"_id": ObjectId(patient_id)}, {"notes": 1, "notes_version": 1})
+        if not patient:
+            return "", 0
+        return patient.get("notes", ""), patient.get("notes_version", 0)
 
     def verify_user(self, email, password):
         return self.db.users.find_one({"email": email})
@@ -0,0 +1,183 @@
+import copy
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from pymongo.errors import OperationFailure
+
+from cache import LRUCache
+
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', 2048))
+DB_CACHE_TTL_SECONDS = float(os.getenv('DB_CACHE_TTL_SECONDS', 60))
+DB_CACHE_CHANGE_STREAM_RETRY_SECONDS = float(
+    os.getenv('DB_CACHE_CHANGE_STREAM_RETRY_SECONDS', 5))
+
+# Server error codes: the resume token fell off the oplog or is invalid,
+# and change streams need a replica set.
+RESUME_FAILED_CODES = (260, 280, 286)
+NOT_REPLICA_SET_CODE = 40573
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class QueryCache:
+    """
+    Read-through cache for DatabaseManager queries.
+
+    Entries are grouped by namespace (e.g. "patients") and scope (the
+    provider or patient id the query is about). Invalidating bumps a
+    generation counter that is part of every key, so stale entries are
+    never served again and simply age out of the LRU. A load that races
+    with an invalidation is stored under the old generation and dropped.
+    """
+
+    def __init__(self, maxsize=DB_CACHE_SIZE, ttl=DB_CACHE_TTL_SECONDS):
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def key(self, namespace, scope, args):
+        with self._lock:
+            return (
+                namespace, self._generations[namespace],
+                scope, self._generations[(namespace, scope)],
+                args
+            )
+
+    def invalidate(self, namespace, scope=None):
+        """Drop one scope of a namespace, or the whole namespace"""
+        with self._lock:
+            if scope is None:
+                self._generations[namespace] += 1
+            else:
+                self._generations[(namespace, scope)] += 1
+
+    def stats(self):
+        return self.entries.stats()
+
+
+def _bind(signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    return bound.arguments
+
+
+def cached(namespace, scope_arg):
+    """Cache a DatabaseManager method, scoped by the value of `scope_arg`"""
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            arguments = _bind(signature, (self,) + args, kwargs)
+            arguments.pop("self")
+            key = self.query_cache.key(
+                namespace, arguments[scope_arg], tuple(arguments.items()))
+
+            value = self.query_cache.entries.get(key, _MISSING)
+            if value is _MISSING:
+                value = method(self, *args, **kwargs)
+                self.query_cache.entries.set(key, value)
+            # Callers are free to mutate what they get back.
+            return copy.deepcopy(value)
+
+        return wrapper
+    return decorator
+
+
+def invalidates(namespace, scope_arg=None):
+    """Invalidate a cached namespace (scoped by `scope_arg`) after a write"""
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                scope = None
+                if scope_arg:
+                    scope = _bind(signature, (self,) + args, kwargs)[scope_arg]
+                self.query_cache.invalidate(namespace, scope)
+
+        return wrapper
+    return decorator
+
+
+# How a change event on each collection maps onto cache scopes.
+CHANGE_STREAM_SCOPES = {
+    "patients": [("patients", "provider_id"), ("patient_notes", "_id")],
+    "recordings": [("recordings", "patient_id")],
+    "system_messages": [("prompts", "provider_id")],
+}
+
+
+class ChangeStreamInvalidator(threading.Thread):
+    """
+    Watches the cached collections and invalidates matching scopes, so
+    writes made by other app replicas or worker.py show up immediately.
+    Requires a replica set; enable with DB_CACHE_CHANGE_STREAMS=1.
+
+    A broken stream is logged and reopened from the last resume token.
+    When that isn't possible, every cached namespace is invalidated, since
+    changes may have been missed in between.
+    """
+
+    def __init__(self, db, query_cache,
+                 retry_seconds=DB_CACHE_CHANGE_STREAM_RETRY_SECONDS):
+        super().__init__(name="db-cache-invalidator", daemon=True)
+        self.db = db
+        self.query_cache = query_cache
+        self.retry_seconds = retry_seconds
+        self.resume_token = None
+
+    def run(self):
+        while True:
+            try:
+                self.watch()
+            except OperationFailure as e:
+                if e.code == NOT_REPLICA_SET_CODE:
+                    logger.error("Change streams need a replica set; "
+                                 "cache invalidation across processes is off")
+                    return
+                if e.code in RESUME_FAILED_CODES:
+                    self.resume_token = None
+                logger.exception("Change stream failed; reopening")
+            except Exception:
+                logger.exception("Change stream failed; reopening")
+            time.sleep(self.retry_seconds)
+
+    def watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(CHANGE_STREAM_SCOPES)}}}]
+        with self.db.watch(pipeline, full_document="updateLookup",
+                           resume_after=self.resume_token) as stream:
+            if self.resume_token is None:
+                self.invalidate_all()
+            for change in stream:
+                try:
+                    self.handle(change)
+                except Exception:
+                    logger.exception("Could not apply change %s", change["_id"])
+                    self.invalidate_all()
+                self.resume_token = stream.resume_token
+
+    def handle(self, change):
+        document = change.get("fullDocument")
+        for namespace, field in CHANGE_STREAM_SCOPES[change["ns"]["coll"]]:
+            scope = document.get(field) if document else None
+            if scope is None:
+                # Deletes carry no document, so we can't tell the scope.
+                self.query_cache.invalidate(namespace)
+            else:
+                self.query_cache.invalidate(namespace, str(scope))
+
+    def invalidate_all(self):
+        for scopes in CHANGE_STREAM_SCOPES.values():
+            for namespace, _ in scopes:
+                self.query_cache.invalidate(namespace)
@@ -0,0 +1,276 @@
+"""Batch ingest of recorded WAV files: transcribe, summarize and save each one.
+
+    python ingest.py recordings/ --provider-id <id> --patient-id <id>
+    python ingest.py 'dictations/*.wav' --provider-id <id> \
+        --patient-map patients.csv --processes 8 --concurrency 16
+
+`--patient-map` is a CSV of `pattern,patient_id` rows matched against file
+names in order (e.g. `smith_*.wav,64f...`). Decoding, resampling and silence
+trimming run in a process pool; transcription, OpenAI and MongoDB calls
+overlap on an event loop. Every finished file is appended to the manifest, so a rerun
+with the same manifest skips what is already done.
+"""
+import argparse
+import asyncio
+import csv
+import fnmatch
+import glob
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import openai
+from dotenv import load_dotenv
+
+from audio_store import AudioStore
+from data import DEFAULT_PROMPT_NAME, DatabaseManager
+from stt import prepare_upload, transcribe_upload
+from stt_backends import create_router
+from summary_cache import SummaryCache
+from utils import get_summary
+
+DONE = "done"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+logger = logging.getLogger("ingest")
+
+
+def find_files(paths):
+    """WAV files under the given directories, files and glob patterns"""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found.extend(glob.glob(os.path.join(path, "**", "*.wav"),
+                                   recursive=True))
+        else:
+            found.extend(glob.glob(path) or [path])
+    return sorted(dict.fromkeys(os.path.abspath(p) for p in found))
+
+
+def load_patient_map(path):
+    with open(path, newline="") as f:
+        return [(row[0].strip(), row[1].strip())
+                for row in csv.reader(f) if row and not row[0].startswith("#")]
+
+
+def patient_for(path, patient_id, patient_map):
+    name = os.path.basename(path)
+    for pattern, mapped_id in patient_map:
+        if fnmatch.fnmatch(name, pattern):
+            return mapped_id
+    return patient_id
+
+
+class Manifest:
+    """Append-only JSONL log of finished files; the last entry per path wins"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["path"]] = entry
+        self._file = open(path, "a")
+
+    def finished(self, path):
+        entry = self.entries.get(path)
+        return entry is not None and entry["status"] in (DONE, DUPLICATE)
+
+    def record(self, entry):
+        self.entries[entry["path"]] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def prepare_file(path):
+    """CPU stage, run in a worker process: hash and prepare one recording"""
+    with open(path, "rb") as f:
+        audio = f.read()
+    return hashlib.sha256(audio).hexdigest(), prepare_upload(audio)
+
+
+class Ingester:
+    def __init__(self, db_manager, provider_id, system_prompt, router,
+                 process_pool, summary_cache=None):
+        self.db_manager = db_manager
+        self.audio_store = AudioStore(db_manager.db)
+        self.provider_id = provider_id
+        self.system_prompt = system_prompt
+        self.router = router
+        self.process_pool = process_pool
+        self.summary_cache = summary_cache
+        # Hashes taken by files of this run, so copies of the same audio
+        # in flight together aren't all saved.
+        self.seen_hashes = {}
+
+    async def ingest(self, path, patient_id):
+        """Run one file through the pipeline; returns its manifest entry"""
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        entry = {"path": path, "patient_id": patient_id}
+
+        audio_hash, upload = await loop.run_in_executor(
+            self.process_pool, prepare_file, path)
+        entry.update(audio_hash=audio_hash,
+                     audio_seconds=upload.original_seconds,
+                     speech_seconds=upload.duration)
+
+        if audio_hash in self.seen_hashes:
+            return {**entry, "status": DUPLICATE,
+                    "duplicate_of": self.seen_hashes[audio_hash]}
+        self.seen_hashes[audio_hash] = path
+
+        recording_id = await asyncio.to_thread(
+            self.db_manager.find_recording_by_hash,
+            self.provider_id, audio_hash)
+        if recording_id:
+            return {**entry, "status": DUPLICATE, "recording_id": recording_id}
+
+        result = await transcribe_upload(upload, self.router)
+        if not result["transcript"]:
+            raise RuntimeError("Transcription returned no text")
+        summary = await asyncio.to_thread(
+            get_summary, result["transcript"], self.system_prompt,
+            self.summary_cache)
+        recording_id = await asyncio.to_thread(
+            self.save, path, result["transcript"], summary, patient_id,
+            audio_hash)
+
+        return {**entry, "status": DONE, "recording_id": recording_id,
+                "seconds": round(time.monotonic() - started, 2)}
+
+    def save(self, path, transcript, summary, patient_id, audio_hash):
+        with open(path, "rb") as f:
+            audio_file_id = self.audio_store.save(
+                f, filename=os.path.basename(path),
+                metadata={"provider_id": self.provider_id,
+                          "patient_id": patient_id})
+        return self.db_manager.save_recording_data(
+            transcript, summary, self.provider_id, patient_id,
+            audio_hash=audio_hash, audio_file_id=audio_file_id)
+
+
+class Report:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counts = {DONE: 0, DUPLICATE: 0, FAILED: 0, SKIPPED: 0}
+        self.audio_seconds = 0.0
+        self.speech_seconds = 0.0
+
+    def add(self, entry):
+        self.counts[entry["status"]] += 1
+        if entry["status"] == DONE:
+            self.audio_seconds += entry["audio_seconds"]
+            self.speech_seconds += entry["speech_seconds"]
+
+    def summary(self):
+        minutes = max(time.monotonic() - self.started, 1e-9) / 60
+        return (
+            f"{self.counts[DONE]} ingested, {self.counts[DUPLICATE]} "
+            f"duplicates, {self.counts[FAILED]} failed, "
+            f"{self.counts[SKIPPED]} skipped in {minutes:.1f} min | "
+            f"{self.counts[DONE] / minutes:.1f} files/min, "
+            f"{self.audio_seconds / 3600 / minutes:.3f} audio-hours/min "
+            f"({self.audio_seconds / 3600:.2f} h of audio, "
+            f"{self.speech_seconds / 3600:.2f} h after trimming)"
+        )
+
+
+async def run(files, args, system_prompt, db_manager, manifest):
+    report = Report()
+    patient_map = load_patient_map(args.patient_map) if args.patient_map else []
+    # Network stages block in threads (OpenAI, pymongo); size them to match.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=args.concurrency))
+    # Files in flight: enough to keep both pools busy, bounded for memory.
+    in_flight = asyncio.Semaphore(args.concurrency + args.processes)
+
+    router = await create_router(max_connections=args.concurrency)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(args.processes, mp_context=context) as pool:
+        ingester = Ingester(db_manager, args.provider_id, system_prompt,
+                            router, pool, SummaryCache(db_manager.db))
+
+        async def ingest_one(path):
+            patient_id = patient_for(path, args.patient_id, patient_map)
+            if not patient_id:
+                entry = {"path": path, "status": SKIPPED,
+                         "error": "No patient matches this file"}
+            else:
+                async with in_flight:
+                    try:
+                        entry = await ingester.ingest(path, patient_id)
+                    except Exception as e:
+                        logger.warning("%s failed: %s", path, e)
+                        entry = {"path": path, "patient_id": patient_id,
+                                 "status": FAILED, "error": str(e)}
+            entry["finished_at"] = datetime.now().isoformat(timespec="seconds")
+            manifest.record(entry)
+            report.add(entry)
+            finished = sum(report.counts.values())
+            if finished % args.report_every == 0:
+                logger.info("%d/%d files | %s", finished, len(files),
+                            report.summary())
+
+        await asyncio.gather(*(ingest_one(path) for path in files))
+
+    await router.aclose()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+",
+                        help="Directories, files or glob patterns")
+    parser.add_argument("--provider-id", required=True)
+    parser.add_argument("--patient-id",
+                        help="Patient for files not matched by --patient-map")
+    parser.add_argument("--patient-map",
+                        help="CSV of filename pattern,patient_id rows")
+    parser.add_argument("--prompt-name", default=DEFAULT_PROMPT_NAME)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Files transcribed and summarized at once")
+    parser.add_argument("--manifest", default="ingest_manifest.jsonl")
+    parser.add_argument("--report-every", type=int, default=25)
+    args = parser.parse_args()
+    if not args.patient_id and not args.patient_map:
+        parser.error("one of --patient-id or --patient-map is required")
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(name)s: %(message)s")
+    load_dotenv()
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+
+    db_manager = DatabaseManager()
+    system_prompt = db_manager.load_system_prompts(
+        args.provider_id)[args.prompt_name]
+    manifest = Manifest(args.manifest)
+    files = find_files(args.paths)
+    pending = [path for path in files if not manifest.finished(path)]
+    logger.info("%d files found, %d already in %s", len(files),
+                len(files) - len(pending), args.manifest)
+
+    try:
+        report = asyncio.run(run(pending, args, system_prompt, db_manager,
+                                 manifest))
+    finally:
+        manifest.close()
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from audio_store import AudioStore
+
+QUEUED = "queued"
+TRANSCRIBING = "transcribing"
+SUMMARIZING = "summarizing"
+DONE = "done"
+FAILED = "failed"
+
+ACTIVE_STATES = (QUEUED, TRANSCRIBING, SUMMARIZING)
+
+
+class JobQueue:
+    """Mongo-backed queue of recordings waiting to be transcribed and summarized.
+
+    The audio goes straight into the AudioStore archive so long visits don't
+    run into the 16MB document limit; the job only references it, and the
+    finished recording keeps the same file for playback and re-processing.
+
+    Jobs that haven't failed carry `live: True`; a partial unique index on
+    (provider_id, audio_hash) over them keeps one live job per recording.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.jobs = db.jobs
+        self.audio = AudioStore(db)
+
+    def enqueue(self, audio, provider_id, patient_id, system_prompt,
+                audio_hash):
+        """
+        Queue a recording unless the same audio is already queued or done for
+        this provider. Returns (job_id, created).
+        """
+        live_job = {
+            "provider_id": provider_id,
+            "audio_hash": audio_hash,
+            "live": True
+        }
+        existing = self.jobs.find_one(live_job, {"_id": 1})
+        if existing:
+            return str(existing["_id"]), False
+
+        audio_id = self.audio.save(
+            audio, metadata={"provider_id": provider_id,
+                             "patient_id": patient_id})
+        now = datetime.now()
+        try:
+            job = self.jobs.find_one_and_update(
+                live_job,
+                {"$setOnInsert": {
+                    "state": QUEUED,
+                    "audio_id": audio_id,
+                    "patient_id": patient_id,
+                    "system_prompt": system_prompt,
+                    "recording_id": None,
+                    "error": None,
+                    "attempts": 0,
+                    "created_at": now,
+                    "updated_at": now
+                }},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # A concurrent upsert inserted the live job first.
+            job = self.jobs.find_one(live_job, {"audio_id": 1})
+        created = job["audio_id"] == audio_id
+        if not created:
+            # Another session queued the same audio in the meantime.
+            self.audio.delete(audio_id)
+        return str(job["_id"]), created
+
+    def claim(self, worker_id):
+        """Atomically move the oldest queued job to `transcribing`."""
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {"state": QUEUED},
+            {
+                "$set": {
+                    "state": TRANSCRIBING,
+                    "worker_id": worker_id,
+                    "started_at": now,
+                    "updated_at": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def load_audio(self, job):
+        return self.audio.read(job["audio_id"])
+
+    def set_state(self, job_id, state, **fields):
+        fields.update({"state": state, "updated_at": datetime.now()})
+        self.jobs.update_one({"_id": ObjectId(job_id)}, {"$set": fields})
+
+    def complete(self, job, recording_id):
+        self.set_state(job["_id"], DONE, recording_id=recording_id)
+
+    def fail(self, job, error):
+        job = self.jobs.find_one_and_update(
+            {"_id": ObjectId(job["_id"])},
+            {"$set": {"state": FAILED, "error": str(error),
+                      "updated_at": datetime.now()},
+             "$unset": {"live": ""}},
+            projection={"audio_id": 1, "recording_id": 1})
+        if job and job.get("audio_id") and not job.get("recording_id"):
+            # No recording was saved, so nothing else references the audio.
+            try:
+                self.audio.delete(job["audio_id"])
+            except NoFile:
+                pass
+
+    def get_jobs(self, job_ids):
+        return list(self.jobs.find(
+            {"_id": {"$in": [ObjectId(job_id) for job_id in job_ids]}},
+            {"state": 1, "recording_id": 1, "patient_id": 1, "error": 1,
+             "created_at": 1}
+        ).sort("created_at", 1))
+
+    def requeue_stale(self, timeout_seconds, max_attempts=3):
+        """Put jobs whose worker died mid-flight back on the queue."""
+        cutoff = datetime.now() - timedelta(seconds=timeout_seconds)
+        stale = {
+            "state": {"$in": [TRANSCRIBING, SUMMARIZING]},
+            "updated_at": {"$lt": cutoff}
+        }
+        for job in self.jobs.find(
+                {**stale, "attempts": {"$gte": max_attempts}}, {"_id": 1}):
+            self.fail(job, "Worker timed out")
+        result = self.jobs.update_many(
+            stale,
+            {"$set": {"state": QUEUED, "updated_at": datetime.now()}}
+        )
+        return result.modified_count
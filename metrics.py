@@ -0,0 +1,220 @@
+"""Per-stage timing spans, latency histograms and counters.
+
+Enable with METRICS_ENABLED=1. Spans are then aggregated into histograms
+that can be scraped in Prometheus text format (METRICS_PORT) and, with
+METRICS_JSON_LOGS=1, each finished span is also logged as one JSON line.
+When disabled, `timed` returns the function untouched and `span` is a
+shared no-op context manager, so instrumented code pays almost nothing.
+"""
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED') == '1'
+METRICS_JSON_LOGS = os.getenv('METRICS_JSON_LOGS') == '1'
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
+
+# Upper bounds in seconds; covers cache hits through hour-long uploads.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, 120, 300)
+
+logger = logging.getLogger("scriber.metrics")
+if METRICS_JSON_LOGS:
+    # The app and API don't configure logging; span lines must still get
+    # out, as bare JSON, and not twice where a root handler exists.
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_NOOP = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class Registry:
+    """Process-wide store of span histograms and named counters"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, status):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+            if status == "error":
+                self._increment("span_errors_total", 1, (("span", name),))
+
+    def increment(self, name, value=1, **labels):
+        with self._lock:
+            self._increment(name, value, tuple(sorted(labels.items())))
+
+    def _increment(self, name, value, labels):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {
+                name: (list(h.counts), h.total, h.count)
+                for name, h in self.histograms.items()
+            }
+            return histograms, dict(self.counters)
+
+    def render_prometheus(self):
+        histograms, counters = self.snapshot()
+        lines = ["# TYPE scriber_span_seconds histogram"]
+        for name, (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(
+                    f'scriber_span_seconds_bucket{{span="{name}",'
+                    f'le="{bound}"}} {cumulative}')
+            lines.append(f'scriber_span_seconds_sum{{span="{name}"}} {total}')
+            lines.append(f'scriber_span_seconds_count{{span="{name}"}} {count}')
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE scriber_{name} counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter != name:
+                    continue
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+                lines.append(f"scriber_{name}{{{label_text}}} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def increment(name, value=1, **labels):
+    if METRICS_ENABLED:
+        registry.increment(name, value, **labels)
+
+
+@contextlib.contextmanager
+def _span(name, nest=True):
+    parent = _current_span.get()
+    # A suspended generator must not leave its name set for the caller.
+    token = _current_span.set(name) if nest else None
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        # BaseExceptions (cancellation, generator close, st.rerun/st.stop)
+        # are control flow rather than failures of the stage.
+        status = "error"
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        if token is not None:
+            _current_span.reset(token)
+        registry.observe(name, elapsed, status)
+        if METRICS_JSON_LOGS:
+            logger.info(json.dumps({
+                "event": "span",
+                "span": name,
+                "parent": parent,
+                "duration_ms": round(elapsed * 1000, 3),
+                "status": status,
+                "ts": time.time()
+            }))
+
+
+def span(name):
+    """Time a block: `with span("deepgram.request"): ...`"""
+    return _span(name) if METRICS_ENABLED else _NOOP
+
+
+def timed(name):
+    """
+    Time every call of a function, coroutine function or generator
+    function under `name`. Generators are timed until exhausted.
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with _span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                with _span(name, nest=False):
+                    return (yield from func(*args, **kwargs))
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_methods(prefix):
+    """Class decorator applying `timed` to every public method"""
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if not attr.startswith("_") and inspect.isfunction(value):
+                setattr(cls, attr, timed(f"{prefix}.{attr}")(value))
+        return cls
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port=METRICS_PORT):
+    """Serve /metrics from a daemon thread; returns None when disabled"""
+    if not METRICS_ENABLED:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http",
+                     daemon=True).start()
+    logger.info("Serving metrics on :%d/metrics", port)
+    return server
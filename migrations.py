@@ -0,0 +1,303 @@
+"""Versioned schema and index migrations for the scriber database.
+
+Migrations run automatically from `data.init_connection`, under a lock so
+that concurrently starting processes apply each one once. The CLI can also
+apply them by hand and print query plans:
+
+    python migrations.py migrate
+    python migrations.py status
+    python migrations.py explain --provider-id <id> --patient-id <id>
+"""
+import argparse
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from pprint import pprint
+
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import ASCENDING, DESCENDING, MongoClient
+from pymongo.errors import DuplicateKeyError
+
+from search import SearchIndex
+from summary_cache import SUMMARY_CACHE_TTL_SECONDS
+from transcript_store import TranscriptStore
+
+# A lock not renewed for this long is taken to belong to a dead process.
+MIGRATION_LOCK_SECONDS = int(os.getenv('MIGRATION_LOCK_SECONDS', 600))
+MIGRATION_LOCK_ID = "lock"
+
+
+def drop_index_if_exists(collection, name):
+    # A fresh database or an interrupted earlier run may not have it.
+    if name in collection.index_information():
+        collection.drop_index(name)
+
+
+def create_initial_indexes(db):
+    db.recordings.create_index(
+        [("patient_id", ASCENDING), ("provider_id", ASCENDING),
+         ("timestamp", DESCENDING)],
+        name="patient_provider_timestamp")
+    db.recordings.create_index(
+        [("provider_id", ASCENDING), ("audio_hash", ASCENDING)],
+        name="provider_audio_hash",
+        partialFilterExpression={"audio_hash": {"$type": "string"}})
+    db.patients.create_index(
+        [("provider_id", ASCENDING), ("last_name", ASCENDING)],
+        name="provider_last_name")
+    db.system_messages.create_index(
+        [("provider_id", ASCENDING)], name="provider")
+    db.providers.create_index(
+        [("email", ASCENDING)], name="email_unique", unique=True)
+    db.jobs.create_index(
+        [("state", ASCENDING), ("created_at", ASCENDING)],
+        name="state_created_at")
+    db.jobs.create_index(
+        [("provider_id", ASCENDING), ("audio_hash", ASCENDING)],
+        name="provider_audio_hash")
+    db.summary_cache.create_index(
+        "created_at", name="created_at_ttl",
+        expireAfterSeconds=SUMMARY_CACHE_TTL_SECONDS)
+
+
+def add_recording_page_index(db):
+    # Keyset pagination sorts on (timestamp, _id), so the index needs both.
+    db.recordings.create_index(
+        [("patient_id", ASCENDING), ("provider_id", ASCENDING),
+         ("timestamp", DESCENDING), ("_id", DESCENDING)],
+        name="patient_provider_timestamp_id")
+    drop_index_if_exists(db.recordings, "patient_provider_timestamp")
+
+
+def add_unique_prompt_name_index(db):
+    # Prompts saved before the index could repeat a name; keep the newest.
+    duplicates = db.system_messages.aggregate([
+        {"$sort": {"last_modified": -1, "_id": -1}},
+        {"$group": {"_id": {"provider_id": "$provider_id", "name": "$name"},
+                    "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ])
+    for duplicate in duplicates:
+        db.system_messages.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+    db.system_messages.create_index(
+        [("provider_id", ASCENDING), ("name", ASCENDING)],
+        name="provider_name_unique", unique=True)
+    drop_index_if_exists(db.system_messages, "provider")
+
+
+def build_search_index(db):
+    db.search_postings.create_index(
+        [("provider_id", ASCENDING), ("term", ASCENDING)],
+        name="provider_term")
+    db.search_postings.create_index(
+        [("recording_id", ASCENDING), ("term", ASCENDING)],
+        name="recording_term", unique=True)
+    # Search ranks against the number of visits a provider has.
+    db.recordings.create_index(
+        [("provider_id", ASCENDING), ("timestamp", DESCENDING)],
+        name="provider_timestamp")
+
+    search_index = SearchIndex(db)
+    for recording in db.recordings.find(
+            {}, {"transcript": 1, "summary": 1, "provider_id": 1,
+                 "patient_id": 1, "timestamp": 1}):
+        search_index.index_recording(recording)
+
+
+def add_summary_batch_index(db):
+    db.summary_batches.create_index(
+        [("state", ASCENDING), ("created_at", ASCENDING)],
+        name="state_created_at")
+
+
+def add_edit_versions(db):
+    # Optimistic concurrency compares against these; documents written
+    # before they existed start at 0.
+    db.recordings.update_many(
+        {"version": {"$exists": False}}, {"$set": {"version": 0}})
+    db.patients.update_many(
+        {"notes_version": {"$exists": False}}, {"$set": {"notes_version": 0}})
+
+
+def move_transcripts(db, batch_size=500):
+    # Batches are unset as they are copied, so an interrupted run resumes
+    # where it stopped. Disk space is returned by a `compact` afterwards.
+    store = TranscriptStore(db)
+    while True:
+        recordings = list(db.recordings.find(
+            {"transcript": {"$exists": True}}, {"transcript": 1}
+        ).limit(batch_size))
+        if not recordings:
+            return
+        store.put_many({r["_id"]: r["transcript"] for r in recordings})
+        db.recordings.update_many(
+            {"_id": {"$in": [r["_id"] for r in recordings]}},
+            {"$unset": {"transcript": ""}})
+
+
+def add_unique_live_job_index(db):
+    db.jobs.update_many(
+        {"state": {"$ne": "failed"}}, {"$set": {"live": True}})
+    # Races before the index could leave duplicates; keep the oldest.
+    duplicates = db.jobs.aggregate([
+        {"$match": {"live": True}},
+        {"$sort": {"created_at": 1}},
+        {"$group": {"_id": {"provider_id": "$provider_id",
+                            "audio_hash": "$audio_hash"},
+                    "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}}
+    ])
+    for duplicate in duplicates:
+        db.jobs.update_many(
+            {"_id": {"$in": duplicate["ids"][1:]}}, {"$unset": {"live": ""}})
+    db.jobs.create_index(
+        [("provider_id", ASCENDING), ("audio_hash", ASCENDING)],
+        name="provider_audio_hash_live", unique=True,
+        partialFilterExpression={"live": True})
+    drop_index_if_exists(db.jobs, "provider_audio_hash")
+
+
+# (version, description, function). Append new migrations; never reorder.
+MIGRATIONS = [
+    (1, "Initial compound, unique and TTL indexes", create_initial_indexes),
+    (2, "Paginated recordings listing index", add_recording_page_index),
+    (3, "Unique prompt name per provider", add_unique_prompt_name_index),
+    (4, "Full-text search postings, backfilled", build_search_index),
+    (5, "Re-summarization batch queue index", add_summary_batch_index),
+    (6, "Version counters for recordings and patient notes",
+     add_edit_versions),
+    (7, "Compressed transcripts moved to their own collection",
+     move_transcripts),
+    (8, "One live job per provider and audio hash", add_unique_live_job_index),
+]
+
+
+def current_version(db):
+    latest = db.schema_migrations.find_one(
+        {"_id": {"$type": "number"}}, sort=[("_id", DESCENDING)])
+    return latest["_id"] if latest else 0
+
+
+def acquire_lock(db, owner):
+    """Take or renew the migration lock; False if another process holds it"""
+    now = datetime.now()
+    try:
+        db.schema_migrations.update_one(
+            {"_id": MIGRATION_LOCK_ID,
+             "$or": [{"owner": owner}, {"expires_at": {"$lt": now}}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(
+                seconds=MIGRATION_LOCK_SECONDS)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+def release_lock(db, owner):
+    db.schema_migrations.delete_one({"_id": MIGRATION_LOCK_ID, "owner": owner})
+
+
+def run_migrations(db, poll_seconds=1.0):
+    """
+    Apply every migration newer than the recorded schema version. The app,
+    the API and workers all call this on startup; one of them takes the
+    lock in `schema_migrations` and migrates while the others wait for it.
+    """
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    applied = []
+    while current_version(db) < MIGRATIONS[-1][0]:
+        if not acquire_lock(db, owner):
+            time.sleep(poll_seconds)
+            continue
+        try:
+            for number, description, migrate in MIGRATIONS:
+                # Re-read: the previous holder may have applied some.
+                if number <= current_version(db):
+                    continue
+                if not acquire_lock(db, owner):
+                    break  # Expired and taken over; wait for the new holder.
+                migrate(db)
+                db.schema_migrations.update_one(
+                    {"_id": number},
+                    {"$setOnInsert": {"description": description,
+                                      "applied_at": datetime.now()}},
+                    upsert=True
+                )
+                applied.append(number)
+        finally:
+            release_lock(db, owner)
+    return applied
+
+
+def dashboard_queries(provider_id, patient_id):
+    """The find() calls DatabaseManager makes, as (label, cursor) pairs"""
+    return [
+        ("recordings page by patient", lambda db: db.recordings.find(
+            {"patient_id": patient_id, "provider_id": provider_id},
+            {"timestamp": 1}
+        ).sort([("timestamp", -1), ("_id", -1)]).limit(21)),
+        ("recording by audio hash", lambda db: db.recordings.find(
+            {"provider_id": provider_id, "audio_hash": "0" * 64},
+            {"_id": 1})),
+        ("patients by provider", lambda db: db.patients.find(
+            {"provider_id": provider_id},
+            {"first_name": 1, "last_name": 1}
+        ).sort("last_name", 1)),
+        ("patient notes", lambda db: db.patients.find(
+            {"_id": ObjectId(patient_id)})),
+        ("system prompts", lambda db: db.system_messages.find(
+            {"provider_id": provider_id})),
+        ("provider by email", lambda db: db.providers.find(
+            {"email": "someone@example.com"})),
+        ("search postings", lambda db: db.search_postings.find(
+            {"provider_id": provider_id, "term": {"$in": ["metformin"]}},
+            {"_id": 0, "term": 1, "recording_id": 1, "weight": 1})),
+        ("next queued job", lambda db: db.jobs.find(
+            {"state": "queued"}).sort("created_at", 1).limit(1)),
+    ]
+
+
+def explain_queries(db, provider_id, patient_id):
+    for label, query in dashboard_queries(provider_id, patient_id):
+        plan = query(db).explain()
+        winning = plan["queryPlanner"]["winningPlan"]
+        stats = plan.get("executionStats", {})
+        print(f"== {label}")
+        pprint(winning)
+        if stats:
+            print(f"   docs examined: {stats.get('totalDocsExamined')}, "
+                  f"keys examined: {stats.get('totalKeysExamined')}")
+        print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("migrate")
+    subparsers.add_parser("status")
+    explain = subparsers.add_parser("explain")
+    explain.add_argument("--provider-id", required=True)
+    explain.add_argument("--patient-id", required=True)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = MongoClient(os.getenv('MONGO_URI'))['scriber']
+
+    if args.command == "migrate":
+        applied = run_migrations(db)
+        print(f"Applied migrations: {applied or 'none'}")
+    elif args.command == "status":
+        version = current_version(db)
+        for number, description, _ in MIGRATIONS:
+            state = "applied" if number <= version else "pending"
+            print(f"{number:>3}  {state:<8} {description}")
+    else:
+        explain_queries(db, args.provider_id, args.patient_id)
+
+
+if __name__ == "__main__":
+    main()
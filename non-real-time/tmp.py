@@ -5,13 +5,15 @@ import numpy as np
 from datetime import datetime
 
 
-def record_audio(duration, sample_rate=44100, chunk=1024, channels=1):
+# 16 kHz mono int16 is what the transcription pipeline uploads anyway, so
+# record in that format instead of converting afterwards.
+def record_audio(duration, sample_rate=16000, chunk=1024, channels=1):
     # Initialize PyAudio
     audio = pyaudio.PyAudio()
 
     # Open stream
     stream = audio.open(
-        format=pyaudio.paFloat32,
+        format=pyaudio.paInt16,
         channels=channels,
         rate=sample_rate,
         input=True,
@@ -49,12 +51,8 @@ def record_audio(duration, sample_rate=44100, chunk=1024, channels=1):
     return b''.join(frames)
 
 
-def save_audio(audio_data, filename, sample_rate=44100, channels=1):
-    # Convert audio data to numpy array
-    audio_array = np.frombuffer(audio_data, dtype=np.float32)
-
-    # Convert to int16 format
-    audio_int16 = (audio_array * 32767).astype(np.int16)
+def save_audio(audio_data, filename, sample_rate=16000, channels=1):
+    audio_int16 = np.frombuffer(audio_data, dtype=np.int16)
 
     # Create WAV file
     with wave.open(filename, 'wb') as wf:
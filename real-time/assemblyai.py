@@ -1,16 +1,27 @@
 import streamlit as st
-import websockets
 import asyncio
-import base64
-import json
+import os
+import sys
 from configure import auth_key
+from dotenv import load_dotenv
 
 import pyaudio
 
+# The rolling summarizer, DatabaseManager and STT router live in the app root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import DatabaseManager, DEFAULT_PROMPT  # noqa: E402
+from rolling_summary import RollingSummarizer  # noqa: E402
+from stt_backends import create_router  # noqa: E402
+
 if 'text' not in st.session_state:
     st.session_state['text'] = 'Listening...'
     st.session_state['run'] = False
     st.session_state['full_transcript'] = []
+    st.session_state['summarizer'] = None
+    st.session_state['recording_id'] = None
+
+load_dotenv()
+db_manager = DatabaseManager()
 
 
 FRAMES_PER_BUFFER = 3200
@@ -29,83 +40,77 @@ stream = p.open(
 )
 
 
+def start_rolling_summary():
+    # The recording exists from the first second of the visit; the draft
+    # note is folded into it as final segments arrive.
+    recording_id = db_manager.save_recording_data(
+        "", "",
+        st.session_state['provider_id'],
+        st.session_state['patient_id'],
+        summary_complete=False
+    )
+
+    def save_draft(transcript, draft, complete):
+        db_manager.update_recording_draft(
+            recording_id, transcript, draft, summary_complete=complete)
+
+    st.session_state['recording_id'] = recording_id
+    st.session_state['summarizer'] = RollingSummarizer(
+        st.session_state['system_prompt'], save_draft)
+
+
 def toggle_listening():
     st.session_state['run'] = not st.session_state['run']
-    if not st.session_state['run']:
+    if st.session_state['run']:
+        start_rolling_summary()
+    else:
         full_text = ' '.join(st.session_state['full_transcript'])
         with open('transcript.txt', 'w') as f:
             f.write(full_text)
         st.success('Transcript saved to transcript.txt')
         st.session_state['full_transcript'] = []
 
+        _, draft = st.session_state['summarizer'].finish()
+        st.session_state['summarizer'] = None
+        st.markdown(draft)
+
 
 st.title('Get real-time transcription')
 
+st.text_input('Provider ID', key='provider_id')
+st.text_input('Patient ID', key='patient_id')
+st.text_area('System prompt', value=DEFAULT_PROMPT, key='system_prompt')
+
 button_label = 'Stop listening' if st.session_state['run'] else 'Start listening'
 st.button(button_label, on_click=toggle_listening)
 
-URL = "wss://api.assemblyai.com/v2/realtime/ws?sample_rate=16000"
-
-
 async def send_receive():
-
-    print(f'Connecting websocket to url ${URL}')
-
-    async with websockets.connect(
-            URL,
-            extra_headers=(("Authorization", auth_key),),
-            ping_interval=5,
-            ping_timeout=20
-    ) as _ws:
-
-        r = await asyncio.sleep(0.1)
-        print("Receiving SessionBegins ...")
-
-        session_begins = await _ws.recv()
-        print(session_begins)
-        print("Sending messages ...")
-
-        async def send():
-            while st.session_state['run']:
-                try:
-                    data = stream.read(FRAMES_PER_BUFFER)
-                    data = base64.b64encode(data).decode("utf-8")
-                    json_data = json.dumps({"audio_data": str(data)})
-                    r = await _ws.send(json_data)
-
-                except websockets.exceptions.ConnectionClosedError as e:
-                    print(e)
-                    assert e.code == 4008
-                    break
-
-                except Exception as e:
-                    print(e)
-                    assert False, "Not a websocket 4008 error"
-
-                r = await asyncio.sleep(0.01)
-
-        async def receive():
-            while st.session_state['run']:
-                try:
-                    result_str = await _ws.recv()
-                    result = json.loads(result_str)['text']
-
-                    if json.loads(result_str)['message_type'] == 'FinalTranscript':
-                        print(result)
-                        st.session_state['text'] = result
-                        st.markdown(st.session_state['text'])
-                        st.session_state['full_transcript'].append(result)
-
-                except websockets.exceptions.ConnectionClosedError as e:
-                    print(e)
-                    assert e.code == 4008
-                    break
-
-                except Exception as e:
-                    print(e)
-                    assert False, "Not a websocket 4008 error"
-
-        send_result, receive_result = await asyncio.gather(send(), receive())
+    # AssemblyAI is the default here, but the router fails over to any
+    # other configured backend that is healthier or the only one up.
+    router = await create_router(assemblyai_api_key=auth_key,
+                                 order=['assemblyai', 'deepgram'])
+    session = await router.open_stream(sample_rate=RATE)
+    print(f'Streaming to {session.backend}')
+
+    async def send():
+        while st.session_state['run']:
+            await session.send(stream.read(FRAMES_PER_BUFFER))
+            await asyncio.sleep(0.01)
+        await session.finish()
+
+    async def receive():
+        async for result in session.results():
+            if result['is_final']:
+                print(result['text'])
+                st.session_state['text'] = result['text']
+                st.markdown(st.session_state['text'])
+                st.session_state['full_transcript'].append(result['text'])
+                st.session_state['summarizer'].add_segment(result['text'])
+
+    try:
+        await asyncio.gather(send(), receive())
+    finally:
+        await router.aclose()
 
 
 asyncio.run(send_receive())
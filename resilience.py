@@ -0,0 +1,311 @@
+"""Deadlines, retries, hedging and circuit breaking for upstream calls.
+
+Each upstream (Deepgram, OpenAI) gets one `Policy`, shared by every caller
+in the process. A call is handed the time it may take and is made through
+`policy.call(fn)` or `await policy.acall(fn)`, where `fn(timeout)` performs
+one attempt. Outcomes are counted per upstream in `policy.stats()` and, when
+metrics are enabled, as `scriber_upstream_*_total` counters.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """The upstream has been failing; the call was not attempted."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """The call's overall deadline passed before an attempt succeeded."""
+
+
+class LatencyWindow:
+    """Latencies of the most recent successful calls"""
+
+    def __init__(self, size=200):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q, min_samples=20):
+        with self._lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive upstream failures and
+    rejects calls for `reset_seconds`. Then a single trial call is let
+    through: success closes the circuit, failure opens it again. A trial
+    that never reports back, e.g. because it was cancelled, is replaced by
+    a new one after another `reset_seconds`.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self._trial_due(time.monotonic()):
+                self.state = HALF_OPEN
+                self.trial_at = time.monotonic()
+                return True
+            return False
+
+    def available(self):
+        """Whether `allow` would let a call through, without taking the trial"""
+        with self._lock:
+            return self.state == CLOSED or self._trial_due(time.monotonic())
+
+    def _trial_due(self, now):
+        if self.state == OPEN:
+            return now - self.opened_at >= self.reset_seconds
+        return now - self.trial_at >= self.reset_seconds
+
+    def abandon(self):
+        """
+        A call that was let through ended without a verdict on the
+        upstream. If it was the half-open trial, the next call takes over.
+        """
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.opened_at = time.monotonic() - self.reset_seconds
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """Returns True if this failure opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (
+                    self.state == CLOSED and
+                    self.failures >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class Policy:
+    """
+    Resilience settings for one upstream:
+
+    - `deadline` bounds the whole call, retries included; each attempt also
+      gets at most `attempt_timeout`.
+    - Errors for which `retriable(error)` is true are retried up to
+      `max_retries` times with full-jitter exponential backoff, as long as
+      the deadline leaves room.
+    - With `hedge`, an attempt that hasn't finished by the p95 latency of
+      recent calls gets a second, concurrent attempt; the first success
+      wins. Only calls that pass `hedge=True` are hedged.
+    - Retriable failures also feed the circuit breaker.
+    """
+
+    def __init__(self, name, deadline, attempt_timeout, retriable,
+                 max_retries=2, base_delay=0.5, max_delay=8.0,
+                 hedge=False, hedge_quantile=0.95, hedge_min_delay=0.2,
+                 breaker=None, hedge_workers=8):
+        self.name = name
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.retriable = retriable
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.latency = LatencyWindow()
+        self.counters = Counter()
+        self._counter_lock = threading.Lock()
+        # Threads are only started once a call is actually hedged.
+        self._executor = ThreadPoolExecutor(
+            max_workers=hedge_workers, thread_name_prefix=f"{name}-hedge")
+
+    def count(self, event):
+        with self._counter_lock:
+            self.counters[event] += 1
+        metrics.increment(f"upstream_{event}_total", upstream=self.name)
+
+    def stats(self):
+        with self._counter_lock:
+            stats = dict(self.counters)
+        stats["circuit"] = self.breaker.state
+        stats["p95_seconds"] = self.latency.quantile(0.95)
+        return stats
+
+    def hedge_delay(self):
+        delay = self.latency.quantile(self.hedge_quantile)
+        return None if delay is None else max(delay, self.hedge_min_delay)
+
+    def call(self, fn, hedge=False, attempt_timeout=None):
+        """Run `fn(timeout)` under this policy from synchronous code"""
+        deadline_at = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            timeout = self._before_attempt(deadline_at, attempt_timeout)
+            start = time.monotonic()
+            try:
+                if hedge and self.hedge:
+                    result = self._hedged(fn, timeout)
+                else:
+                    result = fn(timeout)
+            except Exception as e:
+                backoff = self._after_failure(e, attempt, deadline_at)
+                time.sleep(backoff)
+                continue
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            self._after_success(time.monotonic() - start)
+            return result
+
+    async def acall(self, fn, hedge=False, attempt_timeout=None):
+        """Await `fn(timeout)` under this policy; `fn` returns a coroutine"""
+        deadline_at = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            timeout = self._before_attempt(deadline_at, attempt_timeout)
+            start = time.monotonic()
+            try:
+                if hedge and self.hedge:
+                    result = await self._ahedged(fn, timeout)
+                else:
+                    result = await asyncio.wait_for(fn(timeout), timeout)
+            except Exception as e:
+                backoff = self._after_failure(e, attempt, deadline_at)
+                await asyncio.sleep(backoff)
+                continue
+            except BaseException:
+                # Cancelled, e.g. the loser of a race between backends.
+                self.breaker.abandon()
+                raise
+            self._after_success(time.monotonic() - start)
+            return result
+
+    def _before_attempt(self, deadline_at, attempt_timeout=None):
+        if not self.breaker.allow():
+            self.count("rejected")
+            raise CircuitOpenError(f"{self.name} circuit is open")
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            self.count("deadline_exceeded")
+            raise DeadlineExceeded(f"{self.name} deadline exceeded")
+        self.count("attempts")
+        return min(attempt_timeout or self.attempt_timeout, remaining)
+
+    def _after_success(self, elapsed):
+        self.latency.add(elapsed)
+        self.breaker.record_success()
+        self.count("successes")
+
+    def _after_failure(self, error, attempt, deadline_at):
+        """Seconds to wait before retrying, or re-raise `error`"""
+        retriable = isinstance(error, TimeoutError) or self.retriable(error)
+        if not retriable:
+            # The upstream answered; the request itself was wrong.
+            self.breaker.record_success()
+        elif self.breaker.record_failure():
+            self.count("circuit_opened")
+        self.count("failures")
+
+        if not retriable or attempt == self.max_retries:
+            raise error
+        backoff = random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if time.monotonic() + backoff >= deadline_at:
+            self.count("deadline_exceeded")
+            raise error
+        self.count("retries")
+        return backoff
+
+    def _hedged(self, fn, timeout):
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return fn(timeout)
+
+        start = time.monotonic()
+        primary = self._executor.submit(fn, timeout)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        self.count("hedges")
+        backup = self._executor.submit(fn, timeout - delay)
+        pending = {primary, backup}
+        error = None
+        while pending:
+            remaining = timeout - (time.monotonic() - start)
+            done, pending = wait(pending, timeout=max(remaining, 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError(f"{self.name} attempt timed out")
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def _ahedged(self, fn, timeout):
+        delay = self.hedge_delay()
+        if delay is None or delay >= timeout:
+            return await asyncio.wait_for(fn(timeout), timeout)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        primary = asyncio.ensure_future(fn(timeout))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        self.count("hedges")
+        backup = asyncio.ensure_future(fn(timeout - delay))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                remaining = timeout - (loop.time() - start)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(remaining, 0),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError(f"{self.name} attempt timed out")
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.count("hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The loser is still holding a connection; let it go.
+            for task in pending:
+                task.cancel()
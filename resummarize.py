@@ -0,0 +1,286 @@
+"""Rewrite the summaries of past visits with a new prompt template.
+
+Batches are created from the UI (or here) and run by worker.py, one window
+of recordings at a time. Rewritten recordings are tagged with the batch id,
+so an interrupted batch resumes where it stopped. To run one by hand:
+
+    python resummarize.py start --provider-id <id> --prompt-name <name>
+    python resummarize.py run <batch id>
+    python resummarize.py status <batch id>
+"""
+import argparse
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import openai
+from bson.objectid import ObjectId
+from dotenv import load_dotenv
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from data import DatabaseManager
+from summary_cache import SummaryCache
+from utils import get_summary
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+RESUMMARIZE_CONCURRENCY = int(os.getenv('RESUMMARIZE_CONCURRENCY', 4))
+RESUMMARIZE_REQUESTS_PER_MINUTE = float(
+    os.getenv('RESUMMARIZE_REQUESTS_PER_MINUTE', 60))
+RESUMMARIZE_WINDOW = int(os.getenv('RESUMMARIZE_WINDOW', 20))
+STALE_BATCH_SECONDS = 10 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Token bucket kept in the `rate_limits` collection under `key`, so every
+    thread and process drawing from the same key (all worker processes and
+    `resummarize.py run`) shares one limit. Draws are compare-and-swap on a
+    version counter; bucket time is wall-clock, so hosts need synced clocks.
+    """
+
+    def __init__(self, db, key, per_minute, burst=None):
+        self.limits = db.rate_limits
+        self.key = key
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1.0, self.rate)
+
+    def acquire(self):
+        while True:
+            now = time.time()
+            bucket = self.limits.find_one({"_id": self.key})
+            if bucket is None:
+                tokens = self.capacity
+            else:
+                tokens = min(self.capacity, bucket["tokens"] +
+                             max(0.0, now - bucket["updated"]) * self.rate)
+            if tokens < 1:
+                time.sleep((1 - tokens) / self.rate)
+                continue
+            if self._draw(bucket, tokens - 1, now):
+                return
+            # Another thread or process drew in between; look again.
+
+    def _draw(self, bucket, tokens, now):
+        state = {"tokens": tokens, "updated": now}
+        if bucket is None:
+            try:
+                self.limits.insert_one({"_id": self.key, "version": 0, **state})
+                return True
+            except DuplicateKeyError:
+                return False
+        result = self.limits.update_one(
+            {"_id": self.key, "version": bucket["version"]},
+            {"$set": state, "$inc": {"version": 1}})
+        return result.modified_count == 1
+
+
+def rate_limit_key(api_key):
+    """Requests are limited per OpenAI key; the key itself isn't stored"""
+    return "openai:" + hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+
+
+class BatchResummarizer:
+    """
+    Resumable bulk re-summarization backed by the `summary_batches`
+    collection. A batch covers the recordings of one patient, or of all a
+    provider's patients, that existed when it was created.
+    """
+
+    def __init__(self, db_manager, summary_cache=None,
+                 concurrency=RESUMMARIZE_CONCURRENCY,
+                 requests_per_minute=RESUMMARIZE_REQUESTS_PER_MINUTE,
+                 window=RESUMMARIZE_WINDOW):
+        self.db_manager = db_manager
+        self.batches = db_manager.db.summary_batches
+        self.summary_cache = summary_cache
+        self.window = window
+        # Shared by all batches in every process using this OpenAI key, so
+        # the rate limit holds however many of them run at once.
+        self.limiter = RateLimiter(
+            db_manager.db, rate_limit_key(openai.api_key),
+            requests_per_minute)
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="resummarize")
+
+    def create(self, provider_id, prompt_name, system_prompt,
+               patient_id=None):
+        """Queue a batch; returns its id"""
+        now = datetime.now()
+        batch = {
+            "provider_id": provider_id,
+            "patient_id": patient_id,
+            "prompt_name": prompt_name,
+            "system_prompt": system_prompt,
+            "state": QUEUED,
+            "created_at": now,
+            "updated_at": now,
+            "done": 0,
+            "failed_ids": []
+        }
+        batch["total"] = self.db_manager.db.recordings.count_documents(
+            self._scope(batch))
+        return str(self.batches.insert_one(batch).inserted_id)
+
+    def claim(self, worker_id, stale_seconds=STALE_BATCH_SECONDS):
+        """Take the oldest queued batch, or one whose worker went quiet"""
+        now = datetime.now()
+        return self.batches.find_one_and_update(
+            {"$or": [
+                {"state": QUEUED},
+                {"state": RUNNING,
+                 "updated_at": {"$lt": now - timedelta(seconds=stale_seconds)}}
+            ]},
+            {"$set": {"state": RUNNING, "worker_id": worker_id,
+                      "updated_at": now}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def cancel(self, batch_id):
+        self.batches.update_one(
+            {"_id": ObjectId(batch_id), "state": {"$in": list(ACTIVE_STATES)}},
+            {"$set": {"state": CANCELLED, "updated_at": datetime.now()}})
+
+    def get_batches(self, batch_ids):
+        return list(self.batches.find(
+            {"_id": {"$in": [ObjectId(batch_id) for batch_id in batch_ids]}},
+            {"state": 1, "prompt_name": 1, "total": 1, "done": 1,
+             "failed_ids": 1, "created_at": 1}
+        ).sort("created_at", 1))
+
+    def run(self, batch):
+        """Rewrite every pending recording of a claimed batch"""
+        while self.run_window(batch):
+            pass
+
+    def run_window(self, batch):
+        """
+        Rewrite the next window of a claimed batch: summarize it
+        concurrently under the rate limit, write it back with one bulk
+        update and save the batch's progress. Returns False once the batch
+        is finished or no longer ours to run.
+        """
+        batch_id = batch["_id"]
+        current = self.batches.find_one(
+            {"_id": batch_id}, {"state": 1, "failed_ids": 1})
+        if current is None or current["state"] != RUNNING:
+            return False
+
+        recordings = list(self.db_manager.db.recordings.find(
+            self._pending(batch, current["failed_ids"]), {"_id": 1}
+        ).sort("timestamp", 1).limit(self.window))
+        if not recordings:
+            self.batches.update_one(
+                {"_id": batch_id, "state": RUNNING},
+                {"$set": {"state": DONE, "updated_at": datetime.now()}})
+            return False
+
+        transcripts = self.db_manager.transcripts.get_many(
+            [r["_id"] for r in recordings])
+        futures = [
+            self.executor.submit(self._summarize,
+                                 transcripts.get(r["_id"], ""),
+                                 batch["system_prompt"])
+            for r in recordings
+        ]
+        updates, failed = {}, []
+        for recording, future in zip(recordings, futures):
+            try:
+                updates[str(recording["_id"])] = {
+                    "summary": future.result(),
+                    "summary_complete": True,
+                    "summary_batch_id": batch_id
+                }
+            except Exception as e:
+                logger.warning("Batch %s: recording %s failed: %s",
+                               batch_id, recording["_id"], e)
+                failed.append(recording["_id"])
+
+        self.db_manager.bulk_update_recording_data(updates)
+        self.batches.update_one(
+            {"_id": batch_id},
+            {
+                "$inc": {"done": len(updates)},
+                "$push": {"failed_ids": {"$each": failed}},
+                "$set": {"updated_at": datetime.now()}
+            }
+        )
+        return True
+
+    def _summarize(self, transcript, system_prompt):
+        # Rate-limit errors are retried with backoff by OPENAI_POLICY.
+        self.limiter.acquire()
+        return get_summary(transcript, system_prompt, self.summary_cache)
+
+    def _scope(self, batch):
+        scope = {"provider_id": batch["provider_id"],
+                 "timestamp": {"$lte": batch["created_at"]}}
+        if batch["patient_id"]:
+            scope["patient_id"] = batch["patient_id"]
+        return scope
+
+    def _pending(self, batch, failed_ids):
+        return {
+            **self._scope(batch),
+            "summary_batch_id": {"$ne": batch["_id"]},
+            "_id": {"$nin": failed_ids}
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    start = subparsers.add_parser("start")
+    start.add_argument("--provider-id", required=True)
+    start.add_argument("--patient-id", default=None)
+    start.add_argument("--prompt-name", required=True)
+    for command in ("run", "status", "cancel"):
+        subparsers.add_parser(command).add_argument("batch_id")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(name)s: %(message)s")
+    load_dotenv()
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    db_manager = DatabaseManager()
+    resummarizer = BatchResummarizer(db_manager, SummaryCache(db_manager.db))
+
+    if args.command == "start":
+        prompts = db_manager.load_system_prompts(args.provider_id)
+        batch_id = resummarizer.create(
+            args.provider_id, args.prompt_name, prompts[args.prompt_name],
+            args.patient_id)
+        print(f"Queued batch {batch_id}")
+    elif args.command == "run":
+        batch = resummarizer.batches.find_one_and_update(
+            {"_id": ObjectId(args.batch_id),
+             "state": {"$in": list(ACTIVE_STATES)}},
+            {"$set": {"state": RUNNING, "worker_id": "cli",
+                      "updated_at": datetime.now()}},
+            return_document=ReturnDocument.AFTER)
+        if batch is None:
+            print("Batch is not queued or running")
+        else:
+            resummarizer.run(batch)
+    elif args.command == "cancel":
+        resummarizer.cancel(args.batch_id)
+    else:
+        batch, = resummarizer.get_batches([args.batch_id])
+        print(f"{batch['state']}: {batch['done']}/{batch['total']} rewritten, "
+              f"{len(batch['failed_ids'])} failed")
+
+
+if __name__ == "__main__":
+    main()
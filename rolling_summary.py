@@ -0,0 +1,95 @@
+import threading
+import time
+
+from utils import chat_completion
+
+FOLD_PROMPT = (
+    "{system_prompt}\n\n"
+    "The visit is still in progress. You will be given the current draft "
+    "note and the newest part of the transcript. Return the complete updated "
+    "note, folding the new information into the draft. Keep everything in "
+    "the draft that is still accurate."
+)
+
+
+class RollingSummarizer:
+    """
+    Keeps a draft note up to date while a visit is being transcribed.
+
+    Final transcript segments are buffered and folded into the draft by a
+    background thread, one model call at a time, whenever `batch_size`
+    segments are waiting or `max_wait` seconds have passed. Each new draft is
+    handed to `on_draft(transcript, draft, complete)` so it can be persisted.
+    """
+
+    def __init__(self, system_prompt, on_draft, batch_size=5, max_wait=20.0):
+        self.system_prompt = system_prompt
+        self.on_draft = on_draft
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.segments = []
+        self.draft = ""
+        self.error = None
+        self._folded = 0
+        self._finished = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="rolling-summary", daemon=True)
+        self._thread.start()
+
+    @property
+    def transcript(self):
+        return " ".join(self.segments)
+
+    def add_segment(self, text):
+        with self._condition:
+            self.segments.append(text)
+            if len(self.segments) - self._folded >= self.batch_size:
+                self._condition.notify()
+
+    def finish(self, timeout=None):
+        """Fold whatever is left and return the final (transcript, draft)"""
+        with self._condition:
+            self._finished = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        return self.transcript, self.draft
+
+    def _run(self):
+        last_fold = time.monotonic()
+        while True:
+            with self._condition:
+                while not self._finished:
+                    waiting = len(self.segments) - self._folded
+                    overdue = time.monotonic() - last_fold >= self.max_wait
+                    if waiting >= self.batch_size or (waiting and overdue):
+                        break
+                    self._condition.wait(timeout=1.0)
+                new_segments = self.segments[self._folded:]
+                finished = self._finished
+
+            if new_segments:
+                try:
+                    self.draft = self._fold(" ".join(new_segments))
+                    self._folded += len(new_segments)
+                except Exception as e:
+                    # Keep the segments pending and retry with the next batch.
+                    self.error = e
+                last_fold = time.monotonic()
+
+            if finished:
+                complete = self._folded == len(self.segments)
+                self.on_draft(self.transcript, self.draft, complete)
+                return
+            if new_segments:
+                self.on_draft(self.transcript, self.draft, False)
+
+    def _fold(self, new_text):
+        response = chat_completion([
+            {"role": "system", "content": FOLD_PROMPT.format(
+                system_prompt=self.system_prompt)},
+            {"role": "user", "content":
+                f"Current draft note:\n{self.draft or '(empty)'}\n\n"
+                f"New transcript:\n{new_text}"}
+        ])
+        return response.choices[0].message.content
@@ -1 +1,2 @@
+python3 worker.py &
 python3 -m streamlit run app.py
\ No newline at end of file
@@ -0,0 +1,218 @@
+import math
+import re
+from collections import Counter
+
+from bson.objectid import ObjectId
+from pymongo import DeleteMany, UpdateOne
+
+from transcript_store import TranscriptStore
+
+# Summary terms are worth more than the same word said once in passing.
+SUMMARY_WEIGHT = 3.0
+BM25_K1 = 1.2
+SNIPPET_CHARS = 160
+
+STOPWORDS = frozenset("""
+a about after again all also am an and any are as at be because been before
+being but by can could did do does doing down for from had has have having he
+her here hers him his how i if in into is it its just me more most my no nor
+not now of off on once only or other our out over own same she should so some
+than that the their them then there these they this those through to too um
+uh under until up very was we were what when where which while who whom why
+will with would yeah you your
+""".split())
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return [
+        token for token in _TOKEN.findall((text or "").lower())
+        if len(token) > 1 and token not in STOPWORDS
+    ]
+
+
+def term_weights(transcript, summary):
+    weights = Counter(tokenize(transcript))
+    for term, count in Counter(tokenize(summary)).items():
+        weights[term] += SUMMARY_WEIGHT * count
+    return weights
+
+
+def snippet(text, terms, width=SNIPPET_CHARS):
+    """Window of `text` around the first query term, with terms in bold"""
+    pattern = re.compile(
+        r"\b(" + "|".join(map(re.escape, terms)) + r")\b", re.IGNORECASE)
+    match = pattern.search(text or "")
+    if match is None:
+        return None
+
+    start = max(0, match.start() - width // 2)
+    end = min(len(text), start + width)
+    start = max(0, end - width)
+    window = pattern.sub(r"**\1**", text[start:end])
+    return ("..." if start else "") + window + ("..." if end < len(text) else "")
+
+
+class SearchIndex:
+    """
+    Inverted index of recording transcripts and summaries in the
+    `search_postings` collection: one posting per (recording, term) holding
+    the term's weight in that visit. Queries rank the postings of their
+    terms with BM25 (without length normalization) in one indexed
+    aggregation, so the cost grows with how common the terms are rather
+    than with the number of visits.
+    """
+
+    def __init__(self, db, transcripts=None):
+        self.db = db
+        self.postings = db.search_postings
+        self.transcripts = transcripts or TranscriptStore(db)
+
+    def index_recording(self, recording, new=False):
+        """
+        Bring the postings of one recording in line with its current text,
+        writing only terms whose weight changed. `new` recordings have no
+        postings yet, so theirs are inserted without looking.
+        """
+        recording_id = recording["_id"]
+        weights = term_weights(recording.get("transcript"),
+                               recording.get("summary"))
+        if new:
+            if weights:
+                self.postings.insert_many([
+                    {
+                        "recording_id": recording_id,
+                        "term": term,
+                        "weight": weight,
+                        "provider_id": recording["provider_id"],
+                        "patient_id": recording["patient_id"],
+                        "timestamp": recording["timestamp"]
+                    }
+                    for term, weight in weights.items()
+                ], ordered=False)
+            return
+
+        self._apply(self._update_operations(
+            recording, weights, self._existing([recording_id])[recording_id]))
+
+    def reindex(self, document_ids):
+        """Re-read one or many recordings and update their postings"""
+        if isinstance(document_ids, (str, ObjectId)):
+            document_ids = [document_ids]
+        recordings = list(self.db.recordings.find(
+            {"_id": {"$in": [ObjectId(i) for i in document_ids]}},
+            {"summary": 1, "provider_id": 1, "patient_id": 1,
+             "timestamp": 1}))
+        ids = [r["_id"] for r in recordings]
+        existing = self._existing(ids)
+        transcripts = self.transcripts.get_many(ids)
+
+        operations = []
+        for recording in recordings:
+            weights = term_weights(transcripts.get(recording["_id"]),
+                                   recording.get("summary"))
+            operations.extend(self._update_operations(
+                recording, weights, existing[recording["_id"]]))
+        self._apply(operations)
+
+    def _existing(self, recording_ids):
+        existing = {recording_id: {} for recording_id in recording_ids}
+        for posting in self.postings.find(
+                {"recording_id": {"$in": recording_ids}},
+                {"recording_id": 1, "term": 1, "weight": 1}):
+            existing[posting["recording_id"]][posting["term"]] = \
+                posting["weight"]
+        return existing
+
+    def _update_operations(self, recording, weights, existing):
+        recording_id = recording["_id"]
+        operations = [
+            UpdateOne(
+                {"recording_id": recording_id, "term": term},
+                {"$set": {
+                    "weight": weight,
+                    "provider_id": recording["provider_id"],
+                    "patient_id": recording["patient_id"],
+                    "timestamp": recording["timestamp"]
+                }},
+                upsert=True
+            )
+            for term, weight in weights.items()
+            if existing.get(term) != weight
+        ]
+        removed = [term for term in existing if term not in weights]
+        if removed:
+            operations.append(DeleteMany(
+                {"recording_id": recording_id, "term": {"$in": removed}}))
+        return operations
+
+    def _apply(self, operations):
+        if operations:
+            self.postings.bulk_write(operations, ordered=False)
+
+    def search(self, provider_id, query, page=0, page_size=10):
+        """
+        Rank a provider's recordings against `query`. Visits matching more
+        of the query terms come first, then by score, then newest first.
+        Returns (hits, total, terms), where each hit has `recording_id`,
+        `patient_id`, `timestamp` and `score`.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return [], 0, terms
+
+        match = {"provider_id": provider_id, "term": {"$in": terms}}
+        # Both counts are answered from indexes without touching documents.
+        document_frequency = {
+            term: self.postings.count_documents(
+                {"provider_id": provider_id, "term": term})
+            for term in terms
+        }
+        total_documents = max(
+            self.db.recordings.count_documents({"provider_id": provider_id}),
+            max(document_frequency.values()))
+        idf = {
+            term: math.log(1 + (total_documents - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+        # Scoring runs in Mongo, so only one page of hits leaves the server.
+        saturation = {"$divide": [
+            {"$multiply": ["$weight", BM25_K1 + 1]},
+            {"$add": ["$weight", BM25_K1]}
+        ]}
+        term_idf = {"$switch": {
+            "branches": [
+                {"case": {"$eq": ["$term", term]}, "then": value}
+                for term, value in idf.items()
+            ],
+            "default": 0
+        }}
+        result = next(self.postings.aggregate([
+            {"$match": match},
+            {"$group": {
+                "_id": "$recording_id",
+                "score": {"$sum": {"$multiply": [term_idf, saturation]}},
+                "matched": {"$sum": 1},
+                "patient_id": {"$first": "$patient_id"},
+                "timestamp": {"$first": "$timestamp"}
+            }},
+            {"$sort": {"matched": -1, "score": -1, "timestamp": -1}},
+            {"$facet": {
+                "total": [{"$count": "count"}],
+                "hits": [{"$skip": page * page_size}, {"$limit": page_size}]
+            }}
+        ]))
+
+        hits = [
+            {
+                "recording_id": str(hit["_id"]),
+                "patient_id": hit["patient_id"],
+                "timestamp": hit["timestamp"],
+                "score": round(hit["score"], 4)
+            }
+            for hit in result["hits"]
+        ]
+        total = result["total"][0]["count"] if result["total"] else 0
+        return hits, total, terms
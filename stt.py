@@ -1,60 +1,188 @@
 from audio_recorder_streamlit import audio_recorder
-import streamlit as st
 
-from deepgram import DeepgramClient, PrerecordedOptions
 import os
-import httpx
 import asyncio
+import logging
+import math
+import threading
+import wave
+from dataclasses import dataclass
 
+from audio import (
+    AudioChunk,
+    encode,
+    prepare_audio,
+    split_samples,
+    stitch_words,
+    trim_silence
+)
+from metrics import span, timed
+from stt_backends import create_router
 
-async def transcribe_audio(audio_data, deepgram_client):
+logger = logging.getLogger(__name__)
 
+
+# Recordings longer than this are split and transcribed chunk by chunk.
+CHUNKED_MIN_SECONDS = float(os.getenv('STT_CHUNKED_MIN_SECONDS', 180))
+CHUNK_SECONDS = float(os.getenv('STT_CHUNK_SECONDS', 60))
+CHUNK_CONCURRENCY = int(os.getenv('STT_CHUNK_CONCURRENCY', 4))
+CHUNK_TIMEOUT_SECONDS = 120.0
+
+
+class STTService:
+    """
+    Long-lived event loop running in a daemon thread. It owns one
+    STTRouter and its pooled vendor clients, so every caller reuses warm
+    TLS connections and transcriptions from different sessions actually
+    overlap.
+    """
+
+    def __init__(self, deepgram_api_key=None):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="stt-event-loop", daemon=True)
+        self.thread.start()
+        self.router = self.run(create_router(deepgram_api_key))
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the service loop and block for its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def transcribe(self, audio_data):
+        return self.run(transcribe_audio(audio_data, self.router))
+
+    def close(self):
+        self.run(self.router.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@dataclass
+class Upload:
+    """
+    A recording ready to transcribe: its encoded chunks (just one for
+    short audio) and the map from upload time back to the original audio.
+    Building it is all the CPU work of a transcription, and it pickles, so
+    batch jobs can prepare uploads in a process pool.
+    """
+    chunks: list
+    content_type: str
+    time_map: object = None          # None when the audio couldn't be decoded
+    duration: float = 0.0            # seconds uploaded, after trimming
+    original_seconds: float = 0.0
+
+
+@timed("stt.prepare_audio")
+def prepare_for_upload(audio_data):
+    """Normalize the recording and cut its silences; CPU-bound"""
+    prepared = prepare_audio(audio_data)
+    original_seconds = prepared.duration
+    prepared.samples, time_map = trim_silence(
+        prepared.samples, prepared.sample_rate)
+    logger.info("Trimmed silence: %.0fs -> %.0fs of audio",
+                original_seconds, prepared.duration)
+    return prepared, time_map, original_seconds
+
+
+def prepare_upload(audio_data, chunk_seconds=CHUNK_SECONDS):
+    """
+    Decode, trim and encode a recording. Recordings longer than
+    CHUNKED_MIN_SECONDS are split at silences into `chunk_seconds` chunks.
+    """
     try:
+        prepared, time_map, original_seconds = prepare_for_upload(audio_data)
+    except (wave.Error, EOFError, ValueError):
+        # Not a WAV we can decode; let the vendor sniff the format.
+        return Upload([AudioChunk(audio_data, 0.0, 0.0, math.inf)],
+                      "application/octet-stream")
+
+    if prepared.duration == 0:
+        return Upload([], "audio/wav", time_map, 0.0, original_seconds)
+
+    if prepared.duration > CHUNKED_MIN_SECONDS:
+        with span("stt.split_audio"):
+            chunks, content_type = split_samples(
+                prepared.samples, prepared.sample_rate,
+                chunk_seconds=chunk_seconds)
+    else:
+        with span("stt.encode_audio"):
+            data, content_type = encode(
+                prepared.samples, prepared.sample_rate)
+        chunks = [AudioChunk(data, 0.0, 0.0, math.inf)]
 
-        # Set up transcription options
-        options = PrerecordedOptions(
-            model="nova-2",  # Using their latest model
-            smart_format=True,  # Enable smart formatting
-            language="en",  # Set to English
-            punctuate=True,  # Add punctuation
-        )
-
-        # Create the source dictionary with the audio buffer
-        source = {'buffer': audio_data}
-
-        # Request transcription with increased timeout for larger files
-        response = deepgram_client.listen.rest.v("1").transcribe_file(
-            source,
-            options,
-            timeout=httpx.Timeout(300.0, connect=10.0)
-        )
-
-        # Extract transcript from the response structure
-        return response["results"]["channels"][0]["alternatives"][0]["transcript"]
-    except Exception as e:
-        st.error(f"Transcription error: {str(e)}")
-        return None
-
-
-def deepgram_stt(deepgram_api_key=None):
-    if not 'deepgram_client' in st.session_state:
-        st.session_state.deepgram_client = DeepgramClient(
-            api_key=deepgram_api_key or os.getenv('DEEPGRAM_API_KEY'))
-
-    output = None
-    audio = audio_recorder(
+    logger.info("Uploading %.0fs of audio in %d chunk(s): %d bytes -> %d "
+                "bytes (%s)", prepared.duration, len(chunks),
+                prepared.original_bytes,
+                sum(len(chunk.data) for chunk in chunks), content_type)
+    return Upload(chunks, content_type, time_map, prepared.duration,
+                  original_seconds)
+
+
+async def transcribe_upload(upload, router, max_concurrency=CHUNK_CONCURRENCY):
+    """
+    Transcribe a prepared upload through `router` and return
+    {"transcript", "words"}. Chunks are transcribed concurrently, each
+    routed and retried on its own, and stitched back together in order.
+    Word times refer to the original recording; they are None if it
+    couldn't be decoded.
+    """
+    if not upload.chunks:
+        return {"transcript": "", "words": []}
+
+    if len(upload.chunks) == 1:
+        result = await router.transcribe(
+            upload.chunks[0].data, upload.content_type,
+            audio_seconds=upload.duration)
+        transcript = result["transcript"]
+        words = result["words"]
+    else:
+        semaphore = asyncio.Semaphore(max_concurrency)
+        chunk_seconds = upload.duration / len(upload.chunks)
+
+        async def transcribe_chunk(chunk):
+            async with semaphore:
+                result = await router.transcribe(
+                    chunk.data, upload.content_type,
+                    audio_seconds=chunk_seconds,
+                    attempt_timeout=CHUNK_TIMEOUT_SECONDS)
+                return result["words"]
+
+        results = await asyncio.gather(
+            *(transcribe_chunk(chunk) for chunk in upload.chunks))
+        words = stitch_words(zip(upload.chunks, results))
+        transcript = " ".join(w["word"] for w in words)
+
+    if upload.time_map is None:
+        return {"transcript": transcript, "words": None}
+    if words:
+        starts = upload.time_map.to_original([w["start"] for w in words])
+        ends = upload.time_map.to_original([w["end"] for w in words])
+        for word, start, end in zip(words, starts, ends):
+            word["start"], word["end"] = float(start), float(end)
+    return {"transcript": transcript, "words": words}
+
+
+async def transcribe_audio_detailed(audio_data, router):
+    """
+    Transcribe a recording and return {"transcript", "words"}. Word times
+    refer to the original recording even though silences were cut before
+    upload; they are None if the audio couldn't be decoded locally.
+    """
+    # Resampling is CPU-bound; keep it off the shared event loop.
+    upload = await asyncio.to_thread(prepare_upload, audio_data)
+    return await transcribe_upload(upload, router)
+
+
+@timed("stt.transcribe_audio")
+async def transcribe_audio(audio_data, router):
+    result = await transcribe_audio_detailed(audio_data, router)
+    return result["transcript"]
+
+
+def record_audio():
+    return audio_recorder(
         text="",
         recording_color="#e8576e",
         neutral_color="#6aa36f",
         icon_size="2x",
     )
-
-    if audio:
-        with st.spinner('Transcribing audio...'):
-            # Run async transcription in sync context
-            output = asyncio.run(transcribe_audio(
-                audio,
-                st.session_state.deepgram_client,
-            ))
-
-    return output
@@ -0,0 +1,574 @@
+"""Speech-to-text vendors behind one interface, and the router between them.
+
+Every backend transcribes whole recordings (`transcribe`) and live audio
+(`open_stream`). `STTRouter` picks a backend per request from its recent
+latency for audio of that length and its recent error rate, fails over to
+the next one when a backend errors or its circuit is open, and races the
+two best backends for short dictations. Backends are enabled by their API
+key (DEEPGRAM_API_KEY, ASSEMBLYAI_API_KEY); STT_BACKENDS orders them.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import httpx
+import websockets
+
+from metrics import increment, timed
+from resilience import (CircuitBreaker, CircuitOpenError, DeadlineExceeded,
+                        LatencyWindow, Policy)
+
+logger = logging.getLogger(__name__)
+
+DEEPGRAM_URL = os.getenv('DEEPGRAM_URL', "https://api.deepgram.com/v1/listen")
+DEEPGRAM_STREAM_URL = os.getenv(
+    'DEEPGRAM_STREAM_URL', "wss://api.deepgram.com/v1/listen")
+DEEPGRAM_OPTIONS = {
+    "model": "nova-2",  # Using their latest model
+    "smart_format": "true",  # Enable smart formatting
+    "language": "en",  # Set to English
+    "punctuate": "true",  # Add punctuation
+}
+
+ASSEMBLYAI_URL = os.getenv('ASSEMBLYAI_URL', "https://api.assemblyai.com/v2")
+ASSEMBLYAI_STREAM_URL = os.getenv(
+    'ASSEMBLYAI_STREAM_URL', "wss://api.assemblyai.com/v2/realtime/ws")
+ASSEMBLYAI_POLL_SECONDS = float(os.getenv('ASSEMBLYAI_POLL_SECONDS', 1.0))
+
+# Connections kept warm to each vendor, shared by every session in the process.
+STT_MAX_CONNECTIONS = int(os.getenv('STT_MAX_CONNECTIONS', 20))
+STT_KEEPALIVE_SECONDS = float(os.getenv('STT_KEEPALIVE_SECONDS', 120))
+
+# Every vendor request goes through its backend's policy. Deepgram uploads
+# up to STT_HEDGE_MAX_BYTES (short dictations and chunks) are hedged once
+# they run past the recent p95, since sending them twice costs little.
+STT_DEADLINE_SECONDS = float(os.getenv('STT_DEADLINE_SECONDS', 600))
+STT_ATTEMPT_TIMEOUT_SECONDS = float(
+    os.getenv('STT_ATTEMPT_TIMEOUT_SECONDS', 300))
+STT_MAX_RETRIES = int(os.getenv('STT_MAX_RETRIES', 2))
+STT_HEDGE = os.getenv('STT_HEDGE', '1') == '1'
+STT_HEDGE_MAX_BYTES = int(os.getenv('STT_HEDGE_MAX_BYTES', 2 * 1024 * 1024))
+
+STT_BACKENDS = [name.strip() for name in
+                os.getenv('STT_BACKENDS', 'deepgram,assemblyai').split(',')
+                if name.strip()]
+# Audio up to this long counts as a short dictation: it is raced across the
+# two best backends, and its latencies are tracked apart from long audio's.
+ROUTER_SHORT_SECONDS = float(os.getenv('STT_ROUTER_SHORT_SECONDS', 30))
+ROUTER_HEDGE = os.getenv('STT_ROUTER_HEDGE', '1') == '1'
+# Expected latency is scaled by 1 + penalty * recent error rate.
+ROUTER_ERROR_PENALTY = float(os.getenv('STT_ROUTER_ERROR_PENALTY', 4.0))
+# Share of requests sent to a random healthy backend to keep its stats fresh.
+ROUTER_EXPLORE_RATE = float(os.getenv('STT_ROUTER_EXPLORE_RATE', 0.05))
+ROUTER_MIN_SAMPLES = 5
+ROUTER_ERROR_WINDOW = 50
+
+SHORT = "short"
+LONG = "long"
+
+
+class TranscriptionError(RuntimeError):
+    """The vendor accepted the audio but could not transcribe it."""
+
+
+def http_retriable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status in (408, 429) or status >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def stream_retriable(error):
+    if isinstance(error, websockets.exceptions.InvalidStatus):
+        status = error.response.status_code
+        return status in (408, 429) or status >= 500
+    return isinstance(error, OSError)
+
+
+def upstream_retriable(error):
+    return http_retriable(error) or stream_retriable(error)
+
+
+# One policy per vendor, shared by every router in the process.
+DEEPGRAM_POLICY = Policy(
+    "deepgram",
+    deadline=STT_DEADLINE_SECONDS,
+    attempt_timeout=STT_ATTEMPT_TIMEOUT_SECONDS,
+    retriable=upstream_retriable,
+    max_retries=STT_MAX_RETRIES,
+    hedge=STT_HEDGE,
+    breaker=CircuitBreaker(failure_threshold=5, reset_seconds=30)
+)
+
+# AssemblyAI jobs aren't hedged: a duplicate job is billed like the first.
+# The policy wraps each upload, submit and poll request separately.
+ASSEMBLYAI_POLICY = Policy(
+    "assemblyai",
+    deadline=STT_DEADLINE_SECONDS,
+    attempt_timeout=STT_ATTEMPT_TIMEOUT_SECONDS,
+    retriable=upstream_retriable,
+    max_retries=STT_MAX_RETRIES,
+    breaker=CircuitBreaker(failure_threshold=5, reset_seconds=30)
+)
+
+
+async def create_client(api_key, max_connections=STT_MAX_CONNECTIONS,
+                        auth_scheme="Token", base_url=""):
+    """Pooled vendor client; create it on the loop that will use it"""
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers={"Authorization": f"{auth_scheme} {api_key}".strip()},
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=STT_KEEPALIVE_SECONDS
+        ),
+        timeout=httpx.Timeout(300.0, connect=10.0)
+    )
+
+
+class StreamSession:
+    """
+    A live transcription over one websocket. Send 16-bit mono PCM with
+    `send`, call `finish` once the audio ends, and iterate `results()` for
+    {"text", "is_final"} updates until the backend closes the session.
+    """
+
+    def __init__(self, ws, backend):
+        self.ws = ws
+        self.backend = backend
+
+    async def send(self, pcm):
+        await self.ws.send(self.encode(pcm))
+
+    async def finish(self):
+        await self.ws.send(json.dumps(self.finish_message()))
+
+    async def results(self):
+        try:
+            async for message in self.ws:
+                result = self.parse(json.loads(message))
+                if result is StopAsyncIteration:
+                    break
+                if result:
+                    yield result
+        finally:
+            await self.ws.close()
+
+    async def aclose(self):
+        await self.ws.close()
+
+    def encode(self, pcm):
+        raise NotImplementedError
+
+    def finish_message(self):
+        raise NotImplementedError
+
+    def parse(self, message):
+        """A result, None to skip the message, or StopAsyncIteration"""
+        raise NotImplementedError
+
+
+class TranscriptionBackend:
+    """
+    One speech-to-text vendor. `transcribe` returns {"transcript", "words"}
+    for a recording or chunk, with word times in seconds from its start;
+    `open_stream` starts a live `StreamSession`. All calls go through
+    `self.policy`, whose breaker and latencies the router reads.
+    """
+    name = None
+
+    def __init__(self, policy):
+        self.policy = policy
+
+    async def transcribe(self, audio_data, content_type="audio/wav",
+                         attempt_timeout=None):
+        raise NotImplementedError
+
+    async def open_stream(self, sample_rate=16000):
+        raise NotImplementedError
+
+    async def aclose(self):
+        pass
+
+    async def _connect(self, url, headers):
+        async def attempt(timeout):
+            return await websockets.connect(
+                url, additional_headers=headers, open_timeout=timeout,
+                ping_interval=5, ping_timeout=20)
+        return await self.policy.acall(attempt)
+
+
+def extract_words(alternative, offset=0.0):
+    return [
+        {
+            "word": w.get("punctuated_word", w["word"]),
+            "start": w["start"] + offset,
+            "end": w["end"] + offset
+        }
+        for w in alternative.get("words", [])
+    ]
+
+
+class DeepgramStream(StreamSession):
+    def encode(self, pcm):
+        return pcm
+
+    def finish_message(self):
+        return {"type": "CloseStream"}
+
+    def parse(self, message):
+        if message.get("type") != "Results":
+            return None
+        text = message["channel"]["alternatives"][0]["transcript"]
+        return {"text": text, "is_final": message.get("is_final", False)} \
+            if text else None
+
+
+class DeepgramBackend(TranscriptionBackend):
+    """Deepgram `nova-2`: prerecorded uploads and live websocket sessions"""
+    name = "deepgram"
+
+    def __init__(self, client, api_key):
+        super().__init__(DEEPGRAM_POLICY)
+        self.client = client
+        self.api_key = api_key
+
+    @timed("deepgram.request")
+    async def transcribe(self, audio_data, content_type="audio/wav",
+                         attempt_timeout=None):
+        async def attempt(timeout):
+            response = await self.client.post(
+                DEEPGRAM_URL,
+                params=DEEPGRAM_OPTIONS,
+                content=audio_data,
+                headers={"Content-Type": content_type},
+                timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0))
+            )
+            response.raise_for_status()
+
+            # Extract the best alternative from the response structure
+            return response.json()["results"]["channels"][0]["alternatives"][0]
+
+        alternative = await self.policy.acall(
+            attempt,
+            hedge=len(audio_data) <= STT_HEDGE_MAX_BYTES,
+            attempt_timeout=attempt_timeout
+        )
+        return {"transcript": alternative["transcript"],
+                "words": extract_words(alternative)}
+
+    async def open_stream(self, sample_rate=16000):
+        params = httpx.QueryParams({
+            **DEEPGRAM_OPTIONS, "encoding": "linear16",
+            "sample_rate": sample_rate, "channels": 1,
+            "interim_results": "true"
+        })
+        ws = await self._connect(f"{DEEPGRAM_STREAM_URL}?{params}",
+                                 {"Authorization": f"Token {self.api_key}"})
+        return DeepgramStream(ws, self.name)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class AssemblyAIStream(StreamSession):
+    def encode(self, pcm):
+        return json.dumps({"audio_data": base64.b64encode(pcm).decode()})
+
+    def finish_message(self):
+        return {"terminate_session": True}
+
+    def parse(self, message):
+        if "error" in message:
+            raise TranscriptionError(message["error"])
+        message_type = message.get("message_type")
+        if message_type == "SessionTerminated":
+            return StopAsyncIteration
+        if message_type in ("PartialTranscript", "FinalTranscript") and \
+                message["text"]:
+            return {"text": message["text"],
+                    "is_final": message_type == "FinalTranscript"}
+        return None
+
+
+class AssemblyAIBackend(TranscriptionBackend):
+    """
+    AssemblyAI: uploads are transcribed as asynchronous jobs that are
+    polled until done, so they carry a few seconds of queueing; live audio
+    goes over the realtime websocket.
+    """
+    name = "assemblyai"
+
+    def __init__(self, client, api_key):
+        super().__init__(ASSEMBLYAI_POLICY)
+        self.client = client
+        self.api_key = api_key
+
+    @timed("assemblyai.request")
+    async def transcribe(self, audio_data, content_type="audio/wav",
+                         attempt_timeout=None):
+        # Each request is retried on its own: retrying the whole sequence
+        # would upload the audio again and start a second, billed job.
+        async def request(method, url, **kwargs):
+            async def attempt(timeout):
+                response = await self.client.request(
+                    method, url, **kwargs,
+                    timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)))
+                response.raise_for_status()
+                return response.json()
+            return await self.policy.acall(
+                attempt, attempt_timeout=attempt_timeout)
+
+        upload = await request(
+            "POST", "/upload", content=audio_data,
+            headers={"Content-Type": "application/octet-stream"})
+        submitted = await request(
+            "POST", "/transcript",
+            json={"audio_url": upload["upload_url"], "punctuate": True,
+                  "format_text": True, "language_code": "en"})
+
+        ready_by = time.monotonic() + (attempt_timeout or self.policy.deadline)
+        while True:
+            if time.monotonic() >= ready_by:
+                raise DeadlineExceeded(
+                    f"assemblyai transcript {submitted['id']} not ready")
+            await asyncio.sleep(ASSEMBLYAI_POLL_SECONDS)
+            job = await request("GET", f"/transcript/{submitted['id']}")
+            if job["status"] == "completed":
+                break
+            if job["status"] == "error":
+                raise TranscriptionError(job.get("error"))
+
+        return {
+            "transcript": job["text"] or "",
+            "words": [
+                {"word": w["text"], "start": w["start"] / 1000,
+                 "end": w["end"] / 1000}
+                for w in job.get("words") or []
+            ]
+        }
+
+    async def open_stream(self, sample_rate=16000):
+        ws = await self._connect(
+            f"{ASSEMBLYAI_STREAM_URL}?sample_rate={sample_rate}",
+            {"Authorization": self.api_key})
+        return AssemblyAIStream(ws, self.name)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class BackendStats:
+    """Rolling latencies per audio length class, and recent outcomes"""
+
+    def __init__(self):
+        self.latency = {SHORT: LatencyWindow(), LONG: LatencyWindow()}
+        self.outcomes = deque(maxlen=ROUTER_ERROR_WINDOW)
+        self._lock = threading.Lock()
+
+    def record(self, length, elapsed=None):
+        """A success taking `elapsed` seconds, or a failure if None"""
+        if elapsed is not None:
+            self.latency[length].add(elapsed)
+        self.record_outcome(elapsed is not None)
+
+    def record_outcome(self, ok):
+        with self._lock:
+            self.outcomes.append(ok)
+
+    def error_rate(self):
+        with self._lock:
+            if not self.outcomes:
+                return 0.0
+            return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def expected_latency(self, length):
+        """Median latency scaled by the error rate; None until measured"""
+        median = self.latency[length].quantile(
+            0.5, min_samples=ROUTER_MIN_SAMPLES)
+        if median is None:
+            return None
+        return median * (1 + ROUTER_ERROR_PENALTY * self.error_rate())
+
+
+class STTRouter:
+    """
+    Sends each request to the backend expected to answer first and fails
+    over down the ranking. Stats are per process, so every API, app and
+    worker process routes on what it has seen itself.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.stats = {backend.name: BackendStats() for backend in backends}
+
+    def rank(self, audio_seconds=None):
+        """
+        Backends in the order to try them: open circuits last, then
+        measured backends by expected latency for audio of this length,
+        then unmeasured ones by error rate and configured order. Now and
+        then a random healthy backend is tried first to refresh its stats.
+        """
+        length = self.length(audio_seconds)
+
+        def key(backend):
+            stats = self.stats[backend.name]
+            expected = stats.expected_latency(length)
+            return (not backend.policy.breaker.available(), expected is None,
+                    expected or 0.0, stats.error_rate())
+
+        ranked = sorted(self.backends, key=key)
+        healthy = [b for b in ranked if b.policy.breaker.available()]
+        if len(healthy) > 1 and random.random() < ROUTER_EXPLORE_RATE:
+            chosen = random.choice(healthy[1:])
+            ranked.remove(chosen)
+            ranked.insert(0, chosen)
+        return ranked
+
+    def length(self, audio_seconds):
+        # Undecodable audio has no known length; treat it as long.
+        if audio_seconds and audio_seconds <= ROUTER_SHORT_SECONDS:
+            return SHORT
+        return LONG
+
+    async def transcribe(self, audio_data, content_type="audio/wav",
+                         audio_seconds=None, attempt_timeout=None):
+        """Transcribe with the best backend; {"transcript", "words"}"""
+        ranked = self.rank(audio_seconds)
+        length = self.length(audio_seconds)
+        args = (audio_data, content_type, length, attempt_timeout)
+        if length == SHORT and ROUTER_HEDGE and len(ranked) > 1 and \
+                ranked[1].policy.breaker.available():
+            return await self._race(ranked, *args)
+        return await self._failover(ranked, *args)
+
+    async def _attempt(self, backend, audio_data, content_type, length,
+                       attempt_timeout):
+        start = time.monotonic()
+        try:
+            result = await backend.transcribe(
+                audio_data, content_type, attempt_timeout=attempt_timeout)
+        except CircuitOpenError:
+            # Nothing was sent; the open circuit already ranks it last.
+            raise
+        except Exception:
+            self.stats[backend.name].record(length)
+            increment("stt_router_failures_total", backend=backend.name)
+            raise
+        self.stats[backend.name].record(length, time.monotonic() - start)
+        increment("stt_router_requests_total", backend=backend.name,
+                  length=length)
+        return result
+
+    async def _failover(self, backends, *args, error=None):
+        for backend in backends:
+            if error is not None:
+                increment("stt_router_failovers_total", backend=backend.name)
+            try:
+                return await self._attempt(backend, *args)
+            except Exception as e:
+                logger.warning("%s transcription failed: %s", backend.name, e)
+                error = e
+        if error is None:
+            raise RuntimeError("No speech-to-text backend is configured")
+        raise error
+
+    async def _race(self, ranked, *args):
+        """
+        Start the best backend; if it hasn't answered by its p95 for short
+        audio, start the runner-up too and take whichever returns first.
+        """
+        length = args[2]
+        delay = self.stats[ranked[0].name].latency[length].quantile(0.95)
+        if delay is None:
+            return await self._failover(ranked, *args)
+
+        tasks = [asyncio.ensure_future(self._attempt(ranked[0], *args))]
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            increment("stt_router_hedges_total", backend=ranked[1].name)
+            tasks.append(asyncio.ensure_future(
+                self._attempt(ranked[1], *args)))
+
+        error = None
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception as e:
+                    error = e
+        finally:
+            # The slower vendor is still holding a connection; let it go.
+            for task in tasks:
+                task.cancel()
+        return await self._failover(ranked[len(tasks):], *args, error=error)
+
+    async def open_stream(self, sample_rate=16000):
+        """Open a live session on the healthiest backend that connects"""
+        error = None
+        for backend in self.rank():
+            try:
+                session = await backend.open_stream(sample_rate)
+            except Exception as e:
+                logger.warning("%s stream failed to open: %s", backend.name, e)
+                if not isinstance(e, CircuitOpenError):
+                    self.stats[backend.name].record_outcome(False)
+                error = e
+                continue
+            self.stats[backend.name].record_outcome(True)
+            return session
+        raise error or RuntimeError("No speech-to-text backend is configured")
+
+    def status(self):
+        """Per-backend routing stats and policy counters, for dashboards"""
+        return {
+            backend.name: {
+                **backend.policy.stats(),
+                "error_rate": round(self.stats[backend.name].error_rate(), 3),
+                "short_p50_seconds": self.stats[backend.name]
+                .latency[SHORT].quantile(0.5, min_samples=ROUTER_MIN_SAMPLES),
+                "long_p50_seconds": self.stats[backend.name]
+                .latency[LONG].quantile(0.5, min_samples=ROUTER_MIN_SAMPLES),
+            }
+            for backend in self.backends
+        }
+
+    async def aclose(self):
+        for backend in self.backends:
+            await backend.aclose()
+
+
+async def create_router(deepgram_api_key=None, assemblyai_api_key=None,
+                        max_connections=STT_MAX_CONNECTIONS, order=None):
+    """
+    Router over every backend in `order` (STT_BACKENDS) that has an API
+    key; create it on the loop that will use it.
+    """
+    keys = {
+        "deepgram": deepgram_api_key or os.getenv('DEEPGRAM_API_KEY'),
+        "assemblyai": assemblyai_api_key or os.getenv('ASSEMBLYAI_API_KEY')
+    }
+    backends = []
+    for name in order or STT_BACKENDS:
+        if name not in keys:
+            raise ValueError(f"Unknown speech-to-text backend: {name}")
+        if not keys[name]:
+            continue
+        if name == "deepgram":
+            client = await create_client(keys[name], max_connections)
+            backends.append(DeepgramBackend(client, keys[name]))
+        else:
+            client = await create_client(
+                keys[name], max_connections, auth_scheme="",
+                base_url=ASSEMBLYAI_URL)
+            backends.append(AssemblyAIBackend(client, keys[name]))
+    if not backends:
+        raise RuntimeError("No speech-to-text backend is configured")
+    return STTRouter(backends)
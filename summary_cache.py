@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+
+import streamlit as st
+from pymongo.errors import PyMongoError
+
+from cache import LRUCache
+
+SUMMARY_CACHE_SIZE = int(os.getenv('SUMMARY_CACHE_SIZE', 512))
+SUMMARY_CACHE_TTL_SECONDS = int(
+    os.getenv('SUMMARY_CACHE_TTL_SECONDS', 30 * 24 * 3600))
+
+
+def summary_key(transcript, system_prompt, model):
+    payload = json.dumps([model, system_prompt, transcript])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SummaryCache:
+    """
+    Two-tier cache of generated summaries keyed by (transcript, prompt,
+    model): an in-process LRU in front of the `summary_cache` collection,
+    whose documents Mongo expires via a TTL index on `created_at` (see
+    migrations.py).
+    """
+
+    def __init__(self, db, maxsize=SUMMARY_CACHE_SIZE,
+                 ttl_seconds=SUMMARY_CACHE_TTL_SECONDS):
+        self.collection = db.summary_cache
+        self.memory = LRUCache(maxsize=maxsize, ttl=ttl_seconds)
+        self.db_hits = 0
+        self.db_misses = 0
+
+    def get(self, transcript, system_prompt, model):
+        key = summary_key(transcript, system_prompt, model)
+        summary = self.memory.get(key)
+        if summary is not None:
+            return summary
+
+        try:
+            doc = self.collection.find_one({"_id": key}, {"summary": 1})
+        except PyMongoError:
+            doc = None
+        if doc is None:
+            self.db_misses += 1
+            return None
+
+        self.db_hits += 1
+        self.memory.set(key, doc["summary"])
+        return doc["summary"]
+
+    def put(self, transcript, system_prompt, model, summary):
+        key = summary_key(transcript, system_prompt, model)
+        self.memory.set(key, summary)
+        try:
+            self.collection.replace_one(
+                {"_id": key},
+                {"summary": summary, "model": model,
+                 "created_at": datetime.now()},
+                upsert=True
+            )
+        except PyMongoError:
+            # The persisted tier is best-effort; the summary itself is fine.
+            pass
+
+    def stats(self):
+        memory = self.memory.stats()
+        return {
+            "memory_hits": memory["hits"],
+            "db_hits": self.db_hits,
+            "misses": self.db_misses,
+            "memory_size": memory["size"]
+        }
+
+
+@st.cache_resource
+def get_summary_cache(_db):
+    return SummaryCache(_db)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from audio import speech_frames, trim_silence
+
+RATE = 16000
+
+
+def noise(seconds, level, seed=0):
+    return np.random.default_rng(seed).normal(0, level, int(seconds * RATE))
+
+
+def test_continuous_speech_is_kept():
+    # A dictation without pauses has no quiet frames to take a noise floor
+    # from; it used to be trimmed to nothing.
+    mono = noise(10, 2500)
+    trimmed, _ = trim_silence(mono, RATE)
+    assert len(trimmed) / RATE > 9.5
+
+
+def test_silence_is_dropped():
+    speech, _ = speech_frames(noise(5, 20), RATE)
+    assert not speech.any()
+
+
+def test_long_pauses_are_shortened():
+    mono = np.concatenate([
+        noise(1, 20, seed=1), noise(3, 2500, seed=2),
+        noise(5, 20, seed=3), noise(3, 2500, seed=4),
+        noise(1, 20, seed=5)
+    ])
+    trimmed, time_map = trim_silence(mono, RATE)
+    assert 6 < len(trimmed) / RATE < 8
+    # The second stretch of speech starts at 9 s in the original.
+    assert abs(time_map.to_original(len(trimmed) / RATE - 3) - 9) < 0.5
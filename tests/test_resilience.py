@@ -0,0 +1,211 @@
+import asyncio
+import time
+
+import pytest
+
+from resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    Policy
+)
+
+
+def retriable(error):
+    return isinstance(error, ConnectionError)
+
+
+def policy(**kwargs):
+    settings = dict(deadline=5.0, attempt_timeout=1.0, retriable=retriable,
+                    base_delay=0.001, max_delay=0.001)
+    settings.update(kwargs)
+    return Policy("test", **settings)
+
+
+class Flaky:
+    """Raises the given errors in turn, then returns "ok" """
+
+    def __init__(self, *errors, delay=0.0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, timeout):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+
+def test_retries_retriable_errors():
+    p = policy(max_retries=2)
+    fn = Flaky(ConnectionError(), ConnectionError())
+    assert p.call(fn) == "ok"
+    assert fn.calls == 3
+    assert p.stats()["retries"] == 2
+
+
+def test_gives_up_after_max_retries():
+    p = policy(max_retries=1)
+    fn = Flaky(ConnectionError(), ConnectionError())
+    with pytest.raises(ConnectionError):
+        p.call(fn)
+    assert fn.calls == 2
+
+
+def test_does_not_retry_client_errors():
+    p = policy()
+    fn = Flaky(ValueError("bad request"))
+    with pytest.raises(ValueError):
+        p.call(fn)
+    assert fn.calls == 1
+    # The upstream answered, so it doesn't count against the circuit.
+    assert p.breaker.failures == 0
+
+
+def test_deadline_stops_retries():
+    p = policy(deadline=0.05, max_retries=10, base_delay=0.02, max_delay=0.02)
+    fn = Flaky(*[ConnectionError()] * 10, delay=0.02)
+    with pytest.raises((ConnectionError, DeadlineExceeded)):
+        p.call(fn)
+    assert fn.calls < 5
+    assert p.stats()["deadline_exceeded"] == 1
+
+
+def test_attempt_timeout_is_capped_by_deadline():
+    p = policy(deadline=0.5, attempt_timeout=10.0)
+    timeouts = []
+    p.call(lambda timeout: timeouts.append(timeout))
+    assert timeouts[0] <= 0.5
+
+
+def prime_latency(p, seconds, samples=20):
+    for _ in range(samples):
+        p.latency.add(seconds)
+
+
+def test_hedge_wins_over_slow_attempt():
+    p = policy(hedge=True, hedge_min_delay=0.01)
+    prime_latency(p, 0.02)
+    delays = iter([1.0, 0.0])
+
+    def fn(timeout):
+        time.sleep(next(delays))
+        return "ok"
+
+    start = time.monotonic()
+    assert p.call(fn, hedge=True) == "ok"
+    assert time.monotonic() - start < 0.5
+    assert p.stats()["hedges"] == 1
+    assert p.stats()["hedge_wins"] == 1
+
+
+def test_no_hedge_without_latency_history():
+    p = policy(hedge=True)
+    fn = Flaky()
+    assert p.call(fn, hedge=True) == "ok"
+    assert fn.calls == 1
+    assert "hedges" not in p.stats()
+
+
+def test_async_hedge_cancels_loser():
+    p = policy(hedge=True, hedge_min_delay=0.01)
+    prime_latency(p, 0.02)
+    delays = iter([1.0, 0.0])
+    cancelled = []
+
+    async def fn(timeout):
+        try:
+            await asyncio.sleep(next(delays))
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return "ok"
+
+    async def run():
+        result = await p.acall(fn, hedge=True)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "ok"
+    assert cancelled == [True]
+    assert p.stats()["hedge_wins"] == 1
+
+
+def test_circuit_opens_and_rejects():
+    p = policy(max_retries=0,
+               breaker=CircuitBreaker(failure_threshold=2, reset_seconds=60))
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            p.call(Flaky(ConnectionError()))
+    assert p.breaker.state == OPEN
+    fn = Flaky()
+    with pytest.raises(CircuitOpenError):
+        p.call(fn)
+    assert fn.calls == 0
+
+
+def open_breaker(reset_seconds=0.05):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=reset_seconds)
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    return breaker
+
+
+def test_half_open_trial_closes_on_success():
+    breaker = open_breaker()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only one trial at a time.
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_trial_failure_reopens():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+
+
+def test_half_open_trial_expires():
+    breaker = open_breaker()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.available()
+    time.sleep(0.06)
+    # The trial never reported back; another call may try.
+    assert breaker.available()
+    assert breaker.allow()
+
+
+def test_cancelled_half_open_trial_releases_circuit():
+    p = policy(breaker=open_breaker(reset_seconds=0.05))
+    time.sleep(0.06)
+
+    async def slow(timeout):
+        await asyncio.sleep(10)
+
+    async def fast(timeout):
+        return "ok"
+
+    async def run():
+        trial = asyncio.ensure_future(p.acall(slow))
+        await asyncio.sleep(0.01)
+        assert p.breaker.state == HALF_OPEN
+        trial.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await trial
+        return await p.acall(fast)
+
+    assert asyncio.run(run()) == "ok"
+    assert p.breaker.state == CLOSED
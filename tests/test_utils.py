@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import pytest
+
+import utils
+
+
+@pytest.fixture
+def offline_tiktoken(monkeypatch):
+    """tiktoken installed, but its encoding can't be downloaded"""
+    def unavailable(model):
+        raise ConnectionError("no network")
+
+    monkeypatch.setattr(utils, "tiktoken",
+                        SimpleNamespace(encoding_for_model=unavailable))
+    utils._encoding.cache_clear()
+    yield
+    utils._encoding.cache_clear()
+
+
+def test_count_tokens_estimates_when_encoding_unavailable(offline_tiktoken):
+    assert utils.count_tokens("a" * 400) == 100
+
+
+def test_get_summary_works_when_encoding_unavailable(offline_tiktoken,
+                                                     monkeypatch):
+    sent = []
+
+    def chat_completion(messages, stream=False, hedge=True):
+        sent.append(messages)
+        message = SimpleNamespace(content="Summary.")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(utils, "chat_completion", chat_completion)
+    assert utils.get_summary("Patient reports a cough.", "Summarize.") == \
+        "Summary."
+    assert "Patient reports a cough." in sent[0][-1]["content"]
+
+
+def test_split_transcript_works_when_encoding_unavailable(offline_tiktoken):
+    transcript = "The patient has a cough. " * 200
+    chunks = utils.split_transcript(transcript, max_tokens=100)
+    assert len(chunks) > 1
+    assert all(utils.count_tokens(chunk) <= 100 for chunk in chunks)
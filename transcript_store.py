@@ -0,0 +1,207 @@
+"""Compressed transcripts, kept out of the hot `recordings` collection.
+
+Each transcript is one document in `transcripts` with the recording's id,
+compressed with zstd when the `zstandard` package is installed and zlib
+otherwise (TRANSCRIPT_CODEC picks one explicitly). Documents record their
+codec, so both kinds can be read back whichever is configured now.
+
+    python transcript_store.py report [--sample 200]
+
+prints the stored size, compression ratio and compress/decompress latency
+of each available codec on a sample of stored transcripts.
+"""
+import argparse
+import os
+import time
+import zlib
+from datetime import datetime
+
+from bson.binary import Binary
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+TRANSCRIPT_CODEC = os.getenv('TRANSCRIPT_CODEC', ZSTD if zstandard else ZLIB)
+TRANSCRIPT_ZLIB_LEVEL = int(os.getenv('TRANSCRIPT_ZLIB_LEVEL', 6))
+TRANSCRIPT_ZSTD_LEVEL = int(os.getenv('TRANSCRIPT_ZSTD_LEVEL', 3))
+
+
+def compress(text, codec=TRANSCRIPT_CODEC):
+    data = text.encode("utf-8")
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("TRANSCRIPT_CODEC=zstd needs `zstandard`")
+        return zstandard.ZstdCompressor(
+            level=TRANSCRIPT_ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, TRANSCRIPT_ZLIB_LEVEL)
+
+
+def decompress(data, codec):
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("Transcript is zstd-compressed; "
+                               "install `zstandard` to read it")
+        return zstandard.ZstdDecompressor().decompress(data).decode("utf-8")
+    return zlib.decompress(data).decode("utf-8")
+
+
+class TranscriptStore:
+    """
+    Transcripts in the `transcripts` collection, keyed by recording id.
+    Writes can carry the recording's version, so a slow writer never
+    replaces the transcript of a newer edit.
+    """
+
+    def __init__(self, db, codec=TRANSCRIPT_CODEC):
+        self.transcripts = db.transcripts
+        self.codec = codec
+
+    def _document(self, text, version=None):
+        text = text or ""
+        data = compress(text, self.codec)
+        document = {
+            "data": Binary(data),
+            "codec": self.codec,
+            "size": len(text.encode("utf-8")),
+            "stored_size": len(data),
+            "updated_at": datetime.now()
+        }
+        if version is not None:
+            document["version"] = version
+        return document
+
+    def put(self, recording_id, text, version=None):
+        recording_id = ObjectId(recording_id)
+        query = {"_id": recording_id}
+        if version is not None:
+            query["version"] = {"$not": {"$gt": version}}
+        try:
+            self.transcripts.update_one(
+                query, {"$set": self._document(text, version)}, upsert=True)
+        except DuplicateKeyError:
+            # A newer version is already stored; the upsert collided with it.
+            pass
+
+    def put_many(self, texts):
+        """Store {recording_id: text} with one bulk write"""
+        if not texts:
+            return
+        self.transcripts.bulk_write([
+            UpdateOne({"_id": ObjectId(recording_id)},
+                      {"$set": self._document(text)}, upsert=True)
+            for recording_id, text in texts.items()
+        ], ordered=False)
+
+    def get(self, recording_id):
+        document = self.transcripts.find_one(
+            {"_id": ObjectId(recording_id)}, {"data": 1, "codec": 1})
+        return decompress(document["data"], document["codec"]) \
+            if document else None
+
+    def get_many(self, recording_ids):
+        """{recording_id: text} for the given ids, in one query"""
+        return {
+            document["_id"]: decompress(document["data"], document["codec"])
+            for document in self.transcripts.find(
+                {"_id": {"$in": [ObjectId(i) for i in recording_ids]}},
+                {"data": 1, "codec": 1})
+        }
+
+    def delete(self, recording_id):
+        self.transcripts.delete_one({"_id": ObjectId(recording_id)})
+
+    def report(self, sample=200, repeat=5):
+        """Sizes of everything stored, and codec timings on a sample"""
+        totals = next(self.transcripts.aggregate([{"$group": {
+            "_id": None,
+            "count": {"$sum": 1},
+            "size": {"$sum": "$size"},
+            "stored_size": {"$sum": "$stored_size"}
+        }}]), {"count": 0, "size": 0, "stored_size": 0})
+
+        texts = [
+            decompress(document["data"], document["codec"])
+            for document in self.transcripts.find(
+                {}, {"data": 1, "codec": 1}).limit(sample)
+        ]
+        codecs = [ZLIB] + ([ZSTD] if zstandard else [])
+        timings = {}
+        for codec in codecs:
+            compressed = [compress(text, codec) for text in texts]
+            timings[codec] = {
+                "ratio": sum(len(t.encode("utf-8")) for t in texts) /
+                max(sum(map(len, compressed)), 1),
+                "compress_ms": _per_item_ms(
+                    lambda: [compress(text, codec) for text in texts],
+                    len(texts), repeat),
+                "decompress_ms": _per_item_ms(
+                    lambda: [decompress(data, codec) for data in compressed],
+                    len(texts), repeat)
+            }
+        return {
+            "transcripts": totals["count"],
+            "size": totals["size"],
+            "stored_size": totals["stored_size"],
+            "ratio": totals["size"] / max(totals["stored_size"], 1),
+            "sample": len(texts),
+            "codecs": timings
+        }
+
+
+def _per_item_ms(fn, items, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000 / max(items, 1)
+
+
+def collection_size(db, name):
+    """(documents, average document bytes) of a collection, if available"""
+    try:
+        stats = db.command("collStats", name)
+    except Exception:
+        return None
+    return stats.get("count", 0), stats.get("avgObjSize", 0)
+
+
+def main():
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report = subparsers.add_parser("report")
+    report.add_argument("--sample", type=int, default=200)
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = MongoClient(os.getenv('MONGO_URI'))['scriber']
+    result = TranscriptStore(db).report(sample=args.sample)
+
+    print(f"{result['transcripts']} transcripts: "
+          f"{result['size'] / 1e6:.1f} MB -> "
+          f"{result['stored_size'] / 1e6:.1f} MB stored "
+          f"({result['ratio']:.1f}x, codec {TRANSCRIPT_CODEC})")
+    for name in ("recordings", "transcripts"):
+        size = collection_size(db, name)
+        if size:
+            print(f"{name}: {size[0]} documents, {size[1]:.0f} bytes average")
+    print(f"Codecs on a sample of {result['sample']}:")
+    for codec, timing in result["codecs"].items():
+        print(f"  {codec}: {timing['ratio']:.1f}x, "
+              f"compress {timing['compress_ms']:.3f} ms, "
+              f"decompress {timing['decompress_ms']:.3f} ms per transcript")
+
+
+if __name__ == "__main__":
+    main()
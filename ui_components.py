@@ -1,10 +1,18 @@
 import streamlit as st
 from datetime import datetime
-from utils import get_summary
+from utils import stream_summary_to_db
+from summary_cache import get_summary_cache
 import re
 import clipboard
+import jobs
+import resummarize
+from audio_store import AudioStore
+from autosave import Autosave
+from metrics import timed
+from resummarize import BatchResummarizer
 
 
+@timed("ui.render_sidebar")
 def render_sidebar(db_manager):
     # Initialize copied list in session state if it doesn't exist
     if 'copied' not in st.session_state:
@@ -12,6 +20,7 @@ def render_sidebar(db_manager):
 
     with st.sidebar:
         if st.button("Logout"):
+            flush_edits(db_manager, force=True)
             st.session_state.authenticated = False
             st.rerun()
 
@@ -20,6 +29,7 @@ def render_sidebar(db_manager):
         render_system_prompts(db_manager)
 
 
+@timed("ui.render_patient_selection")
 def render_patient_selection(db_manager):
     st.header("Patient Selection")
     patients = db_manager.get_all_patients(st.session_state.provider_id)
@@ -33,6 +43,7 @@ def render_patient_selection(db_manager):
     render_new_patient_form(db_manager)
 
 
+@timed("ui.render_system_prompts")
 def render_system_prompts(db_manager):
     st.divider()
     with st.expander("Select System Prompt", expanded=False):
@@ -73,32 +84,307 @@ def render_system_prompts(db_manager):
                     st.success("New prompt template added!")
                     st.rerun()
 
+    with st.expander("Rewrite Past Visits", expanded=False):
+        scopes = ["All patients"]
+        if st.session_state.get("selected_patient_id"):
+            scopes.insert(0, "Selected patient")
+        scope = st.radio("Visits to rewrite", scopes)
+        st.caption(f"Summaries will be regenerated with "
+                   f"\"{selected_prompt_name}\".")
+        if st.button("Rewrite visits"):
+            patient_id = (st.session_state.selected_patient_id
+                          if scope == "Selected patient" else None)
+            batch_id = BatchResummarizer(db_manager).create(
+                st.session_state.provider_id,
+                selected_prompt_name,
+                updated_prompt,
+                patient_id
+            )
+            st.session_state.setdefault('pending_batches', []).append(batch_id)
+            st.success("Visits queued for rewriting")
+
     with st.sidebar:
         st.divider()
         st.markdown("**Current Prompt Template:**")
         st.info(selected_prompt_name)
+        stats = get_summary_cache(db_manager.db).stats()
+        st.caption(
+            f"Summary cache: {stats['memory_hits'] + stats['db_hits']} hits, "
+            f"{stats['misses']} misses")
 
 
+@timed("ui.render_recording_section")
 def render_recording_section(saved_data, db_manager):
+    recording_id = str(saved_data["_id"])
+    key = ("recording", recording_id)
+    widget_keys = [f"transcript_{recording_id}", f"summary_{recording_id}"]
+    # Pick up changes written elsewhere (worker, rewrite, another tab)
+    # unless this session is still editing the visit.
+    if get_autosave().track(key, saved_data.get("version", 0)):
+        for widget_key in widget_keys:
+            st.session_state.pop(widget_key, None)
+    render_edit_conflict(key, db_manager, widget_keys)
+    render_audio_player(saved_data, db_manager)
     render_transcript_column(saved_data, db_manager)
     render_summary_column(saved_data, db_manager)
 
 
+RECORDINGS_PAGE_SIZE = 20
+
+
+@timed("ui.render_visit_records")
 def render_visit_records(db_manager):
     st.header("Visit Records")
-    recordings = db_manager.get_patient_recordings(
-        st.session_state.selected_patient_id,
-        st.session_state.provider_id
-    )
+
+    # Number of pages loaded is tracked per patient; each page is a small
+    # projection-only query, and bodies are loaded only for the selection.
+    pages_key = f"visit_pages_{st.session_state.selected_patient_id}"
+    if pages_key not in st.session_state:
+        st.session_state[pages_key] = 1
+
+    # A visit opened from search may be older than the pages loaded so far.
+    target = st.session_state.pop('open_recording_id', None)
+
+    recordings = []
+    cursor = None
+    pages = 0
+    found = target is None
+    while True:
+        page, cursor = db_manager.list_recordings(
+            st.session_state.selected_patient_id,
+            st.session_state.provider_id,
+            limit=RECORDINGS_PAGE_SIZE,
+            before=cursor
+        )
+        recordings.extend(page)
+        pages += 1
+        found = found or any(str(r["_id"]) == target for r in page)
+        if cursor is None or (found and pages >= st.session_state[pages_key]):
+            break
+    st.session_state[pages_key] = pages
+
+    if target and found:
+        st.session_state.visit_recording_selector = target
 
     if recordings:
         render_recording_selector(recordings, db_manager)
+        if cursor is not None and st.button("Load older visits"):
+            st.session_state[pages_key] += 1
+            st.rerun()
     else:
         st.info("No recordings found for this patient")
 
+
+SEARCH_PAGE_SIZE = 10
+
+
+@timed("ui.render_search")
+def render_search(db_manager):
+    query = st.text_input("Search visits", placeholder="e.g. metformin",
+                          key="search_query")
+    if not query:
+        return
+
+    # Start from the first page whenever the query changes.
+    if st.session_state.get("search_last_query") != query:
+        st.session_state.search_last_query = query
+        st.session_state.search_page = 0
+    page = st.session_state.search_page
+
+    results = db_manager.search_recordings(
+        st.session_state.provider_id, query, page, SEARCH_PAGE_SIZE)
+    if not results["total"]:
+        st.info("No visits match your search")
+        return
+
+    patients = {
+        patient_id: f"{first_name} {last_name}"
+        for first_name, last_name, patient_id in db_manager.get_all_patients(
+            st.session_state.provider_id)
+    }
+    first = page * SEARCH_PAGE_SIZE + 1
+    st.caption(f"Showing {first}-{first + len(results['results']) - 1} "
+               f"of {results['total']} visits")
+
+    for hit in results["results"]:
+        patient_name = patients.get(hit["patient_id"], "Unknown patient")
+        with st.container(border=True):
+            info_col, open_col = st.columns([0.85, 0.15])
+            with info_col:
+                st.markdown(
+                    f"**{patient_name}** · "
+                    f"{hit['timestamp'].strftime('%Y-%m-%d %H:%M')}")
+                if hit["snippet"]:
+                    st.markdown(hit["snippet"])
+            with open_col:
+                st.button("Open", key=f"search_open_{hit['recording_id']}",
+                          on_click=open_search_result,
+                          args=(hit, patient_name))
+
+    prev_col, next_col = st.columns(2)
+    with prev_col:
+        if page > 0 and st.button("Previous results"):
+            st.session_state.search_page -= 1
+            st.rerun()
+    with next_col:
+        if first + SEARCH_PAGE_SIZE - 1 < results["total"] and \
+                st.button("More results"):
+            st.session_state.search_page += 1
+            st.rerun()
+
+
+def open_search_result(hit, patient_name):
+    first_name, last_name = split_patient_name(patient_name)
+    st.session_state.selected_patient = patient_name
+    st.session_state.first_name = first_name
+    st.session_state.last_name = last_name
+    st.session_state.selected_patient_id = hit["patient_id"]
+    st.session_state.open_recording_id = hit["recording_id"]
+
+
+JOB_STATE_LABELS = {
+    jobs.QUEUED: "Waiting for a worker...",
+    jobs.TRANSCRIBING: "Transcribing audio...",
+    jobs.SUMMARIZING: "Generating summary...",
+}
+
+
+@st.fragment(run_every=2)
+@timed("ui.render_job_status")
+def render_job_status(job_queue, db_manager):
+    pending = st.session_state.get('pending_jobs', [])
+    if not pending:
+        return
+
+    still_pending = []
+    finished = False
+    for job in job_queue.get_jobs(pending):
+        queued_at = job["created_at"].strftime("%H:%M")
+        if job["state"] in jobs.ACTIVE_STATES:
+            still_pending.append(str(job["_id"]))
+            st.info(f"Recording from {queued_at}: "
+                    f"{JOB_STATE_LABELS[job['state']]}")
+            if job["state"] == jobs.SUMMARIZING and job["recording_id"]:
+                partial = db_manager.load_recording_data(
+                    job["recording_id"], transcript=False)
+                if partial and partial["summary"]:
+                    st.markdown(partial["summary"])
+        elif job["state"] == jobs.FAILED:
+            st.toast(f"Recording from {queued_at} failed: {job['error']}",
+                     icon="🚨")
+        else:
+            st.session_state.current_file = job["recording_id"]
+            st.toast(f"Recording from {queued_at} saved successfully!")
+            # The worker wrote the recording from another process.
+            db_manager.query_cache.invalidate("recordings", job["patient_id"])
+            finished = True
+
+    st.session_state.pending_jobs = still_pending
+    if finished:
+        # Rerun the whole page so Visit Records picks up the new recording;
+        # the recorder's stale audio is skipped by its content hash.
+        st.rerun()
+
+
+@st.fragment(run_every=2)
+@timed("ui.render_batch_status")
+def render_batch_status(db_manager):
+    pending = st.session_state.get('pending_batches', [])
+    if not pending:
+        return
+
+    resummarizer = BatchResummarizer(db_manager)
+    still_pending = []
+    for batch in resummarizer.get_batches(pending):
+        batch_id = str(batch["_id"])
+        failed = len(batch["failed_ids"])
+        if batch["state"] in resummarize.ACTIVE_STATES:
+            still_pending.append(batch_id)
+            progress_col, cancel_col = st.columns([0.85, 0.15])
+            with progress_col:
+                st.progress(
+                    (batch["done"] + failed) / max(batch["total"], 1),
+                    text=f"Rewriting visits with \"{batch['prompt_name']}\": "
+                         f"{batch['done']} of {batch['total']}")
+            with cancel_col:
+                if st.button("Cancel", key=f"cancel_batch_{batch_id}"):
+                    resummarizer.cancel(batch_id)
+        elif batch["state"] == resummarize.DONE:
+            message = f"Rewrote {batch['done']} visits"
+            if failed:
+                message += f" ({failed} failed)"
+            st.toast(message)
+
+    st.session_state.pending_batches = still_pending
+
+
+def get_autosave():
+    if 'autosave' not in st.session_state:
+        st.session_state.autosave = Autosave()
+    return st.session_state.autosave
+
+
+def save_edits(db_manager):
+    """Field-level, version-checked writer for Autosave.flush"""
+    def save(key, fields, version):
+        kind, document_id = key
+        if kind == "notes":
+            return db_manager.update_patient_notes(
+                document_id, fields["notes"], version)
+        return db_manager.patch_recording(document_id, fields, version)
+    return save
+
+
+def flush_edits(db_manager, force=False):
+    return get_autosave().flush(save_edits(db_manager), force=force)
+
+
+@st.fragment(run_every=1)
+@timed("ui.render_autosave")
+def render_autosave(db_manager):
+    if not get_autosave().pending:
+        return
+    try:
+        saved, conflicted = flush_edits(db_manager)
+    except Exception as e:
+        st.error(f"Error saving changes: {str(e)}")
+        return
+    if saved:
+        st.toast("Changes saved")
+    if conflicted:
+        # Show the conflict next to the text it concerns.
+        st.rerun(scope="app")
+
+
+@timed("ui.render_edit_conflict")
+def render_edit_conflict(key, db_manager, widget_keys):
+    if key not in get_autosave().conflicts:
+        return
+    st.warning("This was changed elsewhere while you were editing, so your "
+               "last edits weren't saved.")
+    keep_col, reload_col = st.columns(2)
+    with keep_col:
+        st.button("Keep my version", key=f"keep_edits_{key[1]}",
+                  on_click=resolve_edit_conflict,
+                  args=(key, db_manager, widget_keys, True))
+    with reload_col:
+        st.button("Load latest", key=f"reload_edits_{key[1]}",
+                  on_click=resolve_edit_conflict,
+                  args=(key, db_manager, widget_keys, False))
+
+
+def resolve_edit_conflict(key, db_manager, widget_keys, keep):
+    if keep:
+        get_autosave().resolve(key, save_edits(db_manager))
+    else:
+        get_autosave().resolve(key)
+        for widget_key in widget_keys:
+            st.session_state.pop(widget_key, None)
+
 # Helper functions for the main UI components
 
 
+@timed("ui.render_existing_patient_selector")
 def render_existing_patient_selector(patients, db_manager):
     if patients:
         patient_options = [""] + [f"{p[0]} {p[1]}" for p in patients]
@@ -115,6 +401,7 @@ def render_existing_patient_selector(patients, db_manager):
         update_patient_state(selected_patient, patient_ids)
 
 
+@timed("ui.render_new_patient_form")
 def render_new_patient_form(db_manager):
     with st.expander("Create New Patient", expanded=False):
         new_first_name = st.text_input("First Name")
@@ -131,6 +418,38 @@ def on_copy_click(text):
     st.toast('Copied to clipboard!')
 
 
+@timed("ui.render_audio_player")
+def render_audio_player(saved_data, db_manager):
+    file_id = saved_data.get("audio_file_id")
+    if not file_id:
+        return
+
+    # Only the selected segment is fetched from GridFS, and only on request.
+    if not st.toggle("Play audio", key=f"audio_toggle_{str(saved_data['_id'])}"):
+        return
+
+    audio_store = AudioStore(db_manager.db)
+    try:
+        duration = audio_store.layout(file_id).duration
+    except Exception as e:
+        st.error(f"Error loading audio: {str(e)}")
+        return
+    if duration <= 0:
+        st.info("The archived audio is empty.")
+        return
+
+    start, end = st.slider(
+        "Segment (seconds)",
+        min_value=0.0,
+        max_value=duration,
+        value=(0.0, min(duration, 60.0)),
+        key=f"audio_range_{str(saved_data['_id'])}"
+    )
+    st.audio(audio_store.read_time_range(file_id, start, end),
+             format="audio/wav")
+
+
+@timed("ui.render_transcript_column")
 def render_transcript_column(saved_data, db_manager):
     with st.expander("Transcript", expanded=False):
         key = f"transcript_{str(saved_data['_id'])}"
@@ -140,26 +459,23 @@ def render_transcript_column(saved_data, db_manager):
             value=saved_data["transcript"],
             height=300,
             key=key,
-            on_change=lambda: update_transcript(saved_data, db_manager, key)
+            on_change=lambda: get_autosave().edit(
+                ("recording", str(saved_data["_id"])), "transcript",
+                st.session_state[key])
         )
 
 
-def update_transcript(saved_data, db_manager, key):
-    db_manager.update_recording_data(
-        saved_data["_id"],
-        st.session_state[key],
-        saved_data["summary"]
-    )
-    st.success("Transcript updated successfully!")
-
-
+@timed("ui.render_summary_column")
 def render_summary_column(saved_data, db_manager):
     header_col1, header_col2, header_col3 = st.columns([0.6, 0.2, 0.2])
     with header_col1:
         st.subheader("Summary")
 
     with header_col3:
-        render_regenerate_button(saved_data, db_manager)
+        regenerate = render_regenerate_button(saved_data)
+
+    if regenerate:
+        regenerate_summary(saved_data, db_manager)
 
     key = f"summary_{str(saved_data['_id'])}"
     summary = st.text_area(
@@ -168,59 +484,57 @@ def render_summary_column(saved_data, db_manager):
         value=saved_data["summary"],
         height=300,
         key=key,
-        on_change=lambda: update_summary(saved_data, db_manager, key)
+        on_change=lambda: get_autosave().edit(
+            ("recording", str(saved_data["_id"])), "summary",
+            st.session_state[key])
     )
 
 
-def update_summary(saved_data, db_manager, key):
-    db_manager.update_recording_data(
-        saved_data["_id"],
-        saved_data["transcript"],
-        st.session_state[key]
-    )
-    st.success("Summary updated successfully!")
-
-
-def render_regenerate_button(saved_data, db_manager):
+@timed("ui.render_regenerate_button")
+def render_regenerate_button(saved_data):
     button_key = f"regenerate_summary_{str(saved_data['_id'])}"
-
-    if st.button("Rewrite", key=button_key, use_container_width=False):
-        try:
-            with st.spinner('Generating new summary...'):
-                new_summary = get_summary(
-                    saved_data["transcript"],
-                    st.session_state.current_prompt
-                )
-
-                db_manager.update_recording_data(
-                    saved_data["_id"],
-                    saved_data["transcript"],
-                    new_summary
-                )
-
-                if 'current_recording_id' in st.session_state:
-                    st.session_state.current_recording_id = str(
-                        saved_data['_id'])
-
-                st.rerun()
-        except Exception as e:
-            st.error(f"Error regenerating summary: {str(e)}")
-
-
+    return st.button("Rewrite", key=button_key, use_container_width=False)
+
+
+def regenerate_summary(saved_data, db_manager):
+    try:
+        # Summarize the transcript as edited, not as last loaded.
+        flush_edits(db_manager, force=True)
+        transcript = st.session_state.get(
+            f"transcript_{str(saved_data['_id'])}", saved_data["transcript"])
+        # Tokens are rendered as they arrive and flushed to the recording
+        # periodically, so a dropped session keeps the partial note.
+        with st.container(border=True):
+            st.write_stream(stream_summary_to_db(
+                transcript,
+                st.session_state.current_prompt,
+                db_manager,
+                saved_data["_id"],
+                get_summary_cache(db_manager.db)
+            ))
+
+        if 'current_recording_id' in st.session_state:
+            st.session_state.current_recording_id = str(saved_data['_id'])
+
+        st.rerun()
+    except Exception as e:
+        st.error(f"Error regenerating summary: {str(e)}")
+
+
+@timed("ui.render_recording_selector")
 def render_recording_selector(recordings, db_manager):
     if 'current_recording_id' not in st.session_state:
         st.session_state.current_recording_id = None
 
-    recording_options = [
-        (r["timestamp"].strftime("%Y-%m-%d %H:%M"), str(r["_id"]))
+    recording_labels = {
+        str(r["_id"]): r["timestamp"].strftime("%Y-%m-%d %H:%M")
         for r in recordings
-    ]
+    }
 
     selected_recording = st.selectbox(
         "Select a recording:",
-        options=[r[1] for r in recording_options],
-        format_func=lambda x: next(r[0]
-                                   for r in recording_options if r[1] == x),
+        options=list(recording_labels),
+        format_func=recording_labels.get,
         key="visit_recording_selector"
     )
 
@@ -239,14 +553,10 @@ def update_patient_state(selected_patient, patient_ids):
         st.session_state.last_name = last_name
         st.session_state.selected_patient_id = patient_ids.get(
             selected_patient)
-        if 'notes' in st.session_state:
-            del st.session_state.notes
     else:
         st.session_state.first_name = ""
         st.session_state.last_name = ""
         st.session_state.selected_patient_id = None
-        if 'notes' in st.session_state:
-            del st.session_state.notes
 
 
 def handle_new_patient_creation(new_first_name, new_last_name, db_manager):
@@ -279,26 +589,22 @@ def split_patient_name(combined_name):
     return combined_name, ""
 
 
+@timed("ui.render_patient_notes")
 def render_patient_notes(db_manager):
     with st.expander("Notes", expanded=False):
-        # Initialize notes in session state if not already present
-        if 'notes' not in st.session_state:
-            st.session_state.notes = db_manager.get_patient_notes(
-                st.session_state.selected_patient_id)
-
-        notes_input_key = "notes_input"
-
-        def save_notes():
-            new_value = st.session_state[notes_input_key]
-            st.session_state.notes = new_value
-            db_manager.update_patient_notes(
-                st.session_state.selected_patient_id, new_value)
-            st.success("Notes saved successfully!")
+        patient_id = st.session_state.selected_patient_id
+        notes, version = db_manager.get_patient_notes(patient_id)
+        key = ("notes", patient_id)
+        notes_input_key = f"notes_input_{patient_id}"
+        if get_autosave().track(key, version):
+            st.session_state.pop(notes_input_key, None)
+        render_edit_conflict(key, db_manager, [notes_input_key])
 
         st.text_area(
             "Enter your notes here:",
             key=notes_input_key,
-            value=st.session_state.notes,
+            value=notes,
             height=150,
-            on_change=save_notes
+            on_change=lambda: get_autosave().edit(
+                key, "notes", st.session_state[notes_input_key])
         )
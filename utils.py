@@ -5,8 +5,81 @@ from typing import Tuple
 import os
 import hmac
 import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from datetime import datetime
 
+from metrics import span, timed
+from resilience import Policy
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_FLUSH_SECONDS = 2.0
+
+# Transcripts up to this size are summarized in a single call; longer ones
+# are split into chunks that are summarized concurrently and then merged.
+SUMMARY_SINGLE_CALL_TOKENS = int(os.getenv('SUMMARY_SINGLE_CALL_TOKENS', 12000))
+SUMMARY_CHUNK_TOKENS = int(os.getenv('SUMMARY_CHUNK_TOKENS', 6000))
+SUMMARY_MAP_WORKERS = int(os.getenv('SUMMARY_MAP_WORKERS', 4))
+
+# Every OpenAI call goes through OPENAI_POLICY, so the client's own
+# retries are turned off. Hedging duplicates token spend; opt in with
+# OPENAI_HEDGE=1.
+SUMMARY_DEADLINE_SECONDS = float(os.getenv('SUMMARY_DEADLINE_SECONDS', 180))
+SUMMARY_ATTEMPT_TIMEOUT_SECONDS = float(
+    os.getenv('SUMMARY_ATTEMPT_TIMEOUT_SECONDS', 90))
+SUMMARY_MAX_RETRIES = int(os.getenv('SUMMARY_MAX_RETRIES', 3))
+openai.max_retries = 0
+
+
+def openai_retriable(error):
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError,
+                              openai.InternalServerError))
+
+
+OPENAI_POLICY = Policy(
+    "openai",
+    deadline=SUMMARY_DEADLINE_SECONDS,
+    attempt_timeout=SUMMARY_ATTEMPT_TIMEOUT_SECONDS,
+    retriable=openai_retriable,
+    max_retries=SUMMARY_MAX_RETRIES,
+    hedge=os.getenv('OPENAI_HEDGE') == '1'
+)
+
+
+def chat_completion(messages, stream=False, hedge=True):
+    """
+    One chat completion under OPENAI_POLICY. For streams the policy covers
+    getting the stream started; the timeout then bounds each read.
+    """
+    return OPENAI_POLICY.call(
+        lambda timeout: openai.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=messages,
+            stream=stream,
+            timeout=timeout
+        ),
+        hedge=hedge and not stream
+    )
+
+
+MAP_PROMPT = (
+    "You are a medical scribe assistant. This is part {part} of {parts} of "
+    "the transcript of one medical visit. Write concise notes covering every "
+    "symptom, finding, diagnosis, medication and plan mentioned in this part. "
+    "Do not add anything that is not in the transcript."
+)
+REDUCE_PREAMBLE = (
+    "The visit transcript was too long to process at once, so it was split "
+    "into consecutive parts. Below are notes taken from each part, in order. "
+    "Write the summary of the whole visit from them.\n\n"
+)
+
 
 def create_user(email: str, password: str, db) -> Tuple[bool, str]:
     """
@@ -48,6 +121,11 @@ def hash_password(password: str) -> str:
     return hmac.new(salt.encode(), password.encode(), hashlib.sha256).hexdigest()
 
 
+def hash_audio(audio: bytes) -> str:
+    """Content hash used to recognise a recording we've already processed"""
+    return hashlib.sha256(audio).hexdigest()
+
+
 def verify_user(email: str, password: str, db) -> str:
     """Verify provider credentials and return provider_id if successful"""
     provider = db.providers.find_one({"email": email})
@@ -60,12 +138,143 @@ def verify_user(email: str, password: str, db) -> str:
     return None
 
 
-def get_summary(transcript, system_prompt):
-    response = openai.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": transcript}
-        ]
-    )
-    return response.choices[0].message.content
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is None:
+        # Roughly four characters per token for English text.
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(SUMMARY_MODEL)
+    except Exception:
+        # tiktoken downloads its BPE file on first use; offline hosts estimate.
+        return None
+
+
+def split_transcript(transcript: str, max_tokens: int) -> list:
+    """Pack whole sentences into chunks of at most `max_tokens` tokens"""
+    sentences = []
+    for sentence in re.split(r'(?<=[.!?])\s+', transcript):
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            sentences.append((sentence, tokens + 1))
+            continue
+        # Unpunctuated stretches are cut into word windows instead.
+        words = sentence.split()
+        step = max(1, len(words) * max_tokens // (tokens + 1))
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step])
+            sentences.append((piece, count_tokens(piece) + 1))
+
+    chunks, current, current_tokens = [], [], 0
+    for sentence, tokens in sentences:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+@timed("summary.map")
+def summarize_parts(transcript, max_workers=SUMMARY_MAP_WORKERS):
+    """
+    Map step for long transcripts: extract notes from each chunk
+    concurrently. Returns the partial notes in transcript order.
+    """
+    chunks = split_transcript(transcript, SUMMARY_CHUNK_TOKENS)
+
+    def summarize_chunk(numbered_chunk):
+        number, chunk = numbered_chunk
+        response = chat_completion([
+            {"role": "system", "content": MAP_PROMPT.format(
+                part=number, parts=len(chunks))},
+            {"role": "user", "content": chunk}
+        ])
+        return response.choices[0].message.content
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(summarize_chunk, enumerate(chunks, 1)))
+
+
+def summary_messages(transcript, system_prompt):
+    """
+    Messages for the final summary call. Short transcripts go to the model
+    as-is; long ones are mapped into partial notes first and the provider's
+    prompt is applied when merging them.
+    """
+    if count_tokens(transcript) <= SUMMARY_SINGLE_CALL_TOKENS:
+        content = transcript
+    else:
+        notes = summarize_parts(transcript)
+        content = REDUCE_PREAMBLE + "\n\n".join(
+            f"Part {number}:\n{note}" for number, note in enumerate(notes, 1))
+
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": content}
+    ]
+
+
+@timed("summary.get_summary")
+def get_summary(transcript, system_prompt, cache=None):
+    if cache:
+        cached = cache.get(transcript, system_prompt, SUMMARY_MODEL)
+        if cached is not None:
+            return cached
+
+    messages = summary_messages(transcript, system_prompt)
+    with span("openai.chat"):
+        response = chat_completion(messages)
+    summary = response.choices[0].message.content
+    if cache:
+        cache.put(transcript, system_prompt, SUMMARY_MODEL, summary)
+    return summary
+
+
+@timed("summary.stream_summary")
+def stream_summary(transcript, system_prompt, cache=None):
+    """Yield summary tokens as the model produces them"""
+    if cache:
+        cached = cache.get(transcript, system_prompt, SUMMARY_MODEL)
+        if cached is not None:
+            yield cached
+            return
+
+    stream = chat_completion(
+        summary_messages(transcript, system_prompt), stream=True)
+    parts = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+
+    if cache:
+        cache.put(transcript, system_prompt, SUMMARY_MODEL, "".join(parts))
+
+
+def stream_summary_to_db(transcript, system_prompt, db_manager, document_id,
+                         cache=None, flush_interval=SUMMARY_FLUSH_SECONDS):
+    """
+    Stream a summary while periodically saving the partial text to the
+    recording, so an interrupted session keeps what was generated so far.
+    """
+    parts = []
+    last_flush = time.monotonic()
+    for token in stream_summary(transcript, system_prompt, cache):
+        parts.append(token)
+        yield token
+        if time.monotonic() - last_flush >= flush_interval:
+            db_manager.update_recording_summary(
+                document_id, "".join(parts), summary_complete=False)
+            last_flush = time.monotonic()
+
+    db_manager.update_recording_summary(document_id, "".join(parts))
@@ -0,0 +1,130 @@
+"""Background worker pool that drains the `jobs` collection.
+
+Run alongside the Streamlit app:
+
+    python worker.py --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+import openai
+from dotenv import load_dotenv
+
+import jobs
+import metrics
+from data import DatabaseManager
+from resummarize import BatchResummarizer
+from stt import STTService
+from summary_cache import SummaryCache
+from utils import stream_summary_to_db
+
+STALE_JOB_SECONDS = 15 * 60
+
+
+@metrics.timed("worker.process_job")
+def process_job(db_manager, job_queue, job, stt_service, summary_cache=None):
+    recording_id = job.get("recording_id")
+    if recording_id:
+        # Retry of a job that already got through transcription.
+        transcript = db_manager.load_transcript(recording_id)
+    else:
+        audio = job_queue.load_audio(job)
+        transcript = stt_service.transcribe(audio)
+        if not transcript:
+            raise RuntimeError("Transcription returned no text")
+
+        # Save the transcript straight away; the summary is streamed into
+        # the same document so the UI can show it while it's being written.
+        recording_id = db_manager.save_recording_data(
+            transcript,
+            "",
+            job["provider_id"],
+            job["patient_id"],
+            summary_complete=False,
+            audio_hash=job["audio_hash"],
+            audio_file_id=job["audio_id"]
+        )
+
+    job_queue.set_state(job["_id"], jobs.SUMMARIZING,
+                        recording_id=recording_id)
+    for _ in stream_summary_to_db(transcript, job["system_prompt"],
+                                  db_manager, recording_id, summary_cache):
+        pass
+
+    return recording_id
+
+
+def run_worker(worker_id, poll_interval, metrics_port):
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s {worker_id} %(name)s: %(message)s")
+    load_dotenv()
+    metrics.start_http_server(metrics_port)
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    stt_service = STTService(os.getenv('DEEPGRAM_API_KEY'))
+
+    db_manager = DatabaseManager()
+    job_queue = jobs.JobQueue(db_manager.db)
+    summary_cache = SummaryCache(db_manager.db)
+    resummarizer = BatchResummarizer(db_manager, summary_cache)
+    batch = None
+
+    while True:
+        job_queue.requeue_stale(STALE_JOB_SECONDS)
+        job = job_queue.claim(worker_id)
+        if job is None:
+            # Bulk rewrites only use idle time, one window between checks
+            # for new recordings.
+            batch = batch or resummarizer.claim(worker_id)
+            try:
+                if batch is not None and resummarizer.run_window(batch):
+                    continue
+            except Exception:
+                logging.exception("Re-summarization batch %s", batch["_id"])
+            batch = None
+            time.sleep(poll_interval)
+            continue
+
+        try:
+            recording_id = process_job(
+                db_manager, job_queue, job, stt_service, summary_cache)
+            job_queue.complete(job, recording_id)
+            metrics.increment("jobs_total", state=jobs.DONE)
+        except Exception as e:
+            job_queue.fail(job, e)
+            metrics.increment("jobs_total", state=jobs.FAILED)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--metrics-port", type=int,
+                        default=metrics.METRICS_PORT + 1,
+                        help="Worker i serves /metrics on this port + i")
+    args = parser.parse_args()
+
+    # Each process opens its own MongoClient, so never fork a live one.
+    ctx = multiprocessing.get_context("spawn")
+    hostname = socket.gethostname()
+    workers = [
+        ctx.Process(
+            target=run_worker,
+            args=(f"{hostname}-{os.getpid()}-{i}", args.poll_interval,
+                  args.metrics_port + i),
+            daemon=True
+        )
+        for i in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == "__main__":
+    main()